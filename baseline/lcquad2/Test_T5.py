@@ -1,5 +1,3 @@
-from transformers import T5Tokenizer, T5ForConditionalGeneration
-
 import json
 import os
 
@@ -7,34 +5,88 @@ import torch
 import pickle
 import torch.nn as nn
 
-import re
 import argparse
 
+from token_dataset import TokenDataset, load
+from engine import Engine, add_arguments
+from inference import Generator
+from generation_cache import GenerationCache, namespace
+from staged_decoding import StagedDecoder, Validator
+import bundle
+import sharding
+import cpu_backend
+
 parser=argparse.ArgumentParser()
 parser.add_argument('--test_file',type=str,default=None)
 parser.add_argument('--model_name',type=str,default='t5-base')
 parser.add_argument('--checkpoint',type=str,default=None)
-parser.add_argument('--device',type=int,default=0)
+parser.add_argument('--bundle',type=str,default=None)
+parser.add_argument('--vocab',type=str,default='vocab.txt')
+add_arguments(parser)
+parser.add_argument('--analysis',action='store_true')
 parser.add_argument('--beam_length',type=int,default=10)
+parser.add_argument('--constrained',action='store_true')
+parser.add_argument('--constraint_topk',type=int,default=4)
+parser.add_argument('--restrict_vocab',action='store_true')
+parser.add_argument('--gen_cache',type=str,default=None)
+parser.add_argument('--gen_cache_entries',type=int,default=10000)
+parser.add_argument('--gen_cache_ttl',type=float,default=None)
+parser.add_argument('--staged',action='store_true')
+parser.add_argument('--stage_kg',type=str,default=None)
+parser.add_argument('--stage_endpoint',type=str,default=None)
+sharding.add_arguments(parser)
+cpu_backend.add_arguments(parser)
 args=parser.parse_args()
+if args.shard is not None and not 0<=args.shard<args.shards:
+        parser.error('--shard must be below --shards')
+if args.bundle is not None:
+        # config, tokenizer, vocab and fine-tuned weights from bundle.py,
+        # loaded once instead of the hub model plus the checkpoint on top
+        args.model_name=bundle.manifest(args.bundle)['model_name']
+        args.checkpoint=bundle.weights_path(args.bundle)
+        args.vocab=bundle.vocab_path(args.bundle)
+if args.backend!='torch':
+        # quantized and ONNX Runtime models run on CPU
+        args.device='cpu'
+        if args.restrict_vocab:
+                parser.error('--restrict_vocab needs --backend torch')
 
 torch.manual_seed(42)
 
-file=open(args.test_file,'rb')
-final_data_test=pickle.load(file)
-file.close()
+final_data_test=load(args.test_file)
+if isinstance(final_data_test,TokenDataset):
+        final_data_test.check(args.model_name,args.vocab)
+
+
+def result_file(args):
+        temps=''
+        if 'mix' in args.test_file:
+            temps='mix_'
+        if 'small' in args.model_name:
+            temps='small_'+temps
+        else:
+            temps='T5_'+temps
+        return temps+'test_result.json'
+
+
+if args.shards>1 or args.shard is not None:
+        # this run's shard directory, refused if it holds another run's shards
+        sharding.check(parser,args,result_file(args))
 
 
 class Model(nn.Module):
-        def __init__(self,model_name):
+        def __init__(self,model_name,analysis=False):
                 super(Model,self).__init__()
+                from transformers import T5ForConditionalGeneration
                 self.model=T5ForConditionalGeneration.from_pretrained(model_name)
+                # hidden states and attention maps are only kept for analysis runs
+                self.analysis=analysis
 
         def forward(self,input):
                 outputs=self.model(input_ids=input['input_ids'], \
                                            labels=input['labels'],  \
                                            attention_mask=input['attention_mask'], \
-                                           output_hidden_states=True,output_attentions=True)
+                                           output_hidden_states=self.analysis,output_attentions=self.analysis)
 
                 return outputs.loss
                 
@@ -43,47 +95,75 @@ class Test:
         def __init__(self,data_test,args):
                 self.test_data=data_test
 
-                self.tokenizer=T5Tokenizer.from_pretrained(args.model_name)
-                self.model=nn.DataParallel(Model(args.model_name),device_ids=[args.device])
-                self.model.to(f'cuda:{self.model.device_ids[0]}')  
+                # transformers and the optional decoding modules are imported
+                # here, so --help and the parent of a sharded run start fast
+                from transformers import T5Tokenizer
+                self.tokenizer=T5Tokenizer.from_pretrained(args.bundle or args.model_name)
+                self.engine=Engine.from_args(args)
+                self.model=self.engine.wrap(Model(args.bundle or args.model_name,args.analysis))
+                print(self.engine.describe())
                 
                 self.num_gpus=1
                 self.eval_bs=8
                 self.beam=args.beam_length
                 self.args=args
                 
-                params=torch.load(args.checkpoint);
-                self.model.load_state_dict(params);
+                if args.bundle is None:
+                        params=self.engine.load(args.checkpoint);
+                        self.model.load_state_dict(params);
+                if args.backend!='torch':
+                        self.model.module.model=cpu_backend.prepare(self.model.module.model,args.backend, \
+                                                                    args.export_dir,self.engine.threads)
                 print('started')
                 
-                file=open('vocab.txt','r')
+                file=open(args.vocab,'r')
                 vocab=file.readlines()
                 file.close()
                 for i in range(len(vocab)):
                         vocab[i]=vocab[i].strip()
                 vocab.append('null')
                         
-                self.vocab_dict={}
-                i=0
-                for text in vocab:
-                        self.vocab_dict['<extra_id_'+str(i)+'>']=text
-                        i+=1
+                # beam search, output restriction and de-masking as serve.py does them
+                self.generator=Generator(self.model,self.tokenizer,self.engine,vocab,beam=self.beam, \
+                                         constrained=args.constrained,constraint_topk=args.constraint_topk, \
+                                         restrict_vocab=args.restrict_vocab)
+                self.demasker=self.generator.demasker
+                self.cache=None
+                if args.gen_cache is not None:
+                        # beams of inputs seen by earlier runs of this checkpoint
+                        self.cache=GenerationCache(namespace(args.checkpoint,args.model_name,beam=self.beam,max_length=100, \
+                                                             constrained=args.constrained,constraint_topk=args.constraint_topk, \
+                                                             restrict_vocab=args.restrict_vocab, \
+                                                             staged=args.staged,stage_kg=args.stage_kg, \
+                                                             stage_endpoint=args.stage_endpoint,backend=args.backend), \
+                                                   args.gen_cache_entries,args.gen_cache_ttl,disk=args.gen_cache)
+                self.generator.cache=self.cache
+                self.stager=None
+                if args.staged:
+                        # greedy first, beam search only for outputs that fail validation
+                        endpoint=None
+                        if args.stage_kg is not None:
+                                from triple_store import LocalEndpoint
+                                endpoint=LocalEndpoint(args.stage_kg)
+                        elif args.stage_endpoint is not None:
+                                from sparql_endpoint import Endpoint
+                                endpoint=Endpoint(args.stage_endpoint)
+                        self.stager=StagedDecoder(Validator(self.demasker,endpoint),self.beam)
+                self.generator.stager=self.stager
                 
                 self.test()
                 
         def readable(self,string):
-            for key in self.vocab_dict:
-                string=string.replace(key,' '+self.vocab_dict[key]+' ')
-            string=string.replace('  ',' ')
-            vals=string.split()
-            
-            for k in range(len(vals)):
-                if bool(re.match(r'q[0-9]+',vals[k])):
-                    vals[k]='Q'+vals[k][1:]
-                elif bool(re.match(r'p[0-9]+',vals[k])):
-                    vals[k]='P'+vals[k][1:]
-                        
-            return ' '.join(vals)
+                return self.demasker.readable(string)
+
+        def encode(self,data,indices):
+                if isinstance(data,TokenDataset):
+                        return self.engine.to(data.collate(indices,self.tokenizer.pad_token_id))
+                inp,label=[],[]
+                for j in indices:
+                        inp.append(data[j][0])
+                        label.append(data[j][1])
+                return self.preprocess_function(inp,label)
 
         def preprocess_function(self,inputs, targets):
                 model_inputs=self.tokenizer(inputs, padding=True, \
@@ -96,56 +176,67 @@ class Test:
                          for l in label] for label in labels["input_ids"]
                     ]
                 labels['input_ids']=torch.tensor(labels['input_ids'])
-                model_inputs["labels"]=labels["input_ids"].to(f'cuda:{self.model.device_ids[0]}')
-                model_inputs["input_ids"]=model_inputs["input_ids"].to(f'cuda:{self.model.device_ids[0]}')
-                model_inputs["attention_mask"]=model_inputs["attention_mask"].to(f'cuda:{self.model.device_ids[0]}')
+                model_inputs["labels"]=labels["input_ids"]
 
-                return model_inputs
+                return self.engine.to(model_inputs)
                 
         def test(self):
                 self.model.eval()
                 bs,i=self.eval_bs,0
                 saver=[]
+                order=range(len(self.test_data))
+                writer=None
+                if self.args.shard is not None:
+                        # one worker of a sharded run, resuming after its last written batch
+                        writer=sharding.ShardWriter(sharding.shard_path(self.args.shard_dir,self.args.shard))
+                        order=sharding.shard_range(len(self.test_data),self.args.shards,self.args.shard)[writer.done:]
+                        print('shard {}: {} questions left'.format(self.args.shard,len(order)))
                
-                while i<len(self.test_data):
-                    bs_=min(bs,len(self.test_data)-i)
+                while i<len(order):
+                    bs_=min(bs,len(order)-i)
                     i+=bs_
                     inp,label=[],[]
-                    for j in range(i-bs_,i):
+                    for j in order[i-bs_:i]:
                             inp.append(self.test_data[j][0])
                             label.append(self.test_data[j][1])
 
-                    input=self.preprocess_function(inp,label)
-                    
-                    output=self.model.module.model.generate(input_ids=input['input_ids'],
-                                          num_beams=self.beam,attention_mask=input['attention_mask'], \
-                                            early_stopping=True, max_length=100,num_return_sequences=self.beam)
-                    
-                    out=self.tokenizer.batch_decode(output,skip_special_tokens=False)
+                    indices=list(order[i-bs_:i])
+                    out=self.generator.generate(inp,lambda positions:self.encode(self.test_data, \
+                                                                                 [indices[m] for m in positions]))
 
-                    for k in range(len(out)//self.beam):
+                    records=[]
+                    for k in range(len(out)):
                         dict={}
                         dict['question']=self.readable(inp[k])
                         dict['gold_sparql']=self.readable(label[k].strip())
                         dict['top_'+str(self.beam)+'_output']=[]
-                        for s in range(self.beam):
+                        for s in range(len(out[k])):
                             dict['top_'+str(self.beam)+'_output']. \
-                            append(self.readable(out[int(k*self.beam+s)].replace('<pad>',''). \
-                                          replace('</s>','').replace('<unk>','').replace('<s>','').strip()))
+                            append(out[k][s])
                             
-                        saver.append(dict)
+                        records.append(dict)
+                    if writer is not None:
+                        writer.write(records)
+                    else:
+                        saver.extend(records)
                 
-                temps=''
-                if 'mix' in self.args.test_file:
-                    temps='mix_'
-                if 'small' in self.args.model_name:
-                    temps='small_'+temps
+                print(self.engine.memory_report('test'))
+                if writer is not None:
+                        writer.close()
                 else:
-                    temps='T5_'+temps
-                print('Saving to {}'.format(os.getcwd()))
-                file=open(temps+'test_result.json','w')
-                json.dump(saver,file)
-                file.close()
-
-tester=Test(final_data_test,args)
+                        print('Saving to {}'.format(os.getcwd()))
+                        file=open(result_file(self.args),'w')
+                        json.dump(saver,file)
+                        file.close()
+                if self.stager is not None:
+                        print(self.stager.report())
+                if self.cache is not None:
+                        print(self.cache.report())
+                        self.cache.close()
+
+if args.shards>1 and args.shard is None:
+        # parent of a sharded run: the workers load the model, this merges
+        sharding.run(args,len(final_data_test),result_file(args))
+else:
+        tester=Test(final_data_test,args)
 
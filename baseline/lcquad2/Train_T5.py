@@ -1,42 +1,56 @@
 from transformers import T5Tokenizer, T5ForConditionalGeneration
 import transformers
 
-import json
-
 import torch
 import torch.optim as optim
-import pickle
 import torch.nn as nn
 import random
 
 import argparse
 
+from token_dataset import TokenDataset, load
+from engine import Engine, add_arguments
+from batching import TokenBudgetSampler, lengths
+from sparql_rewriter import load_vocab
+from sparql_canon import Matcher
+import telemetry
+import validation
+
 parser=argparse.ArgumentParser()
 parser.add_argument('--train_file',type=str,default=None)
 parser.add_argument('--test',type=bool,default=False)
 parser.add_argument('--model_name',type=str,default='t5-base')
 parser.add_argument('--checkpoint',type=str,default=None)
-parser.add_argument('--device',type=int,default=0)
+add_arguments(parser)
+parser.add_argument('--analysis',action='store_true')
+parser.add_argument('--grad_checkpoint',action='store_true')
+parser.add_argument('--max_tokens',type=int,default=None)
+telemetry.add_arguments(parser)
+validation.add_arguments(parser)
 args=parser.parse_args()
 
 
 torch.manual_seed(42)
 
-file=open(args.train_file,'rb')
-data=pickle.load(file)
-file.close()
+data=load(args.train_file)
+if isinstance(data,TokenDataset):
+        data.check(args.model_name)
 
 total_len=len(data)
 final_data_dev,final_data=data[:total_len//10],data[total_len//10:]
 
 class Model(nn.Module):
-        def __init__(self,model_name):
+        def __init__(self,model_name,analysis=False,grad_checkpoint=False):
                 super(Model,self).__init__()
                 self.model=T5ForConditionalGeneration.from_pretrained(model_name)
+                # hidden states and attention maps are only kept for analysis runs
+                self.analysis=analysis
+                if grad_checkpoint:
+                        self.model.gradient_checkpointing_enable()
 
         def forward(self,input):
                 outputs=self.model(input_ids=input['input_ids'], \
-                                           labels=input['labels'], attention_mask=input['attention_mask'],output_hidden_states=True,output_attentions=True)
+                                           labels=input['labels'], attention_mask=input['attention_mask'],output_hidden_states=self.analysis,output_attentions=self.analysis)
 
                 return outputs.loss
                 
@@ -48,8 +62,10 @@ class Train:
                 self.args=args
 
                 self.tokenizer=T5Tokenizer.from_pretrained(args.model_name)
-                self.model=nn.DataParallel(Model(args.model_name),device_ids=[args.device])
-                self.model.to(f'cuda:{self.model.device_ids[0]}')  
+                self.engine=Engine.from_args(args)
+                self.model=self.engine.wrap(Model(args.model_name,args.analysis,args.grad_checkpoint))
+                print(self.engine.describe())
+                self.matcher=Matcher(load_vocab('vocab.txt'))
                
                 self.optimizer=optim.AdamW(self.model.parameters(),lr=0.0015)
                 self.lr_scheduler=transformers. \
@@ -57,22 +73,39 @@ class Train:
 
                 self.iters=60000
                 self.print_every=100
-                self.eval_every=8000
                 self.num_gpus=1
                 self.eval_bs=6
                 self.bs=5
                 self.back_propogate=10
+
+                self.sampler=None
+                if args.max_tokens is not None:
+                        inp_len,lab_len=lengths(self.data,self.tokenizer)
+                        self.sampler=TokenBudgetSampler(inp_len,lab_len,args.max_tokens)
+
+                # per-step phase times, tokens/s and padding as JSONL (--telemetry)
+                self.telemetry=telemetry.Telemetry.from_args(args,self.engine,model_name=args.model_name, \
+                                                             train_file=args.train_file,max_tokens=args.max_tokens)
+
+                # greedy proxy runs on a fixed dev subset, full beam runs at milestones
+                self.schedule=validation.ValidationSchedule.from_args(args)
+                self.val_subset=validation.stratified_subset(self.dev_data,args.val_size,args.val_seed)
                 
                 self.train()
 
         def generate_batch(self):
-                output=random.sample(self.data,self.bs)
-                inp,label=[],[]
-                for dat in output:
-                        inp.append(dat[0])
-                        label.append(dat[1])
+                if self.sampler is not None:
+                        return self.sampler.sample()
+                return random.sample(range(len(self.data)),self.bs)
 
-                return inp,label
+        def encode(self,data,indices):
+                if isinstance(data,TokenDataset):
+                        return self.engine.to(data.collate(indices,self.tokenizer.pad_token_id))
+                inp,label=[],[]
+                for j in indices:
+                        inp.append(data[j][0])
+                        label.append(data[j][1])
+                return self.preprocess_function(inp,label)
 
         def preprocess_function(self,inputs, targets):
                 model_inputs=self.tokenizer(inputs, padding=True, \
@@ -85,33 +118,44 @@ class Train:
                          for l in label] for label in labels["input_ids"]
                     ]
                 labels['input_ids']=torch.tensor(labels['input_ids'])
-                model_inputs["labels"]=labels["input_ids"].to(f'cuda:{self.model.device_ids[0]}')
-                model_inputs["input_ids"]=model_inputs["input_ids"].to(f'cuda:{self.model.device_ids[0]}')
-                model_inputs["attention_mask"]=model_inputs["attention_mask"].to(f'cuda:{self.model.device_ids[0]}')
+                model_inputs["labels"]=labels["input_ids"]
 
-                return model_inputs
+                return self.engine.to(model_inputs)
 
-        def val(self,o):
-                print('Evaluating ...')
+        def val(self,o,indices=None,beam=10,kind='full'):
+                # beam=1 decodes greedily, for the proxy runs over self.val_subset
+                if indices is None:
+                        indices=range(len(self.dev_data))
+                print('Evaluating on {} questions ...'.format(len(indices)))
                 self.model.eval()
-                acc,bs,i=0,self.eval_bs,0
-                saver=[]
+                acc,exact,bs,i=0,0,self.eval_bs,0
+                temps=''
+                if 'base' in args.model_name:
+                    temps='T5_'
+                else:
+                    temps='small_'
+                name='_dev_result' if kind=='full' else '_dev_'+kind
+                writer=validation.ResultWriter(temps+self.args.train_file.split('.')[0]+name+str(o)+'.jsonl')
                
-                while i<len(self.dev_data):
-                    bs_=min(bs,len(self.dev_data)-i)
+                while i<len(indices):
+                    bs_=min(bs,len(indices)-i)
+                    batch=indices[i:i+bs_]
                     i+=bs_
                     inp,label=[],[]
-                    for j in range(i-bs_,i):
+                    for j in batch:
                             inp.append(self.dev_data[j][0])
                             label.append(self.dev_data[j][1])
 
-                    input=self.preprocess_function(inp,label)
+                    with self.telemetry.phase('val_data'):
+                        input=self.encode(self.dev_data,batch)
                     
-                    output=self.model.module.model.generate(input_ids=input['input_ids'],
-                                          num_beams=10,attention_mask=input['attention_mask'], \
-                                            early_stopping=True, max_length=200,output_hidden_states=True,output_attentions=True)
+                    with self.telemetry.phase('generate'), self.engine.autocast():
+                        output=self.model.module.model.generate(input_ids=input['input_ids'],
+                                          num_beams=beam,attention_mask=input['attention_mask'], \
+                                            early_stopping=beam>1, max_length=200,output_hidden_states=self.args.analysis,output_attentions=self.args.analysis)
                     
                     out=self.tokenizer.batch_decode(output,skip_special_tokens=False)
+                    saver=[]
 
                     for k in range(len(out)):
                             #print(out[k].replace('<pad>','').replace('</s>','').strip())
@@ -121,34 +165,50 @@ class Train:
                             saver.append({'input':inp[k],'gold':label[k].strip(),'generated':out[k].replace('<pad>',''). \
                                           replace('</s>','').replace('<unk>','').replace('<s>','').strip()})
                             if a1==a2:
-                                    acc+=1; #print('ttt')
-                
-                temps=''
-                if 'base' in args.model_name:
-                    temps='T5_'
-                else:
-                    temps='small_'
-                file=open(temps+self.args.train_file.split('.')[0]+'_dev_result'+str(o)+'.json','w')
-                json.dump(saver,file)
-                file.close()
-                return 100*acc/len(self.dev_data)
+                                    exact+=1
+                            # same query up to triple order, variable names and spacing
+                            if self.matcher.match(out[k],label[k]):
+                                    acc+=1
+                    writer.write(saver)
+                writer.close()
+                print('validation exact match={}'.format(100*exact/len(indices)))
+                self.telemetry.flush('validation',('val_data','generate'),step=o,kind=kind,examples=len(indices), \
+                                     exact=100*exact/len(indices),acc=100*acc/len(indices))
+                return 100*acc/len(indices)
 
         def train(self):
 
                 scalar=0
                 for i in range(self.iters):
                         self.model.train()
-                        inp,label=self.generate_batch()
-                        input=self.preprocess_function(inp,label)
-                        loss=self.model(input)
-
-                        scalar+=loss.mean().item()
+                        with self.telemetry.phase('data'):
+                                input=self.encode(self.data,self.generate_batch())
+                        self.telemetry.batch(input)
+                        with self.telemetry.phase('forward'), self.engine.autocast():
+                                loss=self.model(input)
+
+                        step_loss=loss.mean().item()
+                        scalar+=step_loss
                         if(i+1)%self.print_every==0:
                                 print('iteration={}, training loss={}'.format(i+1,scalar/self.print_every))
                                 scalar=0
-                        if(i+1)%self.eval_every==0:
+                        due=self.schedule.due(i+1)
+                        if due is not None:
+                                self.telemetry.pause()
+                        if due=='proxy':
+                                acc=self.val(i+1,self.val_subset,beam=1,kind='proxy')
+                                print('proxy validation acc={}'.format(acc))
+                                if self.schedule.improved(acc):
+                                        due='full'
+                        if due=='full':
+                                print(self.engine.memory_report('train'))
+                                self.engine.reset_peak_memory()
                                 acc=self.val(i+1)
                                 print('validation acc={}'.format(acc))
+                                print(self.engine.memory_report('validation'))
+                                self.engine.reset_peak_memory()
+                                if self.telemetry.enabled:
+                                        print('time split: '+self.telemetry.summary())
 
                                 temps=''
                                 if 'base' in args.model_name:
@@ -158,12 +218,22 @@ class Train:
 
                                 torch.save(self.model.state_dict(),temps+self.args.train_file.split('.')[0] \
                                            +'_checkpoint'+str(i+1)+'.pth')
+                        if due is not None:
+                                self.telemetry.resume()
                         
-                        loss/=self.back_propogate
-                        loss.mean().backward()
+                        with self.telemetry.phase('backward'):
+                                loss/=self.back_propogate
+                                loss.mean().backward()
                         if (i+1)%self.back_propogate:
-                                self.optimizer.step();
-                                self.lr_scheduler.step();
-                                self.optimizer.zero_grad()
+                                with self.telemetry.phase('optimizer'):
+                                        self.optimizer.step();
+                                        self.lr_scheduler.step();
+                                        self.optimizer.zero_grad()
+                        self.telemetry.step(i+1,step_loss,self.lr_scheduler.get_last_lr()[0])
+
+                print(self.engine.memory_report('train'))
+                if self.telemetry.enabled:
+                        print('time split: '+self.telemetry.summary())
+                self.telemetry.close()
 
 trainer=Train(final_data,final_data_dev,args)
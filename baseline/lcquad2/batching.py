@@ -0,0 +1,63 @@
+import random
+
+# Length-bucketed batching under a padded-token budget.
+#
+# Each pass shuffles the data, sorts it by (input, label) length inside pools
+# of `pool_size` examples, cuts each pool greedily into batches whose padded
+# size n*(max input len + max label len) stays within `max_tokens`, and then
+# shuffles the batches, so similar lengths share a batch while the order
+# across buckets stays random.
+
+
+class TokenBudgetSampler:
+    def __init__(self,input_lengths,label_lengths,max_tokens,pool_size=1000,max_examples=None,rng=None):
+        self.input_lengths=[int(n) for n in input_lengths]
+        self.label_lengths=[int(n) for n in label_lengths]
+        self.max_tokens=max_tokens
+        self.pool_size=pool_size
+        self.max_examples=max_examples
+        self.rng=random if rng is None else rng
+        self.batches=[]
+
+    def cost(self,max_inp,max_lab,n):
+        return n*(max_inp+max_lab)
+
+    def make_batches(self):
+        order=list(range(len(self.input_lengths)))
+        self.rng.shuffle(order)
+        batches=[]
+        for start in range(0,len(order),self.pool_size):
+            pool=sorted(order[start:start+self.pool_size], \
+                        key=lambda j:(self.input_lengths[j],self.label_lengths[j]))
+            batch,max_inp,max_lab=[],0,0
+            for j in pool:
+                inp=max(max_inp,self.input_lengths[j])
+                lab=max(max_lab,self.label_lengths[j])
+                full=self.max_examples is not None and len(batch)>=self.max_examples
+                if batch and (full or self.cost(inp,lab,len(batch)+1)>self.max_tokens):
+                    batches.append(batch)
+                    batch,inp,lab=[],self.input_lengths[j],self.label_lengths[j]
+                batch.append(j)
+                max_inp,max_lab=inp,lab
+            if batch:
+                batches.append(batch)
+        self.rng.shuffle(batches)
+        return batches
+
+    def sample(self):
+        if not self.batches:
+            self.batches=self.make_batches()
+        return self.batches.pop()
+
+    def __iter__(self):
+        return iter(self.make_batches())
+
+
+def lengths(data,tokenizer):
+    # (input lengths, label lengths) in tokens for a TokenDataset or a list
+    # of [input, label] strings.
+    if hasattr(data,'lengths'):
+        return data.lengths()
+    inp=tokenizer([d[0] for d in data],max_length=512,truncation=True)['input_ids']
+    lab=tokenizer([d[1] for d in data],max_length=512,truncation=True)['input_ids']
+    return [len(x) for x in inp],[len(x) for x in lab]
@@ -0,0 +1,336 @@
+import os
+import re
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import inspect
+import subprocess
+
+import numpy as np
+import torch
+
+import label_index
+from engine import Engine
+from token_dataset import load
+from sparql_rewriter import Rewriter, load_vocab
+from sparql_decoder import Demasker
+from sparql_canon import structmatch
+
+# CPU throughput/latency benchmark of every pipeline stage:
+#   preprocess   sparql_wikidata -> masked target + [DEF] annotated question
+#                (preprocess.py's loop)
+#   tokenize     Test_T5/Test_BART preprocess_function on eval_bs batches
+#   generate     model.generate per model, beam_length and eval_bs
+#   decode_ids   generated ids -> SPARQL text (Demasker.decode_ids)
+#   readable     masked gold -> SPARQL text (Test_*.readable)
+#   score        get_F1 --structural (sparql_canon.structmatch) over beam
+#                lists: those of a Test_* result file with --results, else
+#                a truncated gold query that does not parse followed by the
+#                gold query or another question's
+# Each reports examples/s, tokens/s, p50/p95 latency per call and the peak
+# RSS of the run so far; everything is saved as JSON, and --compare prints
+# the speed ratio against an earlier run.
+#
+#   python benchmark.py --samples 256 --generate_samples 32 --out bench_new.json --compare bench_old.json
+#
+# Models are randomly initialized from t5-small/bart-base shaped configs, and
+# tokenizers are a sentencepiece (T5) / byte-level BPE (BART) model trained on
+# the sample, so nothing is downloaded (--pretrained_tokenizer uses the hub
+# ones). Random weights rarely emit </s>, so generation mostly runs to
+# --max_length: the numbers bound real decoding from above.
+
+CONFIGS={
+    't5-small':dict(d_model=512,d_kv=64,d_ff=2048,num_layers=6,num_heads=8,vocab_size=32128),
+    't5-base':dict(d_model=768,d_kv=64,d_ff=3072,num_layers=12,num_heads=12,vocab_size=32128),
+    'bart-base':dict(d_model=768,encoder_layers=6,decoder_layers=6,encoder_attention_heads=12, \
+                     decoder_attention_heads=12,encoder_ffn_dim=3072,decoder_ffn_dim=3072,vocab_size=50265+61, \
+                     max_position_embeddings=1024),
+}
+
+parser=argparse.ArgumentParser()
+parser.add_argument('--data',type=str,default='test_new_mix.pickle')
+parser.add_argument('--raw',type=str,default='test_KG_4211.json')
+parser.add_argument('--labels',type=str,default='lcq2_labels.pickle')
+parser.add_argument('--vocab',type=str,default='vocab.txt')
+parser.add_argument('--samples',type=int,default=256)
+parser.add_argument('--generate_samples',type=int,default=32)
+parser.add_argument('--models',type=str,default='t5-small,bart-base')
+parser.add_argument('--beams',type=str,default='1,10')
+parser.add_argument('--batch_sizes',type=str,default='8')
+parser.add_argument('--max_length',type=int,default=100)
+parser.add_argument('--stages',type=str,default='preprocess,tokenize,generate,decode_ids,readable,score')
+parser.add_argument('--pretrained_tokenizer',action='store_true')
+parser.add_argument('--results',type=str,default=None)
+parser.add_argument('--threads',type=int,default=None)
+parser.add_argument('--warmup',type=int,default=1)
+parser.add_argument('--seed',type=int,default=0)
+parser.add_argument('--out',type=str,default=None)
+parser.add_argument('--compare',type=str,default=None)
+
+
+def family(model_name):
+    return 'bart' if 'bart' in model_name.lower() else 't5'
+
+
+def train_tokenizer(kind,texts,vocab,workdir,size=4000):
+    # a throwaway tokenizer over the sample; mask tokens are added as the
+    # trainers' tokenizers have them
+    texts=[re.sub(r'<extra_id_\d+>',' ',t) for t in texts]
+    if kind=='t5':
+        import sentencepiece as spm
+        from transformers import T5Tokenizer
+        prefix=os.path.join(workdir,'spiece')
+        spm.SentencePieceTrainer.train(sentence_iterator=iter(texts),model_prefix=prefix,vocab_size=size, \
+                                       pad_id=0,eos_id=1,unk_id=2,bos_id=-1,hard_vocab_limit=False, \
+                                       minloglevel=2)
+        if 'vocab_file' in inspect.signature(T5Tokenizer.__init__).parameters:
+            return T5Tokenizer(vocab_file=prefix+'.model')
+        # transformers 5: the pieces themselves
+        model=spm.SentencePieceProcessor(model_file=prefix+'.model')
+        return T5Tokenizer(vocab=[(model.id_to_piece(i),model.get_score(i)) for i in range(model.get_piece_size())])
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import BartTokenizer
+    bpe=ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts,vocab_size=size,special_tokens=['<s>','<pad>','</s>','<unk>','<mask>'])
+    bpe.save_model(workdir)
+    vocab_file,merges_file=os.path.join(workdir,'vocab.json'),os.path.join(workdir,'merges.txt')
+    if 'vocab_file' in inspect.signature(BartTokenizer.__init__).parameters:
+        tokenizer=BartTokenizer(vocab_file=vocab_file,merges_file=merges_file)
+    else:
+        # transformers 5: the vocab and merges themselves
+        file=open(merges_file,'r')
+        merges=[tuple(line.split()) for line in file if line.strip() and not line.startswith('#')]
+        file.close()
+        file=open(vocab_file,'r')
+        tokenizer=BartTokenizer(vocab=json.load(file),merges=merges)
+        file.close()
+    tokenizer.add_tokens(['<extra_id_'+str(i)+'>' for i in range(len(vocab))])
+    return tokenizer
+
+
+def random_model(model_name,tokenizer):
+    from transformers import AutoConfig, T5Config, BartConfig, AutoModelForSeq2SeqLM
+    ids=dict(pad_token_id=tokenizer.pad_token_id,eos_token_id=tokenizer.eos_token_id)
+    if model_name in CONFIGS and family(model_name)=='t5':
+        config=T5Config(decoder_start_token_id=tokenizer.pad_token_id,**ids,**CONFIGS[model_name])
+    elif model_name in CONFIGS:
+        config=BartConfig(bos_token_id=tokenizer.bos_token_id,decoder_start_token_id=tokenizer.eos_token_id, \
+                          forced_bos_token_id=None,forced_eos_token_id=None,**ids,**CONFIGS[model_name])
+    else:
+        config=AutoConfig.from_pretrained(model_name)
+    return AutoModelForSeq2SeqLM.from_config(config).eval()
+
+
+def generated_tokens(output,eos):
+    # decoding steps up to and including </s>, over every returned sequence
+    steps=output[:,1:]
+    ended=(steps==eos).any(1)
+    lengths=torch.where(ended,(steps==eos).int().argmax(1)+1,torch.full_like(ended,steps.shape[1],dtype=torch.long))
+    return int(lengths.sum())
+
+
+def peak_rss_mb():
+    return Engine('cpu').peak_memory()/2**20
+
+
+class Bench:
+    def __init__(self):
+        self.results=[]
+
+    def run(self,stage,config,items,fn,batch=1,warmup=0):
+        # fn(batch of items) -> tokens processed; latency is per call
+        batches=[items[i:i+batch] for i in range(0,len(items),batch)]
+        for b in batches[:warmup]:
+            fn(b)
+        times,tokens=[],0
+        for b in batches:
+            start=time.perf_counter()
+            tokens+=fn(b)
+            times.append(time.perf_counter()-start)
+        total=sum(times)
+        result={'stage':stage,'config':config,'examples':len(items),'calls':len(batches), \
+                'seconds':total,'examples_per_sec':len(items)/total if total else None, \
+                'tokens':tokens,'tokens_per_sec':tokens/total if total else None, \
+                'p50_ms':1000*float(np.percentile(times,50)),'p95_ms':1000*float(np.percentile(times,95)), \
+                'peak_rss_mb':peak_rss_mb()}
+        self.results.append(result)
+        print('{:<10} {:<40} {:>10.1f} {:>12.0f} {:>9.2f} {:>9.2f} {:>9.0f}'.format(stage,key_text(config), \
+              result['examples_per_sec'] or 0,result['tokens_per_sec'] or 0,result['p50_ms'],result['p95_ms'], \
+              result['peak_rss_mb']))
+        return result
+
+
+def key_text(config):
+    return ' '.join('{}={}'.format(k,v) for k,v in sorted(config.items()))
+
+
+def header():
+    print('{:<10} {:<40} {:>10} {:>12} {:>9} {:>9} {:>9}'.format('stage','config','ex/s','tokens/s','p50 ms', \
+          'p95 ms','peak MB'))
+
+
+def encode(tokenizer,inputs,targets):
+    # Test_T5/Test_BART preprocess_function
+    model_inputs=tokenizer(inputs,padding=True,return_tensors='pt',max_length=512,truncation=True)
+    labels=tokenizer(targets,padding=True,max_length=512,truncation=True)
+    labels['input_ids']=[[(l if l!=tokenizer.pad_token_id else -100) for l in label] for label in labels['input_ids']]
+    model_inputs['labels']=torch.tensor(labels['input_ids'])
+    return model_inputs
+
+
+def preprocess_items(path,labels_path,vocab,n,seed):
+    file=open(path,'r')
+    data=json.load(file)
+    file.close()
+    random.Random(seed).shuffle(data)
+    rewriter=Rewriter(vocab,{},{})
+    rewriter.labels=label_index.Defaulted(label_index.load(labels_path),rewriter.null)
+    return rewriter,data[:n]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True, \
+                              check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def compare(results,path):
+    file=open(path,'r')
+    old=json.load(file)
+    file.close()
+    before={(r['stage'],key_text(r['config'])):r for r in old['results']}
+    print('\nagainst {} ({})'.format(path,old.get('commit')))
+    print('{:<10} {:<40} {:>10} {:>10} {:>8}'.format('stage','config','old ex/s','new ex/s','speedup'))
+    for r in results:
+        o=before.get((r['stage'],key_text(r['config'])))
+        if o is None or not o['examples_per_sec'] or not r['examples_per_sec']:
+            continue
+        print('{:<10} {:<40} {:>10.1f} {:>10.1f} {:>7.2f}x'.format(r['stage'],key_text(r['config']), \
+              o['examples_per_sec'],r['examples_per_sec'],r['examples_per_sec']/o['examples_per_sec']))
+
+
+def main(args):
+    engine=Engine('cpu',args.threads)
+    torch.manual_seed(args.seed)
+    stages=set(args.stages.split(','))
+    vocab=load_vocab(args.vocab)
+    demasker=Demasker(vocab)
+    data=list(load(args.data))
+    random.Random(args.seed).shuffle(data)
+    sample=data[:args.samples]
+    inputs,targets=[d[0] for d in sample],[d[1] for d in sample]
+    bench=Bench()
+    print(engine.describe())
+    header()
+
+    if 'preprocess' in stages:
+        rewriter,raw=preprocess_items(args.raw,args.labels,vocab,args.samples,args.seed)
+
+        def preprocess(batch):
+            tokens=0
+            for inst in batch:
+                question=(inst['question'] or inst['NNQT_question']).replace('{','').replace('}','')
+                target,ents,_=rewriter.rewrite(inst['sparql_wikidata'])
+                tokens+=len(target.split())+len(rewriter.annotate(question,ents).split())
+            return tokens
+        bench.run('preprocess',{},raw,preprocess)
+
+    workdir=tempfile.mkdtemp(prefix='benchmark_')
+    tokenizers={}
+    for model_name in args.models.split(','):
+        kind=family(model_name)
+        if kind in tokenizers:
+            continue
+        if args.pretrained_tokenizer:
+            from token_dataset import load_tokenizer
+            tokenizers[kind]=load_tokenizer(model_name,vocab)
+        else:
+            os.makedirs(os.path.join(workdir,kind),exist_ok=True)
+            tokenizers[kind]=train_tokenizer(kind,inputs+targets,vocab,os.path.join(workdir,kind))
+
+    if 'tokenize' in stages:
+        for kind,tokenizer in tokenizers.items():
+            def tokenize(batch):
+                encoded=encode(tokenizer,[b[0] for b in batch],[b[1] for b in batch])
+                return int(encoded['attention_mask'].sum()+(encoded['labels']!=-100).sum())
+            bench.run('tokenize',{'tokenizer':kind},sample,tokenize,8)
+
+    if 'generate' in stages:
+        gen_inputs=inputs[:args.generate_samples]
+        for model_name in args.models.split(','):
+            tokenizer=tokenizers[family(model_name)]
+            model=random_model(model_name,tokenizer)
+            for beam in [int(b) for b in args.beams.split(',')]:
+                for bs in [int(b) for b in args.batch_sizes.split(',')]:
+                    def generate(batch):
+                        encoded=tokenizer(batch,padding=True,return_tensors='pt',max_length=512,truncation=True)
+                        with torch.no_grad():
+                            output=model.generate(input_ids=encoded['input_ids'],attention_mask=encoded['attention_mask'], \
+                                                  num_beams=beam,num_return_sequences=beam,early_stopping=beam>1, \
+                                                  max_length=args.max_length,do_sample=False)
+                        return generated_tokens(output,model.config.eos_token_id)
+                    bench.run('generate',{'model':model_name,'beam':beam,'eval_bs':bs},gen_inputs,generate,bs, \
+                              warmup=args.warmup)
+            del model
+
+    if 'decode_ids' in stages:
+        # the gold targets' token ids stand in for generated ones
+        for kind,tokenizer in tokenizers.items():
+            table=demasker.id_table(tokenizer)
+            ids=tokenizer(targets,max_length=512,truncation=True)['input_ids']
+
+            def decode_ids(batch):
+                return sum(len(s.split()) for s in demasker.decode_ids(batch,tokenizer,table))
+            bench.run('decode_ids',{'tokenizer':kind},ids,decode_ids,8)
+
+    if 'readable' in stages:
+        def readable(batch):
+            return sum(len(demasker.readable(t).split()) for t in batch)
+        bench.run('readable',{},targets,readable)
+
+    if 'score' in stages:
+        config={}
+        if args.results is not None:
+            # (gold, beams) of a *test_result.json
+            file=open(args.results,'r')
+            results=json.load(file)
+            file.close()
+            random.Random(args.seed).shuffle(results)
+            items=[(q['gold_sparql'],[v for k,v in q.items() if k.startswith('top_')][0]) for q in results[:args.samples]]
+            config['results']=os.path.basename(args.results)
+        else:
+            golds=[demasker.readable(t.strip()) for t in targets]
+            items=[]
+            for i,gold in enumerate(golds):
+                words=gold.split()
+                items.append((gold,[' '.join(words[:len(words)//2]),gold if i%2==0 else golds[(i+1)%len(golds)]]))
+
+        def score(batch):
+            tokens=0
+            for gold,beams in batch:
+                structmatch(gold,beams,demasker)
+                tokens+=len(gold.split())
+            return tokens
+        bench.run('score',config,items,score)
+
+    import transformers
+    return {'commit':git_commit(),'date':time.strftime('%Y-%m-%d %H:%M:%S'),'host':platform.node(), \
+            'python':platform.python_version(),'torch':torch.__version__,'transformers':transformers.__version__, \
+            'threads':engine.threads,'args':vars(args),'results':bench.results}
+
+
+if __name__=='__main__':
+    args=parser.parse_args()
+    report=main(args)
+    out=args.out or 'benchmark_{}.json'.format(report['commit'] or time.strftime('%Y%m%d_%H%M%S'))
+    file=open(out,'w')
+    json.dump(report,file,indent=1)
+    file.close()
+    print('saved to {}'.format(out))
+    if args.compare is not None:
+        compare(report['results'],args.compare)
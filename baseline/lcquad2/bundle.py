@@ -0,0 +1,81 @@
+import os
+import json
+import shutil
+import argparse
+
+# Self-contained inference bundles of fine-tuned checkpoints.
+#
+# A Train_T5/Train_BART checkpoint is a pickled DataParallel state dict on
+# top of a hub model: loading it builds the pretrained model (a hub lookup
+# and a full read of its weights) and then torch.loads every weight again.
+# A bundle directory holds config.json, the tokenizer files (with BART's
+# added mask tokens), vocab.txt, bundle.json and model.safetensors with the
+# fine-tuned weights under their plain HF names, so from_pretrained maps the
+# file and reads each weight once without touching the network.
+#
+#   python bundle.py T5_train_new_mix_checkpoint40000.pth --model_name t5-base --out t5-base-lcquad2
+#   python Test_T5.py --test_file test_new_mix.pickle --bundle t5-base-lcquad2
+#
+# Only os/json are imported here so scripts can check for a bundle before
+# paying for torch and transformers.
+
+MANIFEST='bundle.json'
+WEIGHTS='model.safetensors'
+VOCAB='vocab.txt'
+
+
+def is_bundle(path):
+    return path is not None and os.path.isfile(os.path.join(path,MANIFEST))
+
+
+def manifest(path):
+    file=open(os.path.join(path,MANIFEST),'r')
+    info=json.load(file)
+    file.close()
+    return info
+
+
+def vocab_path(path):
+    return os.path.join(path,VOCAB)
+
+
+def weights_path(path):
+    return os.path.join(path,WEIGHTS)
+
+
+def convert(checkpoint,model_name,out,vocab='vocab.txt'):
+    import torch
+    from transformers import AutoConfig, AutoModelForSeq2SeqLM
+    from token_dataset import load_tokenizer, vocab_hash
+    from sparql_rewriter import load_vocab
+    from generation_cache import file_hash
+    from cpu_backend import unwrap
+
+    tokenizer=load_tokenizer(model_name,load_vocab(vocab))
+    # the architecture only; every weight comes from the checkpoint
+    model=AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(model_name))
+    if 'bart' in model_name.lower():
+        model.resize_token_embeddings(len(tokenizer))
+    model.load_state_dict(unwrap(torch.load(checkpoint,map_location='cpu')))
+
+    os.makedirs(out,exist_ok=True)
+    model.save_pretrained(out)
+    tokenizer.save_pretrained(out)
+    shutil.copyfile(vocab,vocab_path(out))
+    file=open(os.path.join(out,MANIFEST),'w')
+    json.dump({'model_name':model_name,'checkpoint':os.path.basename(checkpoint), \
+               'checkpoint_sha1':file_hash(checkpoint),'vocab_sha1':vocab_hash(vocab)},file,indent=1)
+    file.close()
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('checkpoint',type=str)
+    parser.add_argument('--model_name',type=str,default='t5-base')
+    parser.add_argument('--out',type=str,required=True)
+    parser.add_argument('--vocab',type=str,default='vocab.txt')
+    args=parser.parse_args()
+
+    convert(args.checkpoint,args.model_name,args.out,args.vocab)
+    size=sum(os.path.getsize(os.path.join(args.out,f)) for f in os.listdir(args.out))
+    print('{}: {:.0f} MB'.format(args.out,size/2**20))
@@ -0,0 +1,254 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Int8 and ONNX Runtime backends for CPU inference of T5 checkpoints.
+#
+# export_model.py turns a Train_T5 checkpoint into an export directory:
+#   model.int8.pth               state dict of the model after torch dynamic
+#                                int8 quantization of every nn.Linear
+#   encoder.onnx, decoder.onnx   the encoder, which also returns each decoder
+#                                layer's cross-attention keys/values, and one
+#                                decoder step over a self-attention KV cache
+#   encoder.int8.onnx, ...       the same graphs with int8 weights
+# OnnxSeq2Seq runs beam search over the two ONNX Runtime sessions and takes
+# the arguments and returns the sequences model.generate does, so the test
+# scripts and inference.Generator call either one the same way.
+
+BACKENDS=('torch','int8','onnx','onnx-int8')
+INT8_STATE='model.int8.pth'
+
+
+def add_arguments(parser):
+    parser.add_argument('--backend',type=str,default='torch',choices=BACKENDS)
+    parser.add_argument('--export_dir',type=str,default=None)
+
+
+def unwrap(state_dict):
+    # Train_* checkpoints: DataParallel('module.') around a Model('model.')
+    prefix='module.model.'
+    return {k[len(prefix):] if k.startswith(prefix) else k:v for k,v in state_dict.items()}
+
+
+def quantize(model):
+    # int8 weights, activations quantized per batch at run time
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(),{nn.Linear},dtype=torch.qint8)
+
+
+def load_int8(model,path):
+    # model: the fp32 architecture the state dict was quantized from
+    model=quantize(model)
+    model.load_state_dict(torch.load(path,map_location='cpu'))
+    return model
+
+
+def cross_attention(model):
+    return [block.layer[1].EncDecAttention for block in model.decoder.block]
+
+
+class EncoderExport(nn.Module):
+    def __init__(self,model):
+        super(EncoderExport,self).__init__()
+        self.model=model
+
+    def forward(self,input_ids,attention_mask):
+        hidden=self.model.encoder(input_ids=input_ids,attention_mask=attention_mask).last_hidden_state
+        cross=[]
+        for attn in cross_attention(self.model):
+            shape=(hidden.shape[0],-1,attn.n_heads,attn.key_value_proj_dim)
+            cross+=[attn.k(hidden).view(shape).transpose(1,2),attn.v(hidden).view(shape).transpose(1,2)]
+        return (hidden,)+tuple(cross)
+
+
+class DecoderExport(nn.Module):
+    # past: self key, self value, cross key, cross value of every layer
+    def __init__(self,model):
+        super(DecoderExport,self).__init__()
+        self.model=model
+
+    def forward(self,decoder_input_ids,encoder_attention_mask,encoder_hidden_states,past):
+        from transformers.cache_utils import DynamicCache, EncoderDecoderCache
+        self_cache,cross_cache=DynamicCache(),DynamicCache()
+        for i in range(len(past)//4):
+            self_cache.update(past[4*i],past[4*i+1],i)
+            cross_cache.update(past[4*i+2],past[4*i+3],i)
+        out=self.model(encoder_outputs=(encoder_hidden_states,),attention_mask=encoder_attention_mask, \
+                       decoder_input_ids=decoder_input_ids,past_key_values=EncoderDecoderCache(self_cache,cross_cache), \
+                       use_cache=True)
+        present=[]
+        for layer in out.past_key_values.self_attention_cache.layers:
+            present+=[layer.keys,layer.values]
+        return (out.logits[:,-1],)+tuple(present)
+
+
+def encoder_names(layers):
+    return ['input_ids','attention_mask'],['hidden']+['cross_{}_{}'.format(i,n) for i in range(layers) for n in ('key','value')]
+
+
+def decoder_names(layers):
+    past=[]
+    for i in range(layers):
+        past+=['past_{}_key'.format(i),'past_{}_value'.format(i),'cross_{}_key'.format(i),'cross_{}_value'.format(i)]
+    present=['present_{}_{}'.format(i,n) for i in range(layers) for n in ('key','value')]
+    return ['decoder_input_ids','encoder_attention_mask','encoder_hidden_states']+past,['logits']+present
+
+
+def export_onnx(model,out,opset=18):
+    # torch.export keeps batch, input and cache lengths symbolic (the
+    # TorchScript exporter bakes T5's position bias and masks into constants)
+    model=model.cpu().eval()
+    layers=len(model.decoder.block)
+    batch,length,past_length=torch.export.Dim('batch'),torch.export.Dim('length'),torch.export.Dim('past_length')
+    input_ids=torch.full((2,7),5,dtype=torch.long)
+    attention_mask=torch.ones_like(input_ids)
+    attention_mask[1,4:]=0
+    with torch.no_grad():
+        encoded=EncoderExport(model)(input_ids,attention_mask)
+        inputs,outputs=encoder_names(layers)
+        torch.onnx.export(EncoderExport(model),(input_ids,attention_mask),os.path.join(out,'encoder.onnx'), \
+                          input_names=inputs,output_names=outputs,opset_version=opset,dynamo=True, \
+                          dynamic_shapes=({0:batch,1:length},{0:batch,1:length}))
+
+        hidden,cross=encoded[0],encoded[1:]
+        attn=cross_attention(model)[0]
+        step=torch.full((2,3),model.config.decoder_start_token_id,dtype=torch.long)
+        empty=hidden.new_zeros(2,attn.n_heads,0,attn.key_value_proj_dim)
+        past=[]
+        for i in range(layers):
+            past+=[empty,empty,cross[2*i],cross[2*i+1]]
+        present=DecoderExport(model)(step,attention_mask,hidden,past)[1:]
+        past=[]
+        for i in range(layers):
+            past+=[present[2*i],present[2*i+1],cross[2*i],cross[2*i+1]]
+        shapes=[]
+        for i in range(layers):
+            shapes+=[{0:batch,2:past_length},{0:batch,2:past_length},{0:batch,2:length},{0:batch,2:length}]
+        inputs,outputs=decoder_names(layers)
+        torch.onnx.export(DecoderExport(model),(step[:,:1],attention_mask,hidden,past),os.path.join(out,'decoder.onnx'), \
+                          input_names=inputs,output_names=outputs,opset_version=opset,dynamo=True, \
+                          dynamic_shapes=({0:batch},{0:batch,1:length},{0:batch,1:length},shapes))
+
+
+def quantize_onnx(out):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    for name in ('encoder','decoder'):
+        quantize_dynamic(os.path.join(out,name+'.onnx'),os.path.join(out,name+'.int8.onnx'),weight_type=QuantType.QInt8)
+
+
+class OnnxSeq2Seq(nn.Module):
+    def __init__(self,export_dir,int8=False,threads=None):
+        super(OnnxSeq2Seq,self).__init__()
+        import onnxruntime as ort
+        file=open(os.path.join(export_dir,'meta.json'),'r')
+        self.meta=json.load(file)
+        file.close()
+        options=ort.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads=threads
+        suffix='.int8.onnx' if int8 else '.onnx'
+        self.encoder=ort.InferenceSession(os.path.join(export_dir,'encoder'+suffix),options,providers=['CPUExecutionProvider'])
+        self.decoder=ort.InferenceSession(os.path.join(export_dir,'decoder'+suffix),options,providers=['CPUExecutionProvider'])
+        # inputs the exporter found unused are dropped from the graph
+        self.decoder_inputs=set(i.name for i in self.decoder.get_inputs())
+        self.layers=self.meta['layers']
+        self.start=self.meta['decoder_start_token_id']
+        self.eos=self.meta['eos_token_id']
+        self.pad=self.meta['pad_token_id']
+
+    def step(self,tokens,mask,hidden,past,cross):
+        feed={'decoder_input_ids':tokens,'encoder_attention_mask':mask,'encoder_hidden_states':hidden}
+        for i in range(self.layers):
+            feed['past_{}_key'.format(i)],feed['past_{}_value'.format(i)]=past[2*i],past[2*i+1]
+            feed['cross_{}_key'.format(i)],feed['cross_{}_value'.format(i)]=cross[2*i],cross[2*i+1]
+        out=self.decoder.run(None,{k:v for k,v in feed.items() if k in self.decoder_inputs})
+        return torch.from_numpy(out[0]).float(),out[1:]
+
+    def generate(self,input_ids,attention_mask,num_beams=1,num_return_sequences=1,max_length=100, \
+                 early_stopping=True,logits_processor=None,length_penalty=1.0,**kwargs):
+        # beam search as model.generate: log-probabilities through the logits
+        # processors, the 2*num_beams best continuations per input, finished
+        # hypotheses scored by sum of log-probs / generated length
+        batch,beam=input_ids.shape[0],num_beams
+        mask=attention_mask.cpu().numpy().astype(np.int64)
+        encoded=self.encoder.run(None,{'input_ids':input_ids.cpu().numpy().astype(np.int64),'attention_mask':mask})
+        hidden=np.repeat(encoded[0],beam,axis=0)
+        cross=[np.repeat(c,beam,axis=0) for c in encoded[1:]]
+        mask=np.repeat(mask,beam,axis=0)
+        empty=np.zeros((batch*beam,cross[0].shape[1],0,cross[0].shape[3]),dtype=cross[0].dtype)
+        past=[empty]*(2*self.layers)
+
+        seqs=torch.full((batch*beam,1),self.start,dtype=torch.long)
+        scores=torch.zeros(batch,beam)
+        scores[:,1:]=float('-inf')
+        hyps=[[] for _ in range(batch)]
+        done=[False]*batch
+        for length in range(1,max_length):
+            logits,past=self.step(seqs[:,-1:].numpy(),mask,hidden,past,cross)
+            logp=torch.log_softmax(logits,dim=-1)
+            if logits_processor is not None:
+                logp=logits_processor(seqs,logp)
+            vocab=logp.shape[-1]
+            top,idx=(scores.view(-1,1)+logp).view(batch,beam*vocab).topk(2*beam,dim=1)
+            top,idx=top.tolist(),idx.tolist()
+            next_scores=torch.zeros(batch,beam)
+            next_tokens=torch.full((batch,beam),self.pad,dtype=torch.long)
+            origins=torch.arange(batch*beam).view(batch,beam)
+            for b in range(batch):
+                if done[b]:
+                    continue
+                n=0
+                for rank in range(2*beam):
+                    score,token,origin=top[b][rank],idx[b][rank]%vocab,idx[b][rank]//vocab
+                    if score==float('-inf'):
+                        break
+                    if token==self.eos:
+                        if rank<beam:
+                            hyps[b].append((score/length**length_penalty,seqs[b*beam+origin].tolist()+[token]))
+                        continue
+                    next_scores[b,n],next_tokens[b,n],origins[b,n]=score,token,b*beam+origin
+                    n+=1
+                    if n==beam:
+                        break
+                if n<beam:
+                    next_scores[b,n:]=float('-inf')
+                hyps[b].sort(key=lambda h:-h[0])
+                del hyps[b][beam:]
+                if len(hyps[b])==beam and (early_stopping or hyps[b][-1][0]>=next_scores[b].max().item()/length**length_penalty):
+                    done[b]=True
+            if all(done):
+                break
+            order=origins.view(-1)
+            seqs=torch.cat([seqs[order],next_tokens.view(-1,1)],dim=1)
+            scores=next_scores
+            past=[p[order.numpy()] for p in past]
+        for b in range(batch):
+            if not done[b]:
+                for k in range(beam):
+                    if scores[b,k]>float('-inf'):
+                        hyps[b].append((scores[b,k].item()/(seqs.shape[1]-1)**length_penalty,seqs[b*beam+k].tolist()))
+                hyps[b].sort(key=lambda h:-h[0])
+
+        # num_return_sequences rows per input, as model.generate returns, even
+        # when the processors left fewer beams alive; the rest are empty
+        out=[]
+        for b in range(batch):
+            rows=[h[1] for h in hyps[b][:num_return_sequences]]
+            out.extend(rows+[[self.start,self.eos]]*(num_return_sequences-len(rows)))
+        width=max(len(s) for s in out)
+        return torch.tensor([s+[self.pad]*(width-len(s)) for s in out],dtype=torch.long)
+
+
+def prepare(model,backend,export_dir=None,threads=None):
+    # the object to call generate on in place of the loaded fp32 model
+    if backend=='int8':
+        if export_dir is not None:
+            return load_int8(model,os.path.join(export_dir,INT8_STATE))
+        return quantize(model)
+    if backend in ('onnx','onnx-int8'):
+        if export_dir is None:
+            raise ValueError('--backend {} needs --export_dir from export_model.py'.format(backend))
+        return OnnxSeq2Seq(export_dir,backend=='onnx-int8',threads)
+    return model
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import zlib
+import pickle
+import argparse
+
+import numpy as np
+
+import label_index
+from sparql_rewriter import Rewriter, load_vocab
+from lexical_linker import terms, gold_links, question_text, record
+from link_recall import scores
+
+# Dense relation (and optionally entity) retrieval for the [DEF] annotations.
+#
+# build encodes every relations.json label once into an L2-normalized float32
+# matrix kept on disk next to its ids; link encodes the questions in batches
+# and takes the top k by inner product, over the whole matrix or, with
+# --nlist, over the --nprobe nearest of nlist k-means cells (IVF).
+#
+#   python dense_linker.py build --out dense_index --train train.json
+#   python dense_linker.py link --index dense_index --data test.json --k 10 --out test_dense_mix.pickle
+#
+# Encoders: 'hash' (default) signs and hashes character 3-5 grams of the
+# content words into --dim buckets and needs no model; any other value is a
+# hub model or bundle.py directory whose encoder outputs are mean pooled.
+# --train adds to each relation's vector the centroid of the training
+# questions that use it, which is what lifts recall past the label text.
+#
+# link writes [input, target] pairs as preprocess.py does, with the gold
+# entity annotations (--entities: retrieved ones) and the retrieved
+# relations in place of the gold ones, and prints recall/all-present at
+# k=1/5/10 as link_recall.py computes them for the README table (per
+# question, 1 for a question without gold ids). --links also writes the
+# link JSON of lexical_linker.py.
+
+KS=(1,5,10)
+
+
+class HashEncoder:
+    def __init__(self,dim=1024,sizes=(3,4,5)):
+        self.dim=dim
+        self.sizes=sizes
+
+    def describe(self):
+        return {'encoder':'hash','dim':self.dim,'sizes':list(self.sizes)}
+
+    def encode(self,texts,batch=None):
+        out=np.zeros((len(texts),self.dim),dtype=np.float32)
+        for row,text in enumerate(texts):
+            for word in terms(text):
+                word=' '+word+' '
+                grams=[word[i:i+n] for n in self.sizes for i in range(max(len(word)-n+1,1))]
+                for gram in grams:
+                    h=zlib.crc32(gram.encode('utf-8'))
+                    out[row,h%self.dim]+=1.0 if h&0x80000000 else -1.0
+        return normalize(out)
+
+
+class TransformerEncoder:
+    def __init__(self,model_name,device='cpu'):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+        self.torch=torch
+        self.model_name=model_name
+        self.device=device
+        self.tokenizer=AutoTokenizer.from_pretrained(model_name)
+        model=AutoModel.from_pretrained(model_name)
+        # seq2seq models: the encoder stack only
+        self.model=(model.get_encoder() if hasattr(model,'get_encoder') else model).to(device).eval()
+
+    def describe(self):
+        return {'encoder':self.model_name}
+
+    def encode(self,texts,batch=64):
+        out=[]
+        for i in range(0,len(texts),batch):
+            encoded=self.tokenizer(texts[i:i+batch],padding=True,truncation=True,max_length=64,return_tensors='pt')
+            encoded={k:v.to(self.device) for k,v in encoded.items() if k in ('input_ids','attention_mask')}
+            with self.torch.no_grad():
+                hidden=self.model(**encoded).last_hidden_state
+            mask=encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            out.append(((hidden*mask).sum(1)/mask.sum(1)).float().cpu().numpy())
+        return normalize(np.concatenate(out) if out else np.zeros((0,1),dtype=np.float32))
+
+
+def make_encoder(spec,dim=1024,device='cpu'):
+    if spec=='hash':
+        return HashEncoder(dim)
+    return TransformerEncoder(spec,device)
+
+
+def encoder_from(meta,device='cpu'):
+    if meta['encoder']=='hash':
+        return HashEncoder(meta['dim'],tuple(meta['sizes']))
+    return TransformerEncoder(meta['encoder'],device)
+
+
+def normalize(x):
+    return x/np.maximum(np.linalg.norm(x,axis=1,keepdims=True),1e-8)
+
+
+def kmeans(x,nlist,iterations=10,seed=0):
+    rng=np.random.default_rng(seed)
+    centroids=x[rng.choice(len(x),nlist,replace=False)].copy()
+    for _ in range(iterations):
+        assign=np.argmax(x@centroids.T,axis=1)
+        for c in range(nlist):
+            members=x[assign==c]
+            if len(members):
+                centroids[c]=members.mean(0)
+        centroids=normalize(centroids)
+    return centroids,np.argmax(x@centroids.T,axis=1)
+
+
+class DenseIndex:
+    # name.npy: vectors, name_ids.npy/name_labels.npy: unicode arrays; with
+    # nlist the rows are grouped by k-means cell, name_centroids.npy and
+    # name_offsets.npy (cell c is rows offsets[c]:offsets[c+1])
+    def __init__(self,path,name):
+        load=lambda suffix:np.load(os.path.join(path,name+suffix+'.npy'),mmap_mode='r')
+        self.vectors=np.asarray(load(''))
+        self.ids=load('_ids')
+        self.labels=load('_labels')
+        self.rows={str(ident):j for j,ident in enumerate(self.ids)}
+        self.centroids=None
+        if os.path.exists(os.path.join(path,name+'_centroids.npy')):
+            self.centroids=np.asarray(load('_centroids'))
+            self.offsets=np.asarray(load('_offsets'))
+
+    @staticmethod
+    def build(path,name,ids,labels,vectors,nlist=0):
+        ids,labels=np.array(ids),np.array([l or '' for l in labels])
+        if nlist>0:
+            centroids,assign=kmeans(vectors,min(nlist,len(vectors)))
+            order=np.argsort(assign,kind='stable')
+            ids,labels,vectors=ids[order],labels[order],vectors[order]
+            offsets=np.zeros(len(centroids)+1,dtype=np.int64)
+            offsets[1:]=np.cumsum(np.bincount(assign,minlength=len(centroids)))
+            np.save(os.path.join(path,name+'_centroids.npy'),centroids.astype(np.float32))
+            np.save(os.path.join(path,name+'_offsets.npy'),offsets)
+        np.save(os.path.join(path,name+'.npy'),vectors.astype(np.float32))
+        np.save(os.path.join(path,name+'_ids.npy'),ids)
+        np.save(os.path.join(path,name+'_labels.npy'),labels)
+
+    def label(self,ident):
+        j=self.rows.get(ident)
+        return '' if j is None else str(self.labels[j])
+
+    def search(self,queries,k,nprobe=8):
+        # (rows, scores), each (len(queries), k), best first
+        k=min(k,len(self.vectors))
+        if self.centroids is None:
+            return best(queries@self.vectors.T,np.arange(len(self.vectors))[None,:],k)
+        nprobe=min(nprobe,len(self.centroids))
+        cells=np.argsort(-(queries@self.centroids.T),axis=1)[:,:nprobe]
+        rows=np.zeros((len(queries),nprobe,k),dtype=np.int64)
+        scores=np.full((len(queries),nprobe,k),-np.inf,dtype=np.float32)
+        # one matmul per probed cell over all the queries probing it
+        for c in np.unique(cells):
+            q,p=np.nonzero(cells==c)
+            start,end=self.offsets[c],self.offsets[c+1]
+            if end==start:
+                continue
+            n=min(k,end-start)
+            rows[q,p,:n],scores[q,p,:n]=best(queries[q]@self.vectors[start:end].T,np.arange(start,end)[None,:],n)
+        return best(scores.reshape(len(queries),-1),rows.reshape(len(queries),-1),k)
+
+
+def best(scores,rows,k):
+    # top k of each row of scores, and the matching entries of rows
+    top=np.argpartition(-scores,k-1,axis=1)[:,:k]
+    top_scores=np.take_along_axis(scores,top,1)
+    ranked=np.argsort(-top_scores,axis=1,kind='stable')
+    top=np.take_along_axis(top,ranked,1)
+    rows=np.broadcast_to(rows,scores.shape)
+    return np.take_along_axis(rows,top,1),np.take_along_axis(top_scores,ranked,1)
+
+
+def prototypes(encoder,ids,data,batch=256):
+    # centroid of the training questions that use each relation
+    position={ident:j for j,ident in enumerate(ids)}
+    questions=[question_text(inst) for inst in data]
+    vectors=encoder.encode(questions,batch)
+    sums=np.zeros((len(ids),vectors.shape[1]),dtype=np.float32)
+    for vector,inst in zip(vectors,data):
+        for ident in set(ident for _,ident in gold_links(inst['sparql_wikidata'])[1]):
+            if ident in position:
+                sums[position[ident]]+=vector
+    return normalize(sums)
+
+
+def build(args):
+    os.makedirs(args.out,exist_ok=True)
+    encoder=make_encoder(args.encoder,args.dim,args.device)
+    relations=label_index.load(args.relations)
+    ids=[k for k in relations if k[:1]=='P']
+    labels=[relations[k] for k in ids]
+    vectors=encoder.encode([l or '' for l in labels],args.batch)
+    if args.train is not None:
+        file=open(args.train,'r')
+        data=json.load(file)
+        file.close()
+        vectors=normalize(vectors+args.prototype_weight*prototypes(encoder,ids,data,args.batch))
+    DenseIndex.build(args.out,'relations',ids,labels,vectors,args.nlist)
+    meta=dict(encoder.describe(),relations=len(ids),train=args.train,nlist=args.nlist,entities=0)
+    if args.entities:
+        labels=label_index.load(args.labels)
+        ids=[k for k in labels if isinstance(k,str) and k[:1]=='q' and k[1:].isdigit()]
+        names=[labels[k] for k in ids]
+        DenseIndex.build(args.out,'entities',[k.upper() for k in ids],names, \
+                         encoder.encode([n or '' for n in names],args.batch),args.nlist)
+        meta['entities']=len(ids)
+    file=open(os.path.join(args.out,'meta.json'),'w')
+    json.dump(meta,file,indent=1)
+    file.close()
+    return meta
+
+
+def link(args):
+    file=open(os.path.join(args.index,'meta.json'),'r')
+    meta=json.load(file)
+    file.close()
+    encoder=encoder_from(meta,args.device)
+    relations=DenseIndex(args.index,'relations')
+    entities=DenseIndex(args.index,'entities') if args.entities else None
+    file=open(args.data,'r')
+    data=json.load(file)
+    file.close()
+
+    vocab=load_vocab(args.vocab)
+    rewriter=Rewriter(vocab,{},{})
+    rewriter.labels=label_index.Defaulted(label_index.load(args.labels),rewriter.null)
+    masks=rewriter.vocab_dict
+
+    questions=[question_text(inst) for inst in data]
+    k=max(args.k,max(KS))
+    start=time.perf_counter()
+    found_rels,found_ents=[],[]
+    for i in range(0,len(questions),args.batch):
+        queries=encoder.encode(questions[i:i+args.batch],args.batch)
+        rows,_=relations.search(queries,k,args.nprobe)
+        found_rels+=[[str(relations.ids[r]) for r in row] for row in rows]
+        if entities is not None:
+            rows,_=entities.search(queries,k,args.nprobe)
+            found_ents+=[[str(entities.ids[r]) for r in row] for row in rows]
+    elapsed=time.perf_counter()-start
+
+    pairs,links=[],[]
+    gold_rels,gold_ents=[],[]
+    for j,inst in enumerate(data):
+        sparql=inst['sparql_wikidata']
+        want_ents,want_rels=gold_links(sparql)
+        gold_rels.append(set(ident for _,ident in want_rels))
+        gold_ents.append(set(ident for _,ident in want_ents))
+        target,annotations,_=rewriter.rewrite(sparql)
+        # keep the gold entity annotations, drop the gold relation ones
+        annotations=[a for a in annotations if a.startswith(masks['wd:'])]
+        ents=[]
+        if entities is not None:
+            ents=[(ident,entities.label(ident)) for ident in found_ents[j][:args.k]]
+            annotations=[rewriter.annotation('wd:',ident,label or None) for ident,label in ents]
+        rels=found_rels[j][:args.k]
+        # relations.json is keyed 'P123', so these are null labelled as in
+        # preprocess.py
+        annotations+=[rewriter.annotation('wdt:',ident,rewriter.rel_labels.get(ident.lower())) for ident in rels]
+        pairs.append([rewriter.annotate(questions[j],annotations),target])
+        if args.links is not None:
+            links.append(record(questions[j],ents,[('wdt:',ident,relations.label(ident)) for ident in rels],target,masks))
+
+    file=open(args.out,'wb')
+    pickle.dump(pairs,file)
+    file.close()
+    if args.links is not None:
+        file=open(args.links,'w')
+        json.dump(links,file)
+        file.close()
+
+    print('{}: {} questions, retrieval {:.2f} s ({:.0f}/s)'.format(args.out,len(pairs),elapsed,len(pairs)/elapsed))
+    report=[('relations',scores(found_rels,gold_rels,KS))]
+    if entities is not None:
+        report.append(('entities',scores(found_ents,gold_ents,KS)))
+    for name,result in report:
+        print('{:<10} {:>6} {:>8} {:>12}'.format(name,'k','recall','all present'))
+        for k,(r,present) in result.items():
+            print('{:<10} {:>6} {:>8.3f} {:>12.3f}'.format('',k,r,present))
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('command',choices=['build','link'])
+    parser.add_argument('--out',type=str,required=True)
+    parser.add_argument('--relations',type=str,default='relations.json')
+    parser.add_argument('--labels',type=str,default='lcq2_labels.pickle')
+    parser.add_argument('--entities',action='store_true')
+    parser.add_argument('--encoder',type=str,default='hash')
+    parser.add_argument('--dim',type=int,default=1024)
+    parser.add_argument('--train',type=str,default=None)
+    parser.add_argument('--prototype_weight',type=float,default=1.0)
+    parser.add_argument('--nlist',type=int,default=0)
+    parser.add_argument('--nprobe',type=int,default=8)
+    parser.add_argument('--index',type=str,default='dense_index')
+    parser.add_argument('--data',type=str,default=None)
+    parser.add_argument('--links',type=str,default=None)
+    parser.add_argument('--k',type=int,default=10)
+    parser.add_argument('--batch',type=int,default=256)
+    parser.add_argument('--device',type=str,default='cpu')
+    parser.add_argument('--vocab',type=str,default='vocab.txt')
+    args=parser.parse_args()
+
+    if args.command=='build':
+        meta=build(args)
+        print('{}: {} relations, {} entities ({})'.format(args.out,meta['relations'],meta['entities'],meta['encoder']))
+    else:
+        if args.data is None:
+            parser.error('link needs --data')
+        link(args)
@@ -0,0 +1,100 @@
+import resource
+import contextlib
+
+import torch
+import torch.nn as nn
+
+# Device/precision handling shared by the train and test scripts.
+#
+# --device takes 'auto' (first GPU if there is one, else CPU), 'cpu', a
+# torch device string such as 'cuda:1' or 'mps', or a bare GPU index as the
+# scripts used to. Models are wrapped in nn.DataParallel on GPUs and in an
+# equivalent pass-through elsewhere, so checkpoints keep their 'module.'
+# prefixes and load on any device.
+
+
+def add_arguments(parser):
+    parser.add_argument('--device',type=str,default='auto')
+    parser.add_argument('--threads',type=int,default=None)
+    parser.add_argument('--bf16',action='store_true')
+
+
+def resolve_device(device):
+    device=str(device)
+    if device=='auto':
+        if torch.cuda.is_available():
+            return torch.device('cuda:0')
+        return torch.device('cpu')
+    if device.isdigit():
+        return torch.device('cuda:'+device)
+    return torch.device(device)
+
+
+class Single(nn.Module):
+    def __init__(self,module):
+        super(Single,self).__init__()
+        self.module=module
+
+    def forward(self,*inputs,**kwargs):
+        return self.module(*inputs,**kwargs)
+
+
+class Engine:
+    def __init__(self,device='auto',threads=None,bf16=False):
+        self.device=resolve_device(device)
+        self.bf16=bf16
+        if self.device.type=='cpu':
+            # intra-op parallelism; torch defaults to the physical core count
+            if threads is not None:
+                torch.set_num_threads(threads)
+            self.threads=torch.get_num_threads()
+        else:
+            self.threads=None
+
+    @classmethod
+    def from_args(cls,args):
+        return cls(args.device,args.threads,args.bf16)
+
+    def wrap(self,module):
+        if self.device.type=='cuda':
+            model=nn.DataParallel(module,device_ids=[self.device.index or 0])
+        else:
+            model=Single(module)
+        model.to(self.device)
+        return model
+
+    def to(self,model_inputs):
+        for key in model_inputs:
+            model_inputs[key]=model_inputs[key].to(self.device)
+        return model_inputs
+
+    def load(self,path):
+        return torch.load(path,map_location=self.device)
+
+    def autocast(self):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type,dtype=torch.bfloat16)
+
+    def reset_peak_memory(self):
+        if self.device.type=='cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def peak_memory(self):
+        # bytes; device allocator peak on GPUs, process peak RSS on CPU
+        # (which cannot be reset, so it is the high-water mark of the run)
+        if self.device.type=='cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+    def memory_report(self,stage):
+        kind='allocated' if self.device.type=='cuda' else 'rss'
+        return 'peak memory ({}, {})={:.1f} MiB'.format(stage,kind,self.peak_memory()/2**20)
+
+    def describe(self):
+        text='device={}'.format(self.device)
+        if self.threads is not None:
+            text+=', threads={}'.format(self.threads)
+        if self.bf16:
+            text+=', bf16 autocast'
+        return text
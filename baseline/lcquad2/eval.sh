@@ -10,11 +10,37 @@ echo "Testing BART base on LCQUAD 2.0"
 python3 Test_BART.py --test_file test_new_mix.pickle --model_name facebook/bart-base --checkpoint BART_train_new_mix_checkpoint40000.pth --beam_length 10
 
 echo "Calculate F1 for T5 base on LCQUAD 2.0"
-python3 get_F1.py --test_file T5_mix_test_result.json > T5_mix_test.txt
+python3 get_F1.py --test_file T5_mix_test_result.json --workers 16 --cache sparql_cache.sqlite > T5_mix_test.txt
 
 echo "Calculate F1 for T5 small on LCQUAD 2.0"
-python3 get_F1.py --test_file small_mix_test_result.json > small_mix_test.txt
+python3 get_F1.py --test_file small_mix_test_result.json --workers 16 --cache sparql_cache.sqlite > small_mix_test.txt
 
 echo "Calculate F1 for BART base on LCQUAD 2.0"
-python3 get_F1.py --test_file BART_mix_test_result.json > BART_mix_test.txt
+python3 get_F1.py --test_file BART_mix_test_result.json --workers 16 --cache sparql_cache.sqlite > BART_mix_test.txt
 
+
+# Offline scoring against a local subgraph instead of the Virtuoso endpoint
+# python3 triple_store.py --build --ntriples latest-truthy.nt.gz --out kg --relevant test_KG_4211.json
+# python3 get_F1.py --test_file T5_mix_test_result.json --workers 16 --kg kg > T5_mix_test.txt
+
+# Endpoint-free proxy: structural match of the first parseable prediction
+# python3 get_F1.py --test_file T5_mix_test_result.json --structural > T5_mix_test_structural.txt
+
+# Grammar-constrained beams (invalid SPARQL pruned while decoding)
+# python3 Test_T5.py --test_file test_new_mix.pickle --model_name t5-base --checkpoint T5_train_new_mix_checkpoint40000.pth --beam_length 10 --constrained
+
+# CPU inference: int8 / ONNX export of a checkpoint, the backend comparison, and a test run on it
+# python3 export_model.py T5_train_new_mix_checkpoint40000.pth --model_name t5-base --out t5-base-cpu --int8 --onnx --benchmark test_new_mix.pickle --samples 200
+# python3 Test_T5.py --test_file test_new_mix.pickle --model_name t5-base --checkpoint T5_train_new_mix_checkpoint40000.pth --beam_length 10 --backend int8 --export_dir t5-base-cpu
+
+# Self-contained safetensors bundle (config, tokenizer, vocab.txt, weights), loaded without the hub model
+# python3 bundle.py T5_train_new_mix_checkpoint40000.pth --model_name t5-base --out t5-base-lcquad2
+# python3 Test_T5.py --test_file test_new_mix.pickle --bundle t5-base-lcquad2 --beam_length 10
+
+# CPU throughput/latency of every stage with random t5-small/bart-base weights (no downloads);
+# compare against the JSON of an earlier commit
+# python3 benchmark.py --samples 256 --generate_samples 32 --beams 1,10 --batch_sizes 8,32 --compare benchmark_<commit>.json
+
+# Test set split over 16 worker processes (CPU: cores/16 threads each), results written per shard as they come;
+# rerunning the same command resumes unfinished shards, then merges them into T5_mix_test_result.json
+# python3 Test_T5.py --test_file test_new_mix.pickle --model_name t5-base --checkpoint T5_train_new_mix_checkpoint40000.pth --beam_length 10 --device cpu --shards 16
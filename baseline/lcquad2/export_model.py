@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import argparse
+
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+import bundle
+from cpu_backend import unwrap, quantize, export_onnx, quantize_onnx, prepare, INT8_STATE
+from token_dataset import load, load_tokenizer
+from sparql_rewriter import load_vocab
+from sparql_decoder import Demasker
+from sparql_canon import canonical
+
+# Export a Train_T5 checkpoint for CPU inference and compare the backends.
+#
+#   python export_model.py T5_train_new_mix_checkpoint40000.pth --model_name t5-base --out t5-base-cpu --int8 --onnx
+#   python export_model.py T5_train_new_mix_checkpoint40000.pth --model_name t5-base --out t5-base-cpu \
+#                          --benchmark test_new_mix.pickle --samples 200
+#
+# The checkpoint can also be a bundle.py directory.
+#
+# The benchmark decodes the same questions with every backend found in --out
+# and reports latency per question, top-1 accuracy against the gold query
+# (structural match, see sparql_canon) and top-1 agreement with fp32.
+
+parser=argparse.ArgumentParser()
+parser.add_argument('checkpoint',type=str)
+parser.add_argument('--model_name',type=str,default='t5-base')
+parser.add_argument('--out',type=str,default='export')
+parser.add_argument('--int8',action='store_true')
+parser.add_argument('--onnx',action='store_true')
+parser.add_argument('--opset',type=int,default=18)
+parser.add_argument('--benchmark',type=str,default=None)
+parser.add_argument('--samples',type=int,default=200)
+parser.add_argument('--batch',type=int,default=8)
+parser.add_argument('--beam_length',type=int,default=10)
+parser.add_argument('--threads',type=int,default=None)
+parser.add_argument('--vocab',type=str,default='vocab.txt')
+
+
+def load_fp32(model_name,checkpoint,**kwargs):
+    if bundle.is_bundle(checkpoint):
+        return AutoModelForSeq2SeqLM.from_pretrained(checkpoint,**kwargs).eval()
+    model=AutoModelForSeq2SeqLM.from_pretrained(model_name,**kwargs)
+    model.load_state_dict(unwrap(torch.load(checkpoint,map_location='cpu')))
+    return model.eval()
+
+
+def size_mb(out,names):
+    # large graphs keep their weights in a .data file next to the .onnx
+    paths=[os.path.join(out,n) for n in names]+[os.path.join(out,n+'.data') for n in names]
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))/2**20
+
+
+def export(args):
+    os.makedirs(args.out,exist_ok=True)
+    # eager attention exports as MatMuls ONNX Runtime fuses; the SDPA
+    # decomposition transposes every layer's cross-attention keys each step
+    model=load_fp32(args.model_name,args.checkpoint,attn_implementation='eager')
+    config=model.config
+    meta={'model_name':args.model_name,'checkpoint':os.path.abspath(args.checkpoint), \
+          'layers':len(model.decoder.block),'decoder_start_token_id':config.decoder_start_token_id, \
+          'eos_token_id':config.eos_token_id,'pad_token_id':config.pad_token_id,'formats':[]}
+    if args.onnx:
+        start=time.perf_counter()
+        export_onnx(model,args.out,args.opset)
+        meta['formats'].append('onnx')
+        print('onnx: {:.0f} MB in {:.0f} s'.format(size_mb(args.out,['encoder.onnx','decoder.onnx']),time.perf_counter()-start))
+        if args.int8:
+            quantize_onnx(args.out)
+            meta['formats'].append('onnx-int8')
+            print('onnx int8: {:.0f} MB'.format(size_mb(args.out,['encoder.int8.onnx','decoder.int8.onnx'])))
+    if args.int8:
+        torch.save(quantize(model).state_dict(),os.path.join(args.out,INT8_STATE))
+        meta['formats'].append('int8')
+        print('int8: {:.0f} MB'.format(size_mb(args.out,[INT8_STATE])))
+    file=open(os.path.join(args.out,'meta.json'),'w')
+    json.dump(meta,file,indent=1)
+    file.close()
+
+
+def decode(model,tokenizer,demasker,table,inputs,beam,batch):
+    out,elapsed=[],0.0
+    for i in range(0,len(inputs),batch):
+        encoded=tokenizer(inputs[i:i+batch],padding=True,return_tensors='pt',max_length=512,truncation=True)
+        start=time.perf_counter()
+        with torch.no_grad():
+            output=model.generate(input_ids=encoded['input_ids'],attention_mask=encoded['attention_mask'], \
+                                  num_beams=beam,num_return_sequences=beam,early_stopping=True,max_length=100)
+        elapsed+=time.perf_counter()-start
+        texts=demasker.decode_ids(output,tokenizer,table)
+        out+=[texts[k*beam:(k+1)*beam] for k in range(len(texts)//beam)]
+    return out,elapsed
+
+
+def same(demasker,a,b):
+    ca,cb=canonical(demasker.executable(a)),canonical(demasker.executable(b))
+    if ca is not None and cb is not None:
+        return ca==cb
+    return a.replace(' ','')==b.replace(' ','')
+
+
+def benchmark(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    data=load(args.benchmark)
+    n=min(args.samples,len(data))
+    inputs=[data[j][0] for j in range(n)]
+    demasker=Demasker(load_vocab(args.vocab))
+    gold=[demasker.readable(data[j][1].strip()) for j in range(n)]
+    tokenizer=load_tokenizer(args.model_name,path=args.checkpoint if bundle.is_bundle(args.checkpoint) else None)
+    table=demasker.id_table(tokenizer)
+
+    file=open(os.path.join(args.out,'meta.json'),'r')
+    formats=json.load(file)['formats']
+    file.close()
+    reference=None
+    print('{:<10} {:>10} {:>10} {:>10} {:>12}'.format('backend','ms/quest','top-1 acc','agree','beam overlap'))
+    for backend in ['torch']+[f for f in ('int8','onnx','onnx-int8') if f in formats]:
+        model=load_fp32(args.model_name,args.checkpoint) if backend in ('torch','int8') else None
+        model=prepare(model,backend,args.out,args.threads)
+        out,elapsed=decode(model,tokenizer,demasker,table,inputs,args.beam_length,args.batch)
+        if reference is None:
+            reference=out
+        acc=sum(same(demasker,out[k][0],gold[k]) for k in range(n))
+        agree=sum(out[k][0]==reference[k][0] for k in range(n))
+        overlap=sum(len(set(out[k])&set(reference[k]))/len(reference[k]) for k in range(n))
+        print('{:<10} {:>10.1f} {:>9.1f}% {:>9.1f}% {:>11.1f}%'.format(backend,1000*elapsed/n,100*acc/n,100*agree/n,100*overlap/n))
+        del model
+
+
+if __name__=='__main__':
+    args=parser.parse_args()
+    if bundle.is_bundle(args.checkpoint):
+        args.model_name=bundle.manifest(args.checkpoint)['model_name']
+        args.vocab=bundle.vocab_path(args.checkpoint)
+    if args.int8 or args.onnx:
+        export(args)
+    if args.benchmark is not None:
+        benchmark(args)
@@ -0,0 +1,121 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sparql_cache import QueryCache
+
+# Cache of generated beams in front of model.generate.
+#
+# Entries are keyed by the masked input with whitespace collapsed, within a
+# namespace that hashes the checkpoint file, the model name and every
+# decoding parameter, so a new checkpoint or beam size never reuses stale
+# beams. The memory tier is an LRU bounded by entry count and optional TTL;
+# the optional disk tier is a sparql_cache.QueryCache (SQLite, LRU by size)
+# that several processes and runs can share, read with the same TTL.
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def file_hash(path,chunk=2**20):
+    h=hashlib.sha1()
+    file=open(path,'rb')
+    while True:
+        block=file.read(chunk)
+        if not block:
+            break
+        h.update(block)
+    file.close()
+    return h.hexdigest()
+
+
+def namespace(checkpoint,model_name,**params):
+    text=json.dumps({'checkpoint':file_hash(checkpoint),'model':model_name,'params':params},sort_keys=True)
+    return 'generate:'+hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self,namespace,max_entries=10000,ttl=None,disk=None,disk_bytes=2**30):
+        self.namespace=namespace
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.entries=OrderedDict()
+        self.lock=threading.Lock()
+        self.disk=QueryCache(disk,disk_bytes) if disk is not None else None
+        self.hits,self.disk_hits,self.misses=0,0,0
+        self.evicted,self.expired=0,0
+
+    def get(self,text):
+        key=normalize(text)
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is not None:
+                if self.ttl is not None and time.time()-entry[1]>self.ttl:
+                    del self.entries[key]
+                    self.expired+=1
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits+=1
+                    return entry[0]
+        if self.disk is not None:
+            beams=self.disk.get(self.namespace,key,self.ttl)
+            if beams is not None:
+                with self.lock:
+                    self.disk_hits+=1
+                self._remember(key,beams)
+                return beams
+        with self.lock:
+            self.misses+=1
+        return None
+
+    def put(self,text,beams):
+        key=normalize(text)
+        self._remember(key,beams)
+        if self.disk is not None:
+            self.disk.put(self.namespace,key,beams)
+
+    def _remember(self,key,beams):
+        if self.max_entries<=0:
+            return
+        with self.lock:
+            self.entries[key]=(beams,time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted+=1
+
+    def generate(self,texts,fn):
+        # beams for every text; fn(positions) generates the missing ones
+        # (once per distinct input) and returns their beams in that order
+        out=[self.get(t) for t in texts]
+        first={}
+        for k,beams in enumerate(out):
+            if beams is None:
+                first.setdefault(normalize(texts[k]),k)
+        missing=sorted(first.values())
+        if missing:
+            for k,beams in zip(missing,fn(missing)):
+                out[k]=beams
+                self.put(texts[k],beams)
+            for k,beams in enumerate(out):
+                if beams is None:
+                    out[k]=out[first[normalize(texts[k])]]
+        return out
+
+    def stats(self):
+        lookups=self.hits+self.disk_hits+self.misses
+        rate=100*(self.hits+self.disk_hits)/lookups if lookups else 0.0
+        return {'hits':self.hits,'disk_hits':self.disk_hits,'misses':self.misses, \
+                'hit_rate':rate,'entries':len(self.entries),'evicted':self.evicted,'expired':self.expired}
+
+    def report(self):
+        s=self.stats()
+        return 'generation cache hits={}, disk hits={}, misses={}, hit rate={:.1f}%, entries={}, evicted={}, expired={}' \
+            .format(s['hits'],s['disk_hits'],s['misses'],s['hit_rate'],s['entries'],s['evicted'],s['expired'])
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
@@ -1,11 +1,43 @@
-import sys,os,json,re,copy,requests
+import sys
 import json
 import argparse
-import re
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from sparql_decoder import Demasker
+from sparql_endpoint import Endpoint, DEFAULT_URL
+from sparql_cache import QueryCache, CachedEndpoint
+from triple_store import LocalEndpoint
+from sparql_canon import structmatch
 
 parser=argparse.ArgumentParser()
 parser.add_argument('--test_file',type=str,default=None)
+parser.add_argument('--endpoint',type=str,default=DEFAULT_URL)
+parser.add_argument('--workers',type=int,default=1)
+parser.add_argument('--timeout',type=float,default=60)
+parser.add_argument('--retries',type=int,default=2)
+parser.add_argument('--cache',type=str,default=None)
+parser.add_argument('--cache_mb',type=int,default=1024)
+parser.add_argument('--failure_ttl',type=float,default=86400)
+parser.add_argument('--kg',type=str,default=None)
+parser.add_argument('--structural',action='store_true')
 args=parser.parse_args()
+if args.cache is not None and args.kg is not None:
+    # the local store answers from its index; the cache is for the endpoint
+    parser.error('--cache only applies to the SPARQL endpoint, not to --kg')
+
+demasker=Demasker.from_file('vocab.txt')
+cache=None
+if args.kg is not None:
+    # local triple store built by triple_store.py; queries are CPU bound, so
+    # the workers are forked processes sharing its mmapped index
+    endpoint=LocalEndpoint(args.kg)
+else:
+    endpoint=Endpoint(args.endpoint,args.timeout,args.retries,args.workers)
+if args.cache is not None:
+    cache=QueryCache(args.cache,args.cache_mb*2**20,failure_ttl=args.failure_ttl)
+    endpoint=CachedEndpoint(endpoint,cache)
 
 string_prefix='PREFIX p: <http://www.wikidata.org/prop/> PREFIX pq: <http://www.wikidata.org/prop/qualifier/> PREFIX ps: <http://www.wikidata.org/prop/statement/>   PREFIX wd: <http://www.wikidata.org/entity/> PREFIX wds: <http://www.wikidata.org/entity/statement/> PREFIX wdt: <http://www.wikidata.org/prop/direct/> '
 
@@ -31,10 +63,8 @@ def match(target, answer):
 
 def hitkg(query,typeq):
     try:
-        url = 'http://ltcpu3:8890/sparql'
 #        print(query)
-        r = requests.get(url, params={'format': 'json', 'query': query})
-        json_format = r.json()
+        json_format = endpoint.query(query)
 #        print(json_format)
         results = json_format
         if not results and typeq == 'target':
@@ -62,18 +92,7 @@ def empty(r):
     return False
 
 def change(string):
-    string=string.replace('  ',' ').replace('( ','(').replace(' )',')') \
-    .replace('{ ',' {'). \
-    replace(' }','}').replace('wd: ','wd:').replace('wdt: ','wdt:'). \
-    replace(' p: ',' p:').replace(' ps: ',' ps:').replace('pq: ','pq:'). \
-    replace(' , ',', ').replace(", '",",'").replace(" ' ","'").replace("' ","'"). \
-    replace(" '","'").replace(' = ', '=').strip()
-    
-    rep_dec=re.findall('[0-9] \. [0-9]',string)
-    for dec in rep_dec:
-        string=string.replace(dec,dec.replace(' . ','.'))
-    
-    return string
+    return demasker.executable(string)
 
 def querymatch(target, predictions):
     target=string_prefix+change(target)
@@ -92,6 +111,11 @@ def querymatch(target, predictions):
             return False,None,None,None
     return False,None,None,None
 
+def evaluate(question):
+    if args.structural:
+        return structmatch(question['gold_sparql'],question['top_10_output'],demasker,string_prefix)
+    return querymatch(question['gold_sparql'],question['top_10_output'])
+
 def acc(file_name):
     
     file=open(file_name,'r')
@@ -99,28 +123,38 @@ def acc(file_name):
     file.close()
     accuracy,total,mrr=0,0,0
     
-    for question in data:
-        temp,target1,prediction1,prediction_no=querymatch(question['gold_sparql'],question['top_10_output'])
-        accuracy+=temp
-        total+=1
-        if target1 is not None:
-            mrr+=(1/prediction_no)
-            print('MATCH')
-            print(question['question'].split('[DEF]')[0].strip())
-            print(prediction1)
-            print(target1)
-            print('Matched rank '+str(prediction_no))
-            print('Total number of matches uptil now is :'+str(accuracy))
-            print('Accuracy uptil now is: '+str(100*accuracy/total))
-            print('MRR uptil now is: '+str(mrr/total))
-            print('Total queries uptil now is: '+str(total))
-            print('\n\n')
-            
-        else: 
-            print('NO MATCH')
-            print(question['question'].split('[DEF]')[0].strip())
-            print('Total queries uptil now is: '+str(total))
-            print('\n\n')
+    # questions run concurrently, at most --workers in flight, and are
+    # reported in file order
+    if args.kg is not None and args.workers>1:
+        pool=ProcessPoolExecutor(max_workers=args.workers,mp_context=multiprocessing.get_context('fork'))
+    else:
+        pool=ThreadPoolExecutor(max_workers=max(args.workers,1))
+    try:
+        for question,result in zip(data,pool.map(evaluate,data)):
+            temp,target1,prediction1,prediction_no=result
+            accuracy+=temp
+            total+=1
+            if target1 is not None:
+                mrr+=(1/prediction_no)
+                print('MATCH')
+                print(question['question'].split('[DEF]')[0].strip())
+                print(prediction1)
+                print(target1)
+                print('Matched rank '+str(prediction_no))
+                print('Total number of matches uptil now is :'+str(accuracy))
+                print('Accuracy uptil now is: '+str(100*accuracy/total))
+                print('MRR uptil now is: '+str(mrr/total))
+                print('Total queries uptil now is: '+str(total))
+                print('\n\n')
+
+            else: 
+                print('NO MATCH')
+                print(question['question'].split('[DEF]')[0].strip())
+                print('Total queries uptil now is: '+str(total))
+                print('\n\n')
+    finally:
+        # a failed gold query exits; drop the questions still queued
+        pool.shutdown(cancel_futures=True)
             
     return
 
@@ -132,3 +166,6 @@ print('Prediction Followed by Target\n\n')
     
 acc(args.test_file)
 
+if cache is not None:
+    print(cache.stats())
+    cache.close()
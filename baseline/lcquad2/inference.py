@@ -0,0 +1,120 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+import bundle
+from token_dataset import load_tokenizer
+from sparql_rewriter import load_vocab
+from sparql_decoder import Demasker
+from cpu_backend import prepare
+
+# Checkpoint loading and batched beam search for serve.py and other online
+# callers; Test_T5.py and Test_BART.py decode through the same Generator
+# (with their own model loading and pre-tokenized inputs).
+#
+# Checkpoints are the Train_T5/Train_BART state dicts (a DataParallel
+# wrapper around a module whose .model is the HF seq2seq model), so they
+# load exactly as Test_T5.py loads them, or bundle.py directories, whose
+# weights are read once. transformers is imported on first use, so callers
+# can parse arguments and start up before paying for it.
+
+
+class Seq2Seq(nn.Module):
+    def __init__(self,model_name):
+        super(Seq2Seq,self).__init__()
+        from transformers import AutoModelForSeq2SeqLM
+        self.model=AutoModelForSeq2SeqLM.from_pretrained(model_name)
+
+
+class Generator:
+    def __init__(self,model,tokenizer,engine,vocab,beam=10,max_length=100, \
+                 constrained=False,constraint_topk=4,restrict_vocab=False,cache=None,stager=None):
+        self.model=model
+        self.tokenizer=tokenizer
+        self.engine=engine
+        self.beam=beam
+        self.max_length=max_length
+        self.demasker=Demasker(vocab)
+        self.id_table=self.demasker.id_table(tokenizer)
+        from transformers import LogitsProcessorList
+        self.processors=LogitsProcessorList()
+        if constrained:
+            from sparql_constraint import SparqlLogitsProcessor
+            self.processors.append(SparqlLogitsProcessor(tokenizer,vocab,constraint_topk))
+        self.output_vocab=None
+        if restrict_vocab:
+            from restricted_vocab import OutputVocabulary
+            self.output_vocab=OutputVocabulary(tokenizer,vocab)
+        self.cache=cache
+        self.stager=stager
+
+    @classmethod
+    def load(cls,model_name,checkpoint,vocab_path,engine,backend='torch',export_dir=None,**kwargs):
+        source=None
+        if bundle.is_bundle(checkpoint):
+            # the bundle names its model and carries its own vocab.txt
+            source,model_name=checkpoint,bundle.manifest(checkpoint)['model_name']
+            vocab_path=vocab_path or bundle.vocab_path(checkpoint)
+        vocab=load_vocab(vocab_path)
+        tokenizer=load_tokenizer(model_name,vocab,source)
+        seq2seq=Seq2Seq(source or model_name)
+        if 'bart' in model_name.lower():
+            # Train_BART resizes the embeddings for the added mask tokens
+            seq2seq.model.resize_token_embeddings(len(tokenizer))
+        model=engine.wrap(seq2seq)
+        if source is None:
+            model.load_state_dict(engine.load(checkpoint))
+        model.eval()
+        if backend!='torch':
+            # int8 or ONNX Runtime (export_model.py) in place of the fp32 model
+            model.module.model=prepare(model.module.model,backend,export_dir,engine.threads)
+        return cls(model,tokenizer,engine,vocab,**kwargs)
+
+    def encode(self,inputs):
+        model_inputs=self.tokenizer(inputs,padding=True,return_tensors='pt',max_length=512,truncation=True)
+        return self.engine.to({'input_ids':model_inputs['input_ids'], \
+                               'attention_mask':model_inputs['attention_mask']})
+
+    def generate_ids(self,input,beam=None):
+        beam=beam or self.beam
+        restricted=contextlib.nullcontext()
+        if self.output_vocab is not None:
+            from restricted_vocab import restrict
+            restricted=restrict(self.model.module.model,self.output_vocab.allowed(input['input_ids']))
+        with torch.no_grad(), self.engine.autocast(), restricted:
+            return self.model.module.model.generate(input_ids=input['input_ids'], \
+                                                    attention_mask=input['attention_mask'], \
+                                                    num_beams=beam,num_return_sequences=beam, \
+                                                    early_stopping=True,max_length=self.max_length, \
+                                                    logits_processor=self.processors)
+
+    # encode, where given, maps positions in inputs to their model inputs
+    # (Test_* collate pre-tokenized data); otherwise inputs are tokenized
+
+    def beams(self,inputs,beam=None,encode=None):
+        beam=beam or self.beam
+        input=self.encode(inputs) if encode is None else encode(list(range(len(inputs))))
+        out=self.demasker.decode_ids(self.generate_ids(input,beam),self.tokenizer,self.id_table)
+        return [out[k*beam:(k+1)*beam] for k in range(len(inputs))]
+
+    def decode(self,inputs,encode=None):
+        if self.stager is None:
+            return self.beams(inputs,encode=encode)
+        return self.stager.decode(inputs,lambda positions,beam:self.beams([inputs[k] for k in positions],beam, \
+                                                                          subset(encode,positions)))
+
+    def generate(self,inputs,encode=None):
+        # top beam_length de-masked SPARQL strings for each masked input
+        if self.cache is None:
+            return self.decode(inputs,encode)
+        return self.cache.generate(inputs,lambda missing:self.decode([inputs[k] for k in missing], \
+                                                                     subset(encode,missing)))
+
+
+def subset(encode,positions):
+    # encode for the inputs at positions
+    if encode is None:
+        return None
+    return lambda sub:encode([positions[k] for k in sub])
+
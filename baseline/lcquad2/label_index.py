@@ -0,0 +1,195 @@
+import json
+import struct
+import hashlib
+import argparse
+from collections.abc import Mapping
+
+import numpy as np
+
+# Read-only, memory-mapped id -> label index for lcq2_labels.pickle and
+# relations.json.
+#
+# Same container as token_dataset (magic, header length, JSON header,
+# 8-byte aligned sections). Entries are sorted by a 64-bit blake2b hash of
+# the id, so a lookup is one searchsorted over the hash array plus a key
+# comparison; ids and labels are utf-8 blobs indexed by int64 offsets, and a
+# flag array keeps the None labels apart from empty strings. Opening an
+# index maps the file instead of unpickling a dict, and parallel workers
+# share the pages.
+#
+#   python label_index.py lcq2_labels.pickle lcq2_labels.idx
+#   python label_index.py relations.json relations.idx
+
+MAGIC=b'LABELS01'
+ALIGN=8
+
+SECTIONS=[('hashes','<u8'),('keys','u1'),('key_offsets','<i8'),
+          ('values','u1'),('value_offsets','<i8'),('none','u1')]
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key,digest_size=8).digest(),'little')
+
+
+def _blob(strings):
+    offsets=np.zeros(len(strings)+1,dtype='<i8')
+    offsets[1:]=np.cumsum([len(s) for s in strings])
+    return np.frombuffer(b''.join(strings),dtype='u1'),offsets
+
+
+def build(mapping,path,source=None):
+    entries=sorted((key_hash(k.encode('utf-8')),k.encode('utf-8'),v) for k,v in mapping.items())
+    arrays={}
+    arrays['hashes']=np.array([e[0] for e in entries],dtype='<u8')
+    arrays['keys'],arrays['key_offsets']=_blob([e[1] for e in entries])
+    arrays['values'],arrays['value_offsets']=_blob([b'' if e[2] is None else e[2].encode('utf-8') for e in entries])
+    arrays['none']=np.array([e[2] is None for e in entries],dtype='u1')
+
+    header={'source':source,'count':len(entries),'sections':{}}
+    # section offsets depend on the header size; see token_dataset.write
+    blob=b''
+    while True:
+        start=len(MAGIC)+8+len(blob)
+        pos=-(-start//ALIGN)*ALIGN
+        for name,dtype in SECTIONS:
+            header['sections'][name]=[pos,dtype,len(arrays[name])]
+            pos+=-(-arrays[name].nbytes//ALIGN)*ALIGN
+        new=json.dumps(header).encode('utf-8')
+        stable=len(new)==len(blob)
+        blob=new
+        if stable:
+            break
+
+    file=open(path,'wb')
+    file.write(MAGIC)
+    file.write(struct.pack('<Q',len(blob)))
+    file.write(blob)
+    for name,dtype in SECTIONS:
+        file.write(b'\0'*(header['sections'][name][0]-file.tell()))
+        file.write(arrays[name].tobytes())
+    file.close()
+    return header
+
+
+class LabelIndex(Mapping):
+    # Assignments go to an in-memory overlay (the file stays read-only), and
+    # labels stored as None read as self.none, so preprocess.py's fixes and
+    # its None -> null mapping work as they did on the dict.
+    def __init__(self,path):
+        self.path=path
+        file=open(path,'rb')
+        magic=file.read(len(MAGIC))
+        if magic!=MAGIC:
+            file.close()
+            raise ValueError('{} is not a label index'.format(path))
+        size=struct.unpack('<Q',file.read(8))[0]
+        self.header=json.loads(file.read(size).decode('utf-8'))
+        file.close()
+        # plain ndarray views: memmap's per-item __getitem__ costs more than
+        # the lookup itself
+        mm=np.asarray(np.memmap(path,dtype='u1',mode='r'))
+        self.arrays={}
+        for name,(offset,dtype,length) in self.header['sections'].items():
+            width=np.dtype(dtype).itemsize
+            self.arrays[name]=mm[offset:offset+length*width].view(dtype)
+        self.overrides={}
+        self.none=None
+
+    def _text(self,name,j):
+        offsets=self.arrays[name[:-1]+'_offsets']
+        return self.arrays[name][offsets[j]:offsets[j+1]].tobytes()
+
+    def find(self,key):
+        # position of key in the file, -1 when absent
+        data=key.encode('utf-8')
+        h=np.uint64(key_hash(data))
+        hashes=self.arrays['hashes']
+        j=int(np.searchsorted(hashes,h))
+        while j<len(hashes) and hashes[j]==h:
+            if self._text('keys',j)==data:
+                return j
+            j+=1
+        return -1
+
+    def value(self,j):
+        if self.arrays['none'][j]:
+            return self.none
+        return self._text('values',j).decode('utf-8')
+
+    def __getitem__(self,key):
+        if key in self.overrides:
+            return self.overrides[key]
+        if not isinstance(key,str):
+            raise KeyError(key)
+        j=self.find(key)
+        if j<0:
+            raise KeyError(key)
+        return self.value(j)
+
+    def __setitem__(self,key,value):
+        self.overrides[key]=value
+
+    def __contains__(self,key):
+        return key in self.overrides or (isinstance(key,str) and self.find(key)>=0)
+
+    def __iter__(self):
+        yield from self.overrides
+        for j in range(self.header['count']):
+            key=self._text('keys',j).decode('utf-8')
+            if key not in self.overrides:
+                yield key
+
+    def __len__(self):
+        return self.header['count']+sum(1 for k in self.overrides if isinstance(k,str) and self.find(k)<0)
+
+
+def fill_none(labels,value):
+    # labels whose stored value is None read as value
+    if isinstance(labels,LabelIndex):
+        labels.none=value
+        return labels
+    for key in labels:
+        if labels[key] is None:
+            labels[key]=value
+    return labels
+
+
+class Defaulted(dict):
+    # labels that read as null for ids they do not have (or store as None),
+    # so queries outside the label file still rewrite
+    def __init__(self,labels,null):
+        super(Defaulted,self).__init__()
+        self.labels=labels
+        self.null=null
+
+    def __missing__(self,key):
+        value=self.labels.get(key)
+        return self.null if value is None else value
+
+
+def load(path):
+    # A label index, or the original pickle/JSON dictionary.
+    file=open(path,'rb')
+    magic=file.read(len(MAGIC))
+    file.close()
+    if magic==MAGIC:
+        return LabelIndex(path)
+    if path.endswith('.json'):
+        file=open(path,'r')
+        data=json.load(file)
+    else:
+        import pickle
+        file=open(path,'rb')
+        data=pickle.load(file)
+    file.close()
+    return data
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('source',type=str)
+    parser.add_argument('out',type=str)
+    args=parser.parse_args()
+
+    header=build(load(args.source),args.out,args.source)
+    print('{}: {} labels'.format(args.out,header['count']))
@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import label_index
+from sparql_rewriter import Rewriter, load_vocab, mask_dict, lex, PREFIX, ENTITY, RELATION
+
+# Local entity/relation linker in place of the Falcon 2.0 web API.
+#
+# BM25 inverted indexes over the entity labels (lcq2_labels) and relation
+# labels (relations.json). Every n-gram of a question that does not start or
+# end on a stopword is a mention; entities are scored per mention by BM25
+# times the share of the label and of the mention the match covers, so
+# "palace of westminster" beats "westminster" and "palace". Relations are
+# scored against the whole question. Output is the link JSON experiments.ipynb
+# reads (see README), with the masked gold query as labels.
+#
+#   python lexical_linker.py build --out linker_index
+#   python lexical_linker.py link --index linker_index --data train.json --out link_train.json \
+#                            --ents 10 --rels 10 --workers 8
+#
+# The index is a directory of .npy arrays opened with mmap_mode='r', so
+# forked --workers share its pages.
+
+ENTITY_URI='http://www.wikidata.org/entity/'
+RELATION_URIS={'wdt:':'http://www.wikidata.org/prop/direct/','p:':'http://www.wikidata.org/prop/', \
+               'ps:':'http://www.wikidata.org/prop/statement/','pq:':'http://www.wikidata.org/prop/qualifier/'}
+
+STOPWORDS=frozenset('''a about an and any are as at be been by can could did do does for from had has
+have he her hers him his how i in is it its me my name of on or she should so tell that the their
+them there these they this those to was were what when where which who whom whose why will with would
+you your s'''.split())
+
+ARRAYS=('indptr','docs','weights','lengths','ids','id_offsets','labels','label_offsets','terms','term_offsets')
+
+_WORD_RE=re.compile(r'[a-z0-9]+')
+
+
+def words(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def stem(word):
+    # plurals only; relation labels are mostly nouns
+    if len(word)>4 and word.endswith('ies'):
+        return word[:-3]+'y'
+    if len(word)>3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def terms(text):
+    # content words, stemmed; all of them when the text is only stopwords
+    tokens=words(text)
+    content=[t for t in tokens if t not in STOPWORDS] or tokens
+    return [stem(t) for t in content]
+
+
+def _blob(strings):
+    data=[s.encode('utf-8') for s in strings]
+    offsets=np.zeros(len(data)+1,dtype='<i8')
+    offsets[1:]=np.cumsum([len(s) for s in data])
+    return np.frombuffer(b''.join(data),dtype='u1'),offsets
+
+
+class LexicalIndex:
+    def __init__(self,path,name):
+        self.arrays={a:np.load(os.path.join(path,'{}_{}.npy'.format(name,a)),mmap_mode='r') for a in ARRAYS}
+        self.arrays={a:np.asarray(v) for a,v in self.arrays.items()}
+        offsets,blob=self.arrays['term_offsets'],self.arrays['terms'].tobytes()
+        self.vocab={blob[offsets[j]:offsets[j+1]].decode('utf-8'):j for j in range(len(offsets)-1)}
+        self.indptr,self.docs,self.weights=self.arrays['indptr'],self.arrays['docs'],self.arrays['weights']
+        self.lengths=self.arrays['lengths']
+        offsets,blob=self.arrays['id_offsets'],self.arrays['ids'].tobytes()
+        self.rows={blob[offsets[j]:offsets[j+1]].decode('utf-8'):j for j in range(len(offsets)-1)}
+
+    @staticmethod
+    def build(path,name,ids,labels,k1=1.2,b=0.75):
+        postings=defaultdict(list)
+        lengths=np.zeros(len(ids),dtype='<i4')
+        for doc,label in enumerate(labels):
+            tokens=terms(label or '')
+            lengths[doc]=len(set(tokens))
+            for t in set(tokens):
+                postings[t].append((doc,tokens.count(t)))
+        avg=max(lengths.mean(),1.0) if len(ids) else 1.0
+        vocab=sorted(postings)
+        indptr=np.zeros(len(vocab)+1,dtype='<i8')
+        indptr[1:]=np.cumsum([len(postings[t]) for t in vocab])
+        docs=np.zeros(indptr[-1],dtype='<i4')
+        weights=np.zeros(indptr[-1],dtype='<f4')
+        for j,t in enumerate(vocab):
+            entries=np.array(postings[t],dtype='<i8')
+            df=len(entries)
+            idf=np.log(1+(len(ids)-df+0.5)/(df+0.5))
+            tf=entries[:,1]
+            norm=k1*(1-b+b*lengths[entries[:,0]]/avg)
+            docs[indptr[j]:indptr[j+1]]=entries[:,0]
+            weights[indptr[j]:indptr[j+1]]=idf*tf*(k1+1)/(tf+norm)
+        arrays={'indptr':indptr,'docs':docs,'weights':weights,'lengths':lengths}
+        arrays['ids'],arrays['id_offsets']=_blob(ids)
+        arrays['labels'],arrays['label_offsets']=_blob([l or '' for l in labels])
+        arrays['terms'],arrays['term_offsets']=_blob(vocab)
+        for a in ARRAYS:
+            np.save(os.path.join(path,'{}_{}.npy'.format(name,a)),arrays[a])
+        return {'count':len(ids),'terms':len(vocab),'postings':int(indptr[-1])}
+
+    def _text(self,name,j):
+        offsets=self.arrays[name[:-1]+'_offsets']
+        return self.arrays[name][offsets[j]:offsets[j+1]].tobytes().decode('utf-8')
+
+    def ident(self,doc):
+        return self._text('ids',doc)
+
+    def label(self,doc):
+        return self._text('labels',doc)
+
+    def label_of(self,ident):
+        # label of an id; '' when the index does not have it
+        doc=self.rows.get(ident)
+        return '' if doc is None else self.label(doc)
+
+    def score(self,query):
+        # (docs, BM25 scores, number of query terms each doc matched)
+        rows=[self.vocab[t] for t in set(query) if t in self.vocab]
+        if not rows:
+            return np.zeros(0,dtype='<i4'),np.zeros(0),np.zeros(0)
+        docs=np.concatenate([self.docs[self.indptr[r]:self.indptr[r+1]] for r in rows])
+        weights=np.concatenate([self.weights[self.indptr[r]:self.indptr[r+1]] for r in rows])
+        docs,inverse=np.unique(docs,return_inverse=True)
+        return docs,np.bincount(inverse,weights),np.bincount(inverse)
+
+
+def top(docs,scores,k):
+    if len(docs)>k:
+        keep=np.argpartition(-scores,k-1)[:k]
+        docs,scores=docs[keep],scores[keep]
+    return docs,scores
+
+
+class Linker:
+    def __init__(self,path,max_ngram=6):
+        self.path=path
+        self.entities=LexicalIndex(path,'entities')
+        self.relations=LexicalIndex(path,'relations')
+        self.max_ngram=max_ngram
+
+    def mentions(self,question):
+        tokens=words(question)
+        spans=set()
+        for i in range(len(tokens)):
+            if tokens[i] in STOPWORDS:
+                continue
+            for j in range(i+1,min(len(tokens),i+self.max_ngram)+1):
+                if tokens[j-1] in STOPWORDS:
+                    continue
+                spans.add(tuple(sorted(set(stem(t) for t in tokens[i:j] if t not in STOPWORDS))))
+        return spans
+
+    def link_entities(self,question,k):
+        best={}
+        for span in self.mentions(question):
+            docs,bm25,matched=self.entities.score(span)
+            if not len(docs):
+                continue
+            scores=bm25*matched/np.maximum(self.entities.lengths[docs],1)*matched/len(span)
+            for doc,score in zip(*top(docs,scores,k)):
+                if score>best.get(doc,0):
+                    best[doc]=score
+        return self.rank(self.entities,best,k)
+
+    def link_relations(self,question,k):
+        query=terms(question)
+        docs,bm25,matched=self.relations.score(query)
+        scores=bm25*np.sqrt(matched/np.maximum(self.relations.lengths[docs],1))
+        return self.rank(self.relations,dict(zip(*top(docs,scores,k))),k)
+
+    def rank(self,index,scores,k):
+        # ties (e.g. equal labels) go to the lower, usually better known, id
+        ids=[(index.ident(doc),doc,score) for doc,score in scores.items()]
+        ids.sort(key=lambda e:(-e[2],len(e[0]),e[0]))
+        return [(ident,index.label(doc)) for ident,doc,_ in ids[:k]]
+
+    def link(self,question,k_ents=10,k_rels=10):
+        return self.link_entities(question,k_ents) if k_ents>0 else [], \
+               self.link_relations(question,k_rels) if k_rels>0 else []
+
+
+def gold_links(sparql):
+    # ids in the gold query, upper-cased, in order: [(prefix, id)]
+    ents,rels,prefix=[],[],None
+    for kind,text in lex(sparql):
+        if kind==PREFIX:
+            prefix=text
+        elif kind==ENTITY and '}' not in text:
+            ents.append((prefix,text.upper()))
+        elif kind==RELATION:
+            rels.append((prefix,text.upper()))
+    return ents,rels
+
+
+def question_text(inst):
+    # as preprocess.py
+    question=inst['NNQT_question'] if inst.get('question') is None else inst['question']
+    return question.replace('{','').replace('}','')
+
+
+def record(question,ents,rels,target,masks):
+    # ents: [(id, label)], rels: [(prefix, id, label)]
+    links={'utterance':question,'ents':[],'rels':[]}
+    fragments=[]
+    for ident,label in ents:
+        links['ents'].append({'uri':ENTITY_URI+ident,'prefix':'wd:','id':ident})
+        fragments+=['[DEF]','wd:',(ident+' '+label).strip()]
+    for prefix,ident,label in rels:
+        links['rels'].append({'uri':RELATION_URIS[prefix]+ident,'prefix':prefix,'id':ident})
+        fragments+=['[DEF]',prefix,(ident+' '+label).strip()]
+    inputs=question+' '+' '.join(masks.get(f,f) for f in fragments)
+    return [links,{'utterance':question,'fragments':fragments},{'inputs':inputs,'labels':target}]
+
+
+_linker,_options=None,None
+
+
+def link_batch(batch):
+    # batch: [(question, sparql or None)]
+    k_ents,k_rels,gold_ents,gold_rels,vocab=_options
+    masks=mask_dict(vocab)
+    rewriter=Rewriter(vocab,defaultdict(str),{})
+    out=[]
+    for question,sparql in batch:
+        ents,rels=_linker.link(question,k_ents,k_rels)
+        rels=[('wdt:',ident,label) for ident,label in rels]
+        target=''
+        if sparql is not None:
+            target=rewriter.rewrite(sparql)[0]
+            want_ents,want_rels=gold_links(sparql)
+            if gold_ents:
+                have=set(e[0] for e in ents)
+                for _,ident in want_ents:
+                    if ident not in have:
+                        have.add(ident)
+                        ents.append((ident,_linker.entities.label_of(ident)))
+            if gold_rels:
+                have=set(r[:2] for r in rels)
+                for prefix,ident in want_rels:
+                    if (prefix,ident) not in have:
+                        have.add((prefix,ident))
+                        rels.append((prefix,ident,_linker.relations.label_of(ident)))
+        out.append(record(question,ents,rels,target,masks))
+    return out
+
+
+def link_all(linker,items,k_ents=10,k_rels=10,gold_ents=False,gold_rels=False,vocab=None,workers=1,batch=256):
+    # items: [(question, sparql or None)]; workers>1 forks processes that
+    # share the linker
+    global _linker,_options
+    _linker,_options=linker,(k_ents,k_rels,gold_ents,gold_rels,vocab or load_vocab('vocab.txt'))
+    batches=[items[i:i+batch] for i in range(0,len(items),batch)]
+    if workers>1:
+        pool=ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('fork'))
+        results=list(pool.map(link_batch,batches))
+        pool.shutdown()
+    else:
+        results=[link_batch(b) for b in batches]
+    return [r for result in results for r in result]
+
+
+def build(out,labels_path='lcq2_labels.pickle',relations_path='relations.json'):
+    os.makedirs(out,exist_ok=True)
+    labels=label_index.load(labels_path)
+    ids=[k for k in labels if isinstance(k,str) and re.fullmatch(r'q[0-9]+',k)]
+    info={'entities':LexicalIndex.build(out,'entities',[k.upper() for k in ids],[labels[k] for k in ids])}
+    relations=label_index.load(relations_path)
+    ids=[k for k in relations if re.fullmatch(r'P[0-9]+',k)]
+    info['relations']=LexicalIndex.build(out,'relations',ids,[relations[k] for k in ids])
+    info['sources']=[labels_path,relations_path]
+    file=open(os.path.join(out,'meta.json'),'w')
+    json.dump(info,file,indent=1)
+    file.close()
+    return info
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('command',choices=['build','link'])
+    parser.add_argument('--out',type=str,required=True)
+    parser.add_argument('--labels',type=str,default='lcq2_labels.pickle')
+    parser.add_argument('--relations',type=str,default='relations.json')
+    parser.add_argument('--index',type=str,default='linker_index')
+    parser.add_argument('--data',type=str,default=None)
+    parser.add_argument('--ents',type=int,default=10)
+    parser.add_argument('--rels',type=int,default=10)
+    parser.add_argument('--gold_ents',action='store_true')
+    parser.add_argument('--gold_rels',action='store_true')
+    parser.add_argument('--max_ngram',type=int,default=6)
+    parser.add_argument('--workers',type=int,default=1)
+    parser.add_argument('--batch',type=int,default=256)
+    parser.add_argument('--vocab',type=str,default='vocab.txt')
+    args=parser.parse_args()
+
+    if args.command=='build':
+        info=build(args.out,args.labels,args.relations)
+        print('{}: {} entities, {} relations'.format(args.out,info['entities']['count'],info['relations']['count']))
+    else:
+        if args.data is None:
+            parser.error('link needs --data')
+        file=open(args.data,'r')
+        data=json.load(file)
+        file.close()
+        items=[(question_text(inst),inst.get('sparql_wikidata')) for inst in data]
+        start=time.perf_counter()
+        links=link_all(Linker(args.index,args.max_ngram),items,args.ents,args.rels,args.gold_ents,args.gold_rels, \
+                       load_vocab(args.vocab),args.workers,args.batch)
+        elapsed=time.perf_counter()-start
+        file=open(args.out,'w')
+        json.dump(links,file)
+        file.close()
+        print('{}: {} questions in {:.1f} s ({:.0f}/s)'.format(args.out,len(links),elapsed,len(links)/elapsed))
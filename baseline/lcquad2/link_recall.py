@@ -0,0 +1,207 @@
+import os
+import re
+import json
+import glob
+import time
+import argparse
+
+import numpy as np
+
+from lexical_linker import gold_links, question_text
+
+# Entity/relation linking recall of link JSON files (the list of
+# [links, fragments, inputs/labels] experiments.ipynb reads).
+#
+# For every k: recall (share of a question's gold ids among its first k
+# candidates, averaged over questions, 1 when it has none, as in
+# linking.ipynb), all present (share of questions with every gold id in the
+# first k) and the average number and length in words of the [DEF]
+# annotations that k keeps. 'all' is the whole candidate list, which is the
+# README table's k for Falcon files (k candidates per detected mention).
+#
+#   python link_recall.py link_test.json --gold test_KG_4211.json
+#   python link_recall.py --experiments ../../experiments --root ../..
+#
+# Gold ids come from sparql_wikidata with the preprocess.py lexer for the
+# questions --gold has at the same position (link files follow its order),
+# else from the masked labels as linking.ipynb does. --experiments evaluates the LINKS_PATH of every experiment notebook
+# and writes link_recall.json next to its meta_data.json.
+
+KS=(1,5,10,None)
+
+_ID_RE=re.compile(r'[QP][0-9]+')
+
+
+def label_ids(labels):
+    ents,rels=set(),set()
+    for tok in labels.split(' '):
+        m=_ID_RE.search(tok.upper())
+        if m is not None:
+            (ents if m.group(0)[0]=='Q' else rels).add(m.group(0))
+    return ents,rels
+
+
+def gold_index(path):
+    # (utterance, entity ids, relation ids) per question, in file order;
+    # question texts repeat ('n/a', 'na', ...), so link files are paired
+    # with it by position
+    file=open(path,'r')
+    data=json.load(file)
+    file.close()
+    out=[]
+    for inst in data:
+        ents,rels=gold_links(inst['sparql_wikidata'])
+        out.append((question_text(inst),set(i for _,i in ents),set(i for _,i in rels)))
+    return out
+
+
+def ranks(candidates,gold):
+    # candidates: ranked id lists, gold: id sets, one per question. Returns
+    # (question of each gold id, its best candidate rank or inf)
+    cq=np.repeat(np.arange(len(candidates)),[len(c) for c in candidates])
+    crank=np.concatenate([np.arange(len(c)) for c in candidates]+[np.zeros(0,dtype=np.int64)])
+    gq=np.repeat(np.arange(len(gold)),[len(g) for g in gold])
+    ids=np.array([i for c in candidates for i in c]+[i for g in gold for i in g]+[''])
+    _,codes=np.unique(ids,return_inverse=True)
+    width=codes.max()+1
+    ckeys=cq*width+codes[:len(cq)]
+    gkeys=gq*width+codes[len(cq):len(cq)+len(gq)]
+
+    order=np.lexsort((crank,ckeys))
+    ckeys,crank=ckeys[order],crank[order]
+    first=np.ones(len(ckeys),dtype=bool)
+    first[1:]=ckeys[1:]!=ckeys[:-1]
+    ckeys,crank=ckeys[first],crank[first]
+    pos=np.minimum(np.searchsorted(ckeys,gkeys),max(len(ckeys)-1,0))
+    found=(ckeys[pos]==gkeys) if len(ckeys) else np.zeros(len(gkeys),dtype=bool)
+    return gq,np.where(found,crank[pos] if len(ckeys) else 0,np.inf)
+
+
+def scores(candidates,gold,ks=KS):
+    # {k: (recall, all present)}
+    n=len(gold)
+    gq,grank=ranks(candidates,gold)
+    total=np.bincount(gq,minlength=n)
+    out={}
+    for k in ks:
+        hit=grank<(np.inf if k is None else k)
+        hits=np.bincount(gq,hit,minlength=n)
+        recall=np.where(total>0,hits/np.maximum(total,1),1.0)
+        out[k]=(float(recall.mean()),float((hits==total).mean()))
+    return out
+
+
+def sizes(candidates,words,ks=KS):
+    # {k: (annotations, words)} per question on average; words: the length
+    # of each candidate's [DEF] annotation
+    n=len(candidates)
+    cq=np.repeat(np.arange(n),[len(c) for c in candidates])
+    crank=np.concatenate([np.arange(len(c)) for c in candidates]+[np.zeros(0,dtype=np.int64)])
+    cost=np.array([w for ws in words for w in ws]+[0])[:len(cq)]
+    out={}
+    for k in ks:
+        keep=crank<(np.inf if k is None else k)
+        out[k]=(float(keep.sum()/max(n,1)),float((cost*keep).sum()/max(n,1)))
+    return out
+
+
+def evaluate(path,gold=None,ks=KS):
+    file=open(path,'r')
+    data=json.load(file)
+    file.close()
+    gold=gold or []
+    ents,rels,gold_ents,gold_rels,ent_words,rel_words=[],[],[],[],[],[]
+    paired=0
+    for j,(links,annotated,converted) in enumerate(data):
+        ents.append([e['id'].upper() for e in links['ents']])
+        rels.append([r['id'].upper() for r in links['rels']])
+        # the j-th --gold question, if the link file follows its order
+        if j<len(gold) and gold[j][0]==links['utterance']:
+            want=gold[j][1:]
+            paired+=1
+        else:
+            want=label_ids(converted['labels'])
+        gold_ents.append(want[0])
+        gold_rels.append(want[1])
+        # [DEF], prefix and 'id label' per candidate, entities first
+        fragments=annotated.get('fragments',[])
+        lengths=[2+len(fragments[j].split()) for j in range(2,len(fragments),3)]
+        if len(lengths)!=len(ents[-1])+len(rels[-1]):
+            lengths=[3]*(len(ents[-1])+len(rels[-1]))
+        ent_words.append(lengths[:len(ents[-1])])
+        rel_words.append(lengths[len(ents[-1]):])
+
+    result={'links':path,'questions':len(data),'gold_questions':paired,'k':{}}
+    ent_scores,rel_scores=scores(ents,gold_ents,ks),scores(rels,gold_rels,ks)
+    ent_sizes,rel_sizes=sizes(ents,ent_words,ks),sizes(rels,rel_words,ks)
+    for k in ks:
+        result['k']['all' if k is None else str(k)]={ \
+            'entity_recall':ent_scores[k][0],'entity_all_present':ent_scores[k][1], \
+            'relation_recall':rel_scores[k][0],'relation_all_present':rel_scores[k][1], \
+            'annotations':ent_sizes[k][0]+rel_sizes[k][0],'annotation_words':ent_sizes[k][1]+rel_sizes[k][1]}
+    return result
+
+
+def table(result):
+    lines=['{} ({} questions, {} with --gold ids)'.format(result['links'],result['questions'], \
+                                                         result.get('gold_questions',0)), \
+           '{:>5} {:>14} {:>18} {:>16} {:>20} {:>12} {:>8}'.format('k','entity recall','entity all present', \
+           'relation recall','relation all present','annotations','words')]
+    for k,r in result['k'].items():
+        lines.append('{:>5} {:>14.3f} {:>18.3f} {:>16.3f} {:>20.3f} {:>12.1f} {:>8.1f}'.format(k, \
+                     r['entity_recall'],r['entity_all_present'],r['relation_recall'],r['relation_all_present'], \
+                     r['annotations'],r['annotation_words']))
+    return '\n'.join(lines)
+
+
+def links_path(experiment):
+    # LINKS_PATH = '...' in the experiment's (papermill) notebook
+    for notebook in sorted(glob.glob(os.path.join(experiment,'*.ipynb'))):
+        file=open(notebook,'r')
+        m=re.search(r"LINKS_PATH = '([^']+)'",file.read())
+        file.close()
+        if m is not None:
+            return m.group(1)
+    return None
+
+
+def write(result,path):
+    file=open(path,'w')
+    json.dump(result,file,indent=1)
+    file.close()
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('links',type=str,nargs='*')
+    parser.add_argument('--gold',type=str,default=None)
+    parser.add_argument('--out',type=str,default=None)
+    parser.add_argument('--experiments',type=str,default=None)
+    parser.add_argument('--root',type=str,default='.')
+    args=parser.parse_args()
+
+    gold=gold_index(args.gold) if args.gold is not None else None
+    jobs=[(path,None) for path in args.links]
+    if args.experiments is not None:
+        for meta in sorted(glob.glob(os.path.join(args.experiments,'*','meta_data.json'))):
+            experiment=os.path.dirname(meta)
+            path=links_path(experiment)
+            if path is None or not os.path.exists(os.path.join(args.root,path)):
+                print('{}: links {} not found, skipped'.format(experiment,path))
+                continue
+            jobs.append((os.path.join(args.root,path),os.path.join(experiment,'link_recall.json')))
+    if not jobs:
+        parser.error('no link files (pass them or --experiments)')
+
+    results=[]
+    for path,out in jobs:
+        start=time.perf_counter()
+        result=evaluate(path,gold)
+        result['seconds']=time.perf_counter()-start
+        print(table(result))
+        print('{:.2f} s\n'.format(result['seconds']))
+        if out is not None:
+            write(result,out)
+        results.append(result)
+    if args.out is not None:
+        write(results[0] if len(results)==1 else results,args.out)
@@ -2,3 +2,20 @@
 python3 preprocess.py --file_name train
 python3 preprocess.py --file_name test
 
+
+# pre-tokenized, memory-mapped copies (pass the .bin file as --train_file/--test_file)
+# python3 preprocess.py --file_name train --tokenizer t5-base
+# python3 preprocess.py --file_name test --tokenizer t5-base
+
+# memory-mapped label indexes (pass them as --labels/--relations)
+# python3 label_index.py lcq2_labels.pickle lcq2_labels.idx
+# python3 label_index.py relations.json relations.idx
+# python3 preprocess.py --file_name test --labels lcq2_labels.idx --relations relations.idx
+
+# local entity/relation links in the link JSON experiments.ipynb reads (in place of Falcon 2.0)
+# python3 lexical_linker.py build --out linker_index
+# python3 lexical_linker.py link --index linker_index --data train.json --out link_train.json --ents 10 --rels 10 --workers 8
+
+# dense relation retrieval: gold entities plus the top k retrieved relations as [DEF] annotations
+# python3 dense_linker.py build --out dense_index --train train.json --nlist 64
+# python3 dense_linker.py link --index dense_index --data test_KG_4211.json --k 10 --nprobe 16 --out test_dense_mix.pickle
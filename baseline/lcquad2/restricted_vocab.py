@@ -0,0 +1,102 @@
+import re
+import contextlib
+
+import torch
+import torch.nn as nn
+
+# Copy-restricted output vocabulary for inference.
+#
+# Targets only contain the <extra_id_N> SPARQL masks, q/p ids and literals
+# copied from the input (question and [DEF] annotations, also lower-cased),
+# digits, punctuation, single characters and a few fixed words such as the
+# 'en' of language filters. RestrictedHead replaces the LM head and, while a token set is
+# active, projects onto those rows of the output matrix only; every other
+# logit is -inf, so generate() sees full-size scores at a fraction of the
+# d_model x vocab cost per step. The set is the union over the batch, and
+# beam scores are log-probabilities renormalised over it.
+
+_NUMERIC_RE=re.compile(r'^[0-9.,+\-eE:\'"()]+$')
+_PUNCT_RE=re.compile(r'[^\w\s]')
+FIXED_WORDS=('en',)
+
+
+class RestrictedHead(nn.Module):
+    def __init__(self,head):
+        super(RestrictedHead,self).__init__()
+        self.head=head
+        self.select(None)
+
+    @property
+    def weight(self):
+        return self.head.weight
+
+    def select(self,allowed):
+        # rows of the output matrix for a batch, gathered once for all of its
+        # decoding steps
+        self.allowed=allowed
+        self.sub_weight,self.sub_bias=None,None
+        if allowed is not None:
+            with torch.no_grad():
+                self.sub_weight=self.head.weight[allowed]
+                if self.head.bias is not None:
+                    self.sub_bias=self.head.bias[allowed]
+
+    def forward(self,hidden):
+        if self.allowed is None:
+            return self.head(hidden)
+        sub=nn.functional.linear(hidden,self.sub_weight,self.sub_bias)
+        out=hidden.new_full(hidden.shape[:-1]+(self.head.out_features,),float('-inf'))
+        out[...,self.allowed]=sub
+        return out
+
+
+class OutputVocabulary:
+    def __init__(self,tokenizer,vocab):
+        self.tokenizer=tokenizer
+        fixed=set()
+        for n in range(len(vocab)):
+            idx=tokenizer.convert_tokens_to_ids('<extra_id_'+str(n)+'>')
+            if idx is not None and idx!=tokenizer.unk_token_id:
+                fixed.add(idx)
+        for idx in (tokenizer.pad_token_id,tokenizer.eos_token_id,tokenizer.bos_token_id,tokenizer.unk_token_id):
+            if idx is not None:
+                fixed.add(idx)
+        for tok,idx in tokenizer.get_vocab().items():
+            text=tok.lstrip('▁Ġ')
+            if len(text)<=1 or _NUMERIC_RE.match(text):
+                fixed.add(idx)
+        for word in FIXED_WORDS:
+            for text in (word,' '+word):
+                fixed.update(tokenizer(text,add_special_tokens=False)['input_ids'])
+        self.fixed=fixed
+
+    def allowed(self,input_ids):
+        # token ids an output for this batch of inputs may use, sorted
+        ids=set(self.fixed)
+        ids.update(input_ids.reshape(-1).tolist())
+        texts=self.tokenizer.batch_decode(input_ids,skip_special_tokens=True)
+        # literals are lower-cased and lose quotes and other punctuation
+        variants=[t.lower() for t in texts]+[_PUNCT_RE.sub(' ',t.lower()) for t in texts]
+        for seq in self.tokenizer(variants,add_special_tokens=False)['input_ids']:
+            ids.update(seq)
+        return torch.tensor(sorted(ids),dtype=torch.long,device=input_ids.device)
+
+
+def install(model):
+    # swap model.lm_head for a RestrictedHead (after the checkpoint is loaded)
+    if not isinstance(model.lm_head,RestrictedHead):
+        model.lm_head=RestrictedHead(model.lm_head)
+    return model.lm_head
+
+
+@contextlib.contextmanager
+def restrict(model,allowed):
+    if allowed is None:
+        yield
+        return
+    head=install(model)
+    head.select(allowed)
+    try:
+        yield
+    finally:
+        head.select(None)
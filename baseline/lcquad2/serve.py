@@ -0,0 +1,221 @@
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from engine import Engine, add_arguments
+import bundle
+import cpu_backend
+from inference import Generator
+from generation_cache import GenerationCache, namespace
+from staged_decoding import StagedDecoder, Validator
+from sparql_rewriter import Rewriter, load_vocab
+import label_index
+
+# HTTP text-to-SPARQL service with dynamic batching.
+#
+# Requests are queued; one worker thread takes the first waiting question,
+# collects more for up to --max_wait_ms or until --max_batch are in hand,
+# runs a single batched beam search and answers every request of the batch.
+#
+#   python serve.py checkpoint.pth vocab.txt --model_name t5-small --gpu 0
+#   python serve.py t5-small-lcquad2 --gpu 0     (a bundle.py directory)
+#
+#   POST /sparql {"question": "...", "entities": [["Q62408", "Palace of
+#                 Westminster"]], "relations": ["P84"]}
+#             (bare entity ids are labelled from --labels, e.g. an index
+#              built by label_index.py)
+#             or {"input": "<question with masked [DEF] annotations>"}
+#   -> {"sparql": [top beams], "timing": {"queue_ms", "generate_ms",
+#       "total_ms", "batch_size"}}
+#   GET /health (with generation cache hit rates)
+
+parser=argparse.ArgumentParser()
+parser.add_argument('checkpoint',type=str)
+parser.add_argument('vocab',type=str,nargs='?',default=None)
+parser.add_argument('--model_name',type=str,default='t5-small')
+parser.add_argument('--gpu',type=str,default=None)
+add_arguments(parser)
+cpu_backend.add_arguments(parser)
+parser.add_argument('--beam_length',type=int,default=10)
+parser.add_argument('--constrained',action='store_true')
+parser.add_argument('--restrict_vocab',action='store_true')
+parser.add_argument('--staged',action='store_true')
+parser.add_argument('--labels',type=str,default=None)
+parser.add_argument('--cache_entries',type=int,default=10000)
+parser.add_argument('--cache_ttl',type=float,default=None)
+parser.add_argument('--cache_disk',type=str,default=None)
+parser.add_argument('--cache_disk_mb',type=int,default=1024)
+parser.add_argument('--max_batch',type=int,default=16)
+parser.add_argument('--max_wait_ms',type=float,default=10)
+parser.add_argument('--host',type=str,default='0.0.0.0')
+parser.add_argument('--port',type=int,default=8000)
+
+
+class Request:
+    def __init__(self,input):
+        self.input=input
+        self.arrived=time.perf_counter()
+        self.done=threading.Event()
+        self.result=None
+        self.error=None
+
+
+class Batcher:
+    def __init__(self,generator,max_batch=16,max_wait_ms=10):
+        self.generator=generator
+        self.max_batch=max_batch
+        self.max_wait=max_wait_ms/1000
+        self.queue=queue.Queue()
+        self.batches,self.questions=0,0
+        self.worker=threading.Thread(target=self.run,daemon=True)
+        self.worker.start()
+
+    def submit(self,input):
+        request=Request(input)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def collect(self):
+        batch=[self.queue.get()]
+        deadline=batch[0].arrived+self.max_wait
+        while len(batch)<self.max_batch:
+            remaining=deadline-time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining>0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch=self.collect()
+            start=time.perf_counter()
+            try:
+                outputs=self.generator.generate([r.input for r in batch])
+            except Exception as err:
+                for r in batch:
+                    r.error=err
+                    r.done.set()
+                continue
+            end=time.perf_counter()
+            self.batches+=1
+            self.questions+=len(batch)
+            for r,out in zip(batch,outputs):
+                r.result={'sparql':out,'timing':{'queue_ms':1000*(start-r.arrived), \
+                                                 'generate_ms':1000*(end-start), \
+                                                 'total_ms':1000*(end-r.arrived), \
+                                                 'batch_size':len(batch)}}
+                r.done.set()
+
+
+def make_input(body,rewriter):
+    # ValueError for bodies that are not one of the request forms above
+    if not isinstance(body,dict):
+        raise ValueError('the body must be a JSON object')
+    if 'input' in body:
+        if not isinstance(body['input'],str):
+            raise ValueError('"input" must be a string')
+        return body['input']
+    if not isinstance(body.get('question'),str):
+        raise ValueError('"question" must be a string')
+    annotations=[]
+    for ent in body.get('entities',[]):
+        ident,label=(ent,None) if isinstance(ent,str) else ent
+        if not isinstance(ident,str):
+            raise ValueError('entity ids must be strings')
+        if label is None:
+            label=rewriter.labels.get(ident.lower())
+        annotations.append(rewriter.annotation('wd:',ident,label))
+    for rel in body.get('relations',[]):
+        prefix,ident=('wdt:',rel) if isinstance(rel,str) else rel
+        if not isinstance(ident,str):
+            raise ValueError('relation ids must be strings')
+        annotations.append(rewriter.annotation(prefix,ident))
+    question=body['question'].replace('{','').replace('}','')
+    return rewriter.annotate(question,annotations)
+
+
+def handler(batcher,rewriter,describe):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version='HTTP/1.1'
+
+        def reply(self,code,payload):
+            data=json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path!='/health':
+                return self.reply(404,{'error':'not found'})
+            status={'status':'ok','engine':describe,'batches':batcher.batches,'questions':batcher.questions}
+            if batcher.generator.cache is not None:
+                status['cache']=batcher.generator.cache.stats()
+            self.reply(200,status)
+
+        def do_POST(self):
+            if self.path not in ('/','/sparql'):
+                return self.reply(404,{'error':'not found'})
+            try:
+                body=json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+                input=make_input(body,rewriter)
+            except (ValueError,KeyError,TypeError) as err:
+                return self.reply(400,{'error':'bad request: '+str(err)})
+            try:
+                result=batcher.submit(input)
+            except Exception as err:
+                return self.reply(500,{'error':str(err)})
+            result['input']=input
+            self.reply(200,result)
+
+        def log_message(self,format,*args):
+            pass
+
+    return Handler
+
+
+if __name__=='__main__':
+    args=parser.parse_args()
+    if args.gpu is not None:
+        args.device=args.gpu
+    weights=args.checkpoint
+    if bundle.is_bundle(args.checkpoint):
+        args.vocab=args.vocab or bundle.vocab_path(args.checkpoint)
+        weights=bundle.weights_path(args.checkpoint)
+    elif args.vocab is None:
+        parser.error('vocab is required unless checkpoint is a bundle directory')
+    if args.backend!='torch':
+        args.device='cpu'
+        if args.restrict_vocab:
+            parser.error('--restrict_vocab needs --backend torch')
+
+    engine=Engine.from_args(args)
+    print(engine.describe())
+    cache=None
+    if args.cache_entries>0 or args.cache_disk is not None:
+        cache=GenerationCache(namespace(weights,args.model_name,beam=args.beam_length,max_length=100, \
+                                        constrained=args.constrained,restrict_vocab=args.restrict_vocab, \
+                                        staged=args.staged,backend=args.backend), \
+                              args.cache_entries,args.cache_ttl,args.cache_disk,args.cache_disk_mb*2**20)
+    generator=Generator.load(args.model_name,args.checkpoint,args.vocab,engine,beam=args.beam_length, \
+                             constrained=args.constrained,restrict_vocab=args.restrict_vocab,cache=cache, \
+                             backend=args.backend,export_dir=args.export_dir)
+    if args.staged:
+        generator.stager=StagedDecoder(Validator(generator.demasker),args.beam_length)
+    labels={}
+    if args.labels is not None:
+        labels=label_index.load(args.labels)
+    rewriter=Rewriter(load_vocab(args.vocab),labels,{})
+    batcher=Batcher(generator,args.max_batch,args.max_wait_ms)
+
+    server=ThreadingHTTPServer((args.host,args.port),handler(batcher,rewriter,engine.describe()))
+    print('serving on {}:{}'.format(args.host,args.port))
+    server.serve_forever()
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+import torch
+
+from engine import resolve_device
+
+# Sharded test runs for Test_T5.py and Test_BART.py.
+#
+# --shards N splits the test set into N contiguous shards and runs each one
+# in its own worker process with its own copy of the model. On CPU every
+# worker gets --threads intra-op threads (by default the available cores
+# divided by N) and is pinned to its own cores; on GPUs the workers are
+# spread over the visible devices. Workers append their results to
+# <shard_dir>/shard<k>.jsonl after every batch (their output goes to
+# shard<k>.log) and the parent merges the shards, in test set order, into the
+# usual *test_result.json that get_F1.py reads.
+#
+#   python Test_T5.py --test_file test_new_mix.pickle --model_name t5-base --checkpoint T5_train_new_mix_checkpoint40000.pth --shards 16
+#
+# Running the same command again resumes: complete shards are skipped and the
+# others continue after their last written question. The shard directory
+# (--shard_dir, by default the result file's name with _shards) keeps the
+# settings of its run and refuses to mix in shards of another one. --shard k
+# runs a single worker by hand, e.g. on another machine sharing the
+# directory; once its shards are complete the run without --shard merges.
+
+# arguments that do not change the results
+RUNTIME=('shard','shard_dir','threads','device','gen_cache','gen_cache_entries','gen_cache_ttl')
+
+
+def add_arguments(parser):
+    parser.add_argument('--shards',type=int,default=1)
+    parser.add_argument('--shard',type=int,default=None)
+    parser.add_argument('--shard_dir',type=str,default=None)
+
+
+def shard_range(size,shards,shard):
+    return range(size*shard//shards,size*(shard+1)//shards)
+
+
+def shard_path(shard_dir,shard):
+    return os.path.join(shard_dir,'shard{}.jsonl'.format(shard))
+
+
+def prepare(args,result_file):
+    # creates the shard directory or checks that it belongs to this run
+    if args.shard_dir is None:
+        args.shard_dir=os.path.splitext(result_file)[0]+'_shards'
+    os.makedirs(args.shard_dir,exist_ok=True)
+    settings={key:value for key,value in vars(args).items() if key not in RUNTIME}
+    path=os.path.join(args.shard_dir,'settings.json')
+    if os.path.exists(path):
+        file=open(path,'r')
+        saved=json.load(file)
+        file.close()
+        changed=sorted(key for key in set(saved)|set(settings) if saved.get(key)!=settings.get(key))
+        if changed:
+            raise ValueError('{} holds the shards of another run ({} differ); delete {} or pass another --shard_dir' \
+                             .format(args.shard_dir,', '.join(changed),args.shard_dir))
+    else:
+        file=open(path+'.tmp','w')
+        json.dump(settings,file,indent=1,sort_keys=True)
+        file.close()
+        os.replace(path+'.tmp',path)
+    return args.shard_dir
+
+
+def check(parser,args,result_file):
+    # prepare for the Test_* scripts, a mismatch reported as a usage error
+    # before any model is loaded
+    try:
+        return prepare(args,result_file)
+    except ValueError as err:
+        parser.error(str(err))
+
+
+def read_shard(path):
+    # (records, bytes) of the complete lines of a shard file; a line cut
+    # short by a killed worker is not counted
+    records,size=[],0
+    if not os.path.exists(path):
+        return records,size
+    file=open(path,'rb')
+    data=file.read()
+    file.close()
+    for line in data.split(b'\n')[:-1]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            break
+        size+=len(line)+1
+    return records,size
+
+
+class ShardWriter:
+    # appends a shard's results, after the ones an earlier run completed
+    def __init__(self,path):
+        self.path=path
+        records,size=read_shard(path)
+        self.done=len(records)
+        if os.path.exists(path) and os.path.getsize(path)>size:
+            os.truncate(path,size)
+        self.file=open(path,'a')
+
+    def write(self,records):
+        for record in records:
+            self.file.write(json.dumps(record)+'\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def progress(args,size):
+    return sum(min(len(read_shard(shard_path(args.shard_dir,shard))[0]),len(shard_range(size,args.shards,shard))) \
+               for shard in range(args.shards))
+
+
+def launch(args,size,poll=30):
+    # runs the shards that are not complete yet as worker processes of this
+    # script; returns the shards that failed
+    device=resolve_device(args.device)
+    cores=sorted(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else None
+    threads=args.threads
+    if threads is None:
+        threads=max(1,(len(cores) if cores is not None else os.cpu_count() or 1)//args.shards)
+
+    workers={}
+    for shard in range(args.shards):
+        total=len(shard_range(size,args.shards,shard))
+        if len(read_shard(shard_path(args.shard_dir,shard))[0])>=total:
+            print('shard {} complete'.format(shard))
+            continue
+        command=[sys.executable]+sys.argv+['--shard',str(shard),'--shard_dir',args.shard_dir,'--threads',str(threads)]
+        env=dict(os.environ,OMP_NUM_THREADS=str(threads),MKL_NUM_THREADS=str(threads),TOKENIZERS_PARALLELISM='false')
+        pin=None
+        if device.type=='cuda':
+            command+=['--device','cuda:{}'.format(shard%torch.cuda.device_count())]
+        elif device.type=='cpu' and cores is not None and threads*args.shards<=len(cores):
+            pin=set(cores[shard*threads:(shard+1)*threads])
+        log=open(os.path.join(args.shard_dir,'shard{}.log'.format(shard)),'a')
+        process=subprocess.Popen(command,stdout=log,stderr=subprocess.STDOUT,env=env, \
+                                 preexec_fn=(lambda pin=pin:os.sched_setaffinity(0,pin)) if pin else None)
+        workers[shard]=(process,log)
+    if workers:
+        print('{} workers, {} threads each, logs in {}'.format(len(workers),threads,args.shard_dir))
+
+    start=last=time.time()
+    failed=[]
+    while workers:
+        time.sleep(1)
+        for shard in list(workers):
+            process,log=workers[shard]
+            if process.poll() is None:
+                continue
+            log.close()
+            del workers[shard]
+            if process.returncode!=0:
+                failed.append(shard)
+                print('shard {} failed with exit code {}'.format(shard,process.returncode))
+        if time.time()-last>=poll or not workers:
+            last=time.time()
+            print('{}/{} questions, {:.0f} s'.format(progress(args,size),size,last-start))
+    return sorted(failed)
+
+
+def merge(args,size):
+    saver=[]
+    for shard in range(args.shards):
+        records=read_shard(shard_path(args.shard_dir,shard))[0]
+        saver.extend(records[:len(shard_range(size,args.shards,shard))])
+    if len(saver)!=size:
+        raise ValueError('{} has {} of {} results'.format(args.shard_dir,len(saver),size))
+    return saver
+
+
+def run(args,size,result_file):
+    # the parent of a sharded run (after check): workers, then the merged
+    # result file
+    failed=launch(args,size)
+    if failed:
+        sys.exit('shards {} failed, see their logs in {}; run again to resume'.format( \
+                 ', '.join(str(shard) for shard in failed),args.shard_dir))
+    saver=merge(args,size)
+    print('Saving to {}'.format(os.path.join(os.getcwd(),result_file)))
+    file=open(result_file,'w')
+    json.dump(saver,file)
+    file.close()
@@ -0,0 +1,221 @@
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+import requests
+
+# On-disk cache of SPARQL results for get_F1.py.
+#
+# Entries are keyed by the endpoint URL plus the query with whitespace
+# collapsed, so the gold queries and the beam candidates several models
+# share are executed once across runs. Least recently used entries are
+# evicted once the stored results exceed max_bytes; the last-used times of
+# hits are written in batches (with the next insert, every touch_every hits
+# and at close) so reads do not wait on SQLite writes. get(..., max_age)
+# skips results stored more than max_age seconds ago (or by a version of
+# this file that did not record when).
+#
+# Queries the endpoint answers with something other than JSON (syntax
+# errors, rejected queries) are remembered for failure_ttl seconds and
+# timeouts for at most an hour, so bad beam candidates are not sent again
+# on every run; connection errors say nothing about the query and are not
+# kept.
+#
+#   python sparql_cache.py --cache sparql_cache.sqlite --stats
+#   python sparql_cache.py --cache sparql_cache.sqlite --clear [--endpoint URL]
+
+
+def normalize(query):
+    return ' '.join(query.split())
+
+
+def cache_key(endpoint,query):
+    return hashlib.sha1((endpoint+'\n'+normalize(query)).encode('utf-8')).hexdigest()
+
+
+class QueryFailed(Exception):
+    # a query that failed recently, answered from the cache
+    pass
+
+
+class QueryCache:
+    def __init__(self,path,max_bytes=2**30,check_every=100,touch_every=1000,failure_ttl=86400):
+        self.path=path
+        self.max_bytes=max_bytes
+        self.check_every=check_every
+        self.touch_every=touch_every
+        self.failure_ttl=failure_ttl
+        self.hits,self.misses,self.evicted,self.expired=0,0,0,0
+        self.failure_hits=0
+        self.inserts=0
+        self.touched={}
+        self.lock=threading.Lock()
+        self.db=sqlite3.connect(path,timeout=60,check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, endpoint TEXT, '
+                        'result TEXT, size INTEGER, used REAL, stored REAL)')
+        if 'stored' not in [row[1] for row in self.db.execute('PRAGMA table_info(results)')]:
+            # caches written before results recorded when they were stored
+            self.db.execute('ALTER TABLE results ADD COLUMN stored REAL')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS failures (key TEXT PRIMARY KEY, endpoint TEXT, '
+                        'error TEXT, expires REAL)')
+        self.db.commit()
+
+    def get(self,endpoint,query,max_age=None):
+        key=cache_key(endpoint,query)
+        with self.lock:
+            row=self.db.execute('SELECT result, stored FROM results WHERE key=?',(key,)).fetchone()
+            if row is not None and max_age is not None and (row[1] is None or time.time()-row[1]>max_age):
+                self.expired+=1
+                row=None
+            if row is None:
+                self.misses+=1
+                return None
+            self.hits+=1
+            self.touched[key]=time.time()
+            if len(self.touched)>=self.touch_every:
+                self._touch()
+                self.db.commit()
+        return json.loads(row[0])
+
+    def _touch(self):
+        # writes the pending last-used times (the caller commits)
+        if self.touched:
+            self.db.executemany('UPDATE results SET used=? WHERE key=?', \
+                                [(used,key) for key,used in self.touched.items()])
+            self.touched={}
+
+    def put(self,endpoint,query,result):
+        key=cache_key(endpoint,query)
+        text=json.dumps(result)
+        with self.lock:
+            self._touch()
+            now=time.time()
+            self.db.execute('INSERT OR REPLACE INTO results (key, endpoint, result, size, used, stored) '
+                            'VALUES (?,?,?,?,?,?)',(key,endpoint,text,len(text),now,now))
+            self.db.commit()
+            self.inserts+=1
+            if self.inserts%self.check_every==0:
+                self._evict()
+
+    def failure(self,endpoint,query):
+        # the error of a query that failed and has not expired yet, else None
+        if not self.failure_ttl:
+            return None
+        key=cache_key(endpoint,query)
+        with self.lock:
+            row=self.db.execute('SELECT error, expires FROM failures WHERE key=?',(key,)).fetchone()
+            if row is None or row[1]<time.time():
+                return None
+            self.failure_hits+=1
+        return row[0]
+
+    def put_failure(self,endpoint,query,error,ttl=None):
+        ttl=self.failure_ttl if ttl is None else min(ttl,self.failure_ttl)
+        if not ttl:
+            return
+        key=cache_key(endpoint,query)
+        with self.lock:
+            self._touch()
+            self.db.execute('INSERT OR REPLACE INTO failures VALUES (?,?,?,?)', \
+                            (key,endpoint,error,time.time()+ttl))
+            self.db.commit()
+
+    def size(self):
+        row=self.db.execute('SELECT COUNT(*), COALESCE(SUM(size),0) FROM results').fetchone()
+        return row[0],row[1]
+
+    def _evict(self):
+        # drop least recently used results down to 90% of the budget, and
+        # expired failures
+        self.db.execute('DELETE FROM failures WHERE expires<?',(time.time(),))
+        count,total=self.size()
+        if total<=self.max_bytes:
+            return
+        target=total-int(0.9*self.max_bytes)
+        self._touch()
+        freed=0
+        for key,size in self.db.execute('SELECT key, size FROM results ORDER BY used').fetchall():
+            if freed>=target:
+                break
+            self.db.execute('DELETE FROM results WHERE key=?',(key,))
+            freed+=size
+            self.evicted+=1
+        self.db.commit()
+
+    def clear(self,endpoint=None):
+        with self.lock:
+            self.touched={}
+            if endpoint is None:
+                cur=self.db.execute('DELETE FROM results')
+                self.db.execute('DELETE FROM failures')
+            else:
+                cur=self.db.execute('DELETE FROM results WHERE endpoint=?',(endpoint,))
+                self.db.execute('DELETE FROM failures WHERE endpoint=?',(endpoint,))
+            self.db.commit()
+        return cur.rowcount
+
+    def stats(self):
+        count,total=self.size()
+        lookups=self.hits+self.misses
+        rate=100*self.hits/lookups if lookups else 0.0
+        return 'cache hits={}, misses={}, hit rate={:.1f}%, failed query hits={}, expired={}, evicted={}, entries={}, ' \
+            'size={:.1f} MiB'.format(self.hits,self.misses,rate,self.failure_hits,self.expired,self.evicted,count,total/2**20)
+
+    def close(self):
+        with self.lock:
+            self._touch()
+            self._evict()
+            self.db.commit()
+            self.db.close()
+
+
+class CachedEndpoint:
+    # Endpoint.query with results served from / stored to a QueryCache.
+    def __init__(self,endpoint,cache):
+        self.endpoint=endpoint
+        self.cache=cache
+        self.url=endpoint.url
+
+    def query(self,query):
+        result=self.cache.get(self.url,query)
+        if result is not None:
+            return result
+        error=self.cache.failure(self.url,query)
+        if error is not None:
+            raise QueryFailed(error)
+        try:
+            result=self.endpoint.query(query)
+        except ValueError as err:
+            # not JSON: the endpoint rejected the query
+            self.cache.put_failure(self.url,query,'{}: {}'.format(type(err).__name__,err))
+            raise
+        except requests.exceptions.Timeout as err:
+            self.cache.put_failure(self.url,query,'{}: {}'.format(type(err).__name__,err),3600)
+            raise
+        self.cache.put(self.url,query,result)
+        return result
+
+    def close(self):
+        self.endpoint.close()
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--cache',type=str,default='sparql_cache.sqlite')
+    parser.add_argument('--clear',action='store_true')
+    parser.add_argument('--endpoint',type=str,default=None)
+    parser.add_argument('--stats',action='store_true')
+    args=parser.parse_args()
+
+    cache=QueryCache(args.cache)
+    if args.clear:
+        print('removed {} cached results'.format(cache.clear(args.endpoint)))
+    if args.stats or not args.clear:
+        count,total=cache.size()
+        print('{}: {} cached results, {:.1f} MiB'.format(args.cache,count,total/2**20))
+    cache.close()
@@ -0,0 +1,179 @@
+import hashlib
+
+from triple_store import parse, QueryError
+from sparql_decoder import Demasker
+
+# Structural equivalence of SPARQL queries, without an endpoint.
+#
+# A query is parsed with the triple_store.py parser, prefixed names are
+# expanded, triple patterns and filters are sorted, variables are renamed in
+# order of first use over the sorted patterns, and the result is printed as
+# one canonical string. Queries that differ only in pattern order, variable
+# names or spacing get the same string; queries that do not parse get None.
+
+
+def _term(t,names):
+    if t[0]=='var':
+        return '?'+names.get(t[1],'_')
+    return t[1]
+
+
+def _value(v):
+    if v[0]=='uri':
+        return '<'+v[1]+'>'
+    return '"'+v[1]+'"@'+v[2]+'^^'+str(v[3])
+
+
+def _expr(e,names):
+    kind=e[0]
+    if kind=='var':
+        return '?'+names.get(e[1],'_')
+    if kind=='value':
+        return _value(e[1])
+    if kind=='not':
+        return '!('+_expr(e[1],names)+')'
+    if kind in ('and','or'):
+        # flatten and sort the operands of && and ||
+        parts=[]
+        stack=[e]
+        while stack:
+            x=stack.pop()
+            if x[0]==kind:
+                stack.extend(x[1:])
+            else:
+                parts.append(_expr(x,names))
+        return '('+(' && ' if kind=='and' else ' || ').join(sorted(parts))+')'
+    if kind=='cmp':
+        op,a,b=e[1],_expr(e[2],names),_expr(e[3],names)
+        if op in ('=','!='):
+            a,b=sorted((a,b))
+        elif op in ('>','>='):
+            op,a,b={'>':'<','>=':'<='}[op],b,a
+        return '('+a+' '+op+' '+b+')'
+    return e[1]+'('+','.join(_expr(a,names) for a in e[2])+')'
+
+
+def _rename(q,names):
+    patterns=sorted(' '.join(_term(t,names) for t in pat) for pat in q['patterns'])
+    filters=sorted(_expr(f,names) for f in q['filters'])
+    return patterns,filters
+
+
+def _first_use(q,names):
+    # variable order by first appearance in the sorted patterns and filters
+    keyed=sorted(q['patterns'],key=lambda pat:' '.join(_term(t,names) for t in pat))
+    order=[]
+    for pat in keyed:
+        for t in pat:
+            if t[0]=='var' and t[1] not in order:
+                order.append(t[1])
+    for f in sorted(q['filters'],key=lambda f:_expr(f,names)):
+        for v in _expr_vars(f):
+            if v not in order:
+                order.append(v)
+    for p in q['projection']:
+        for v in p[1:2]+p[3:4]:
+            if isinstance(v,str) and v not in order:
+                order.append(v)
+    return {v:'v'+str(i) for i,v in enumerate(order)}
+
+
+def _expr_vars(e):
+    if e[0]=='var':
+        return [e[1]]
+    out=[]
+    for part in e[1:]:
+        for x in (part if isinstance(part,list) else [part]):
+            if isinstance(x,tuple):
+                out.extend(_expr_vars(x))
+    return out
+
+
+def canonical_form(q):
+    # Names start out blank, so the first sort is by constants only; renaming
+    # and re-sorting is repeated until the naming no longer changes.
+    names={}
+    for _ in range(4):
+        new=_first_use(q,names)
+        if new==names:
+            break
+        names=new
+    patterns,filters=_rename(q,names)
+    projection=[]
+    for p in q['projection']:
+        if p[0]=='var':
+            projection.append('?'+names[p[1]])
+        elif p[0]=='all':
+            projection.append('*')
+        else:
+            arg='*' if p[1] is None else '?'+names.get(p[1],'_')
+            projection.append('(count('+('distinct ' if p[2] else '')+arg+') as ?'+names[p[3]]+')')
+    parts=[q['form']]
+    if q['distinct']:
+        parts.append('distinct')
+    parts.append(' '.join(sorted(projection)))
+    parts.append('{ '+' . '.join(patterns)+(' . ' if patterns and filters else '')+ \
+                 ' . '.join('filter'+f for f in filters)+' }')
+    if q['order']:
+        parts.append('order by '+' '.join(('desc' if desc else 'asc')+'('+_expr(e,names)+')' \
+                                         for e,desc in q['order']))
+    if q['limit'] is not None:
+        parts.append('limit '+str(q['limit']))
+    if q['offset']:
+        parts.append('offset '+str(q['offset']))
+    return ' '.join(parts)
+
+
+def canonical(sparql):
+    try:
+        return canonical_form(parse(sparql))
+    except (QueryError,KeyError):
+        return None
+
+
+def fingerprint(sparql):
+    form=canonical(sparql)
+    if form is None:
+        return None
+    return hashlib.sha1(form.encode('utf-8')).hexdigest()
+
+
+def equivalent(a,b):
+    form=canonical(a)
+    return form is not None and form==canonical(b)
+
+
+def structmatch(target,predictions,demasker,prefix=''):
+    # endpoint-free proxy of get_F1's query match on readable SPARQL: the
+    # first prediction that parses must be the gold query up to triple
+    # order, variable names and spacing. Returns (match, target, prediction,
+    # rank) like get_F1.querymatch, the queries with prefix in front
+    target=demasker.executable(target)
+    form=canonical(target)
+    for l,prediction in enumerate(predictions):
+        prediction=demasker.executable(prediction)
+        answer=canonical(prediction)
+        if answer is None:
+            continue
+        elif answer==form:
+            return True,prefix+target,prefix+prediction,l+1
+        else:
+            return False,None,None,None
+    return False,None,None,None
+
+
+class Matcher:
+    # Equivalence of masked model output (<extra_id_N> tokens) and gold
+    # targets. Text that does not parse falls back to comparing it with all
+    # spaces removed, the check validation used before.
+    def __init__(self,vocab):
+        self.demasker=Demasker(vocab)
+
+    def canonical(self,masked):
+        return canonical(self.demasker.executable(self.demasker.clean(masked)))
+
+    def match(self,generated,gold):
+        a,b=self.canonical(generated),self.canonical(gold)
+        if a is not None and b is not None:
+            return a==b
+        return self.demasker.clean(generated).replace(' ','')==self.demasker.clean(gold).replace(' ','')
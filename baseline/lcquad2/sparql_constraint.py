@@ -0,0 +1,130 @@
+import re
+
+import torch
+from transformers import LogitsProcessor
+
+from triple_store import Parser, QueryError
+from sparql_decoder import Demasker
+
+# Grammar-constrained decoding for masked SPARQL (PICARD-style).
+#
+# At every step the top_k candidate tokens of each beam are checked by
+# de-masking the beam's prefix plus the candidate and running the
+# triple_store.py parser over it: running out of input is fine, failing on
+# a token is not, and end-of-sequence needs a complete query. All other
+# tokens are masked out. A beam none of whose top_k tokens is valid gets the
+# best valid one among the top widen_k, and when there is none either it may
+# only end (end-of-sequence), so no row of scores is all -inf and beam
+# search keeps its num_return_sequences hypotheses.
+
+INVALID,INCOMPLETE,COMPLETE=0,1,2
+
+_OPEN_QUOTE_RE=re.compile(r"^['\"][^'\"]*$")
+_PARTIAL_NUMBER_RE=re.compile(r'(?:[+-]|[0-9][eE][+-]?|[0-9] \.)$')
+
+
+class PrefixChecker:
+    def __init__(self,demasker):
+        self.demasker=demasker
+        self.cache={}
+
+    def state(self,readable):
+        result=self.cache.get(readable)
+        if result is None:
+            result=self.cache[readable]=self._state(readable)
+        return result
+
+    def _state(self,readable):
+        result=self._parse(self.demasker.executable(readable))
+        if result==INVALID and _PARTIAL_NUMBER_RE.search(readable):
+            # '-', '2e', '1 .' may still become numbers ('1 . 5' is 1.5)
+            digit=' 0' if readable.endswith('.') else '0'
+            if self._parse(self.demasker.executable(readable+digit))!=INVALID:
+                return INCOMPLETE
+        return result
+
+    def _parse(self,sparql):
+        try:
+            parser=Parser(sparql)
+        except QueryError:
+            # only an unterminated literal at the end can still be completed
+            tail=sparql[sparql.rfind("'") if "'" in sparql else len(sparql):]
+            if _OPEN_QUOTE_RE.match(tail) and self._parse(sparql[:len(sparql)-len(tail)]+"''")!=INVALID:
+                return INCOMPLETE
+            return INVALID
+        try:
+            parser.parse()
+        except QueryError:
+            if parser.pos>=len(parser.tokens):
+                return INCOMPLETE
+            return INVALID
+        return COMPLETE
+
+
+class SparqlLogitsProcessor(LogitsProcessor):
+    def __init__(self,tokenizer,vocab,top_k=4,widen_k=64):
+        self.tokenizer=tokenizer
+        self.demasker=Demasker(vocab)
+        self.checker=PrefixChecker(self.demasker)
+        self.top_k=top_k
+        self.widen_k=max(widen_k,top_k)
+        masks,skip=self.demasker.id_table(tokenizer)
+        self.pieces={idx:' '+text+' ' for idx,text in masks.items()}
+        for idx in skip:
+            self.pieces[idx]=''
+        self.eos=tokenizer.eos_token_id
+        self.special=skip-set([self.eos])
+        self.texts={}
+
+    def piece(self,idx):
+        text=self.pieces.get(idx)
+        if text is None:
+            tok=self.tokenizer.convert_ids_to_tokens(idx)
+            text=self.tokenizer.convert_tokens_to_string([tok])
+            if tok.startswith('▁') and not text.startswith(' '):
+                text=' '+text
+            self.pieces[idx]=text
+        return text
+
+    def text(self,prefix,texts):
+        # raw de-masked text of a prefix, extended from last step's prefixes
+        key=tuple(prefix)
+        text=self.texts.get(key[:-1])
+        if text is None:
+            text=''.join(self.piece(idx) for idx in key)
+        else:
+            text+=self.piece(key[-1])
+        texts[key]=text
+        return text
+
+    def allowed(self,text,idx):
+        if idx in self.special:
+            return False
+        if idx==self.eos:
+            return self.checker.state(self.demasker.readable(text))==COMPLETE
+        return self.checker.state(self.demasker.readable(text+self.piece(idx)))!=INVALID
+
+    def __call__(self,input_ids,scores):
+        if len(self.checker.cache)>100000:
+            self.checker.cache.clear()
+        k=min(self.top_k,scores.shape[-1])
+        top=scores.topk(min(self.widen_k,scores.shape[-1]),dim=-1).indices.tolist()
+        mask=torch.full_like(scores,float('-inf'))
+        texts={}
+        for row,prefix in enumerate(input_ids.tolist()):
+            text=self.text(prefix,texts)
+            found=False
+            for idx in top[row][:k]:
+                if self.allowed(text,idx):
+                    mask[row,idx]=0
+                    found=True
+            if not found:
+                for idx in top[row][k:]:
+                    if self.allowed(text,idx):
+                        mask[row,idx]=0
+                        found=True
+                        break
+            if not found and self.eos is not None:
+                mask[row,self.eos]=0
+        self.texts=texts
+        return scores+mask
@@ -0,0 +1,105 @@
+import re
+
+from sparql_rewriter import load_vocab
+
+# Single-pass de-masking of generated <extra_id_N> SPARQL.
+#
+# readable() reproduces the Test_T5/Test_BART post-processing (masks back to
+# SPARQL tokens, q/p ids upper-cased) in one compiled scan instead of a
+# replace per vocab entry, and executable() the get_F1.change spacing fixes.
+# decode_ids() works straight from generated token ids.
+
+_MASK_RE=re.compile(r'<extra_id_(\d+)>')
+_DIGITS=frozenset('0123456789')
+_SPECIAL=('<pad>','</s>','<unk>','<s>')
+_SPECIAL_RE=re.compile('|'.join(re.escape(s) for s in _SPECIAL))
+
+_DECIMAL_RE=re.compile(r'[0-9] \. [0-9]')
+
+
+class Demasker:
+    def __init__(self,vocab):
+        self.vocab=vocab
+
+    @classmethod
+    def from_file(cls,path='vocab.txt'):
+        return cls(load_vocab(path))
+
+    def _mask(self,m):
+        n=int(m.group(1))
+        if n<len(self.vocab):
+            return ' '+self.vocab[n]+' '
+        return m.group(0)
+
+    def _token(self,tok):
+        # q123 -> Q123, p123 -> P123 (a digit must follow the letter)
+        if len(tok)>1 and (tok[0]=='q' or tok[0]=='p') and tok[1] in _DIGITS:
+            return tok[0].upper()+tok[1:]
+        return tok
+
+    def readable(self,string):
+        return ' '.join(self._token(tok) for tok in _MASK_RE.sub(self._mask,string).split())
+
+    def clean(self,string):
+        # generated text still carries the tokenizer's special tokens
+        return self.readable(_SPECIAL_RE.sub('',string))
+
+    def executable(self,string):
+        # get_F1.change: join prefixes to ids and brackets, quotes and commas
+        # to their neighbours. Each replace feeds the next (' , ' leaves the
+        # ", '" the following one joins), and a chain of C-level replaces is
+        # faster here than one regex scan with a Python callback.
+        string=string.replace('  ',' ').replace('( ','(').replace(' )',')') \
+        .replace('{ ',' {'). \
+        replace(' }','}').replace('wd: ','wd:').replace('wdt: ','wdt:'). \
+        replace(' p: ',' p:').replace(' ps: ',' ps:').replace('pq: ','pq:'). \
+        replace(' , ',', ').replace(", '",",'").replace(" ' ","'").replace("' ","'"). \
+        replace(" '","'").replace(' = ', '=').strip()
+
+        for dec in _DECIMAL_RE.findall(string):
+            string=string.replace(dec,dec.replace(' . ','.'))
+        return string
+
+    def batch_readable(self,strings):
+        return [self.clean(s) for s in strings]
+
+    def batch_executable(self,strings):
+        return [self.executable(s) for s in strings]
+
+    def id_table(self,tokenizer):
+        # token id -> vocab text for every <extra_id_N> in the vocabulary,
+        # and the special ids generation pads/terminates with
+        table={}
+        for n,text in enumerate(self.vocab):
+            idx=tokenizer.convert_tokens_to_ids('<extra_id_'+str(n)+'>')
+            if idx is not None and idx!=tokenizer.unk_token_id:
+                table[idx]=text
+        skip=set(i for i in (tokenizer.pad_token_id,tokenizer.eos_token_id, \
+                             tokenizer.bos_token_id,tokenizer.unk_token_id) if i is not None)
+        return table,skip
+
+    def decode_ids(self,sequences,tokenizer,table=None):
+        # Runs of ordinary ids (ids, literals) go through the tokenizer;
+        # mask ids are looked up directly.
+        if table is None:
+            table=self.id_table(tokenizer)
+        masks,skip=table
+        out=[]
+        for seq in sequences:
+            if hasattr(seq,'tolist'):
+                seq=seq.tolist()
+            parts,run=[],[]
+            for idx in seq:
+                if idx in skip:
+                    continue
+                if idx in masks:
+                    if run:
+                        parts.append(tokenizer.decode(run))
+                        run=[]
+                    parts.append(masks[idx])
+                else:
+                    run.append(idx)
+            if run:
+                parts.append(tokenizer.decode(run))
+            out.append(' '.join(self._token(tok) for tok in ' '.join(parts).split()))
+        return out
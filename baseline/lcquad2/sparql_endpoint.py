@@ -0,0 +1,31 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Pooled keep-alive client for the SPARQL endpoint get_F1.py scores against.
+#
+# One Session is shared by all evaluation threads; its connection pool is
+# sized to the number of in-flight queries, and connection errors and 5xx
+# answers are retried with backoff before a query counts as failed.
+
+DEFAULT_URL='http://ltcpu3:8890/sparql'
+
+
+class Endpoint:
+    def __init__(self,url=DEFAULT_URL,timeout=60,retries=2,pool_size=1):
+        self.url=url
+        self.timeout=timeout
+        retry=Retry(total=retries,backoff_factor=0.5,status_forcelist=(500,502,503,504), \
+                    allowed_methods=('GET',))
+        adapter=HTTPAdapter(pool_connections=1,pool_maxsize=max(pool_size,1),max_retries=retry)
+        self.session=requests.Session()
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+
+    def query(self,query):
+        # parsed JSON result; raises on network errors, timeouts and bad JSON
+        r=self.session.get(self.url,params={'format':'json','query':query},timeout=self.timeout)
+        return r.json()
+
+    def close(self):
+        self.session.close()
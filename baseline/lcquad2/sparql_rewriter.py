@@ -0,0 +1,139 @@
+import re
+
+# Single-pass lexer/rewriter for LC-QuAD 2.0 `sparql_wikidata` queries.
+#
+# Produces exactly what the original replace/findall chain in preprocess.py
+# produced: the <extra_id_N> masked target, the [DEF] annotations appended
+# to the question and the literal map, from one scan over the query.
+
+PREFIX='prefix'
+ENTITY='entity'
+RELATION='relation'
+LITERAL='literal'
+VARIABLE='variable'
+KEYWORD='keyword'
+OTHER='other'
+
+ENTITY_PREFIXES=('wd:',)
+RELATION_PREFIXES=('wdt:','p:','ps:','pq:')
+
+_TOKEN_RE=re.compile(r"""
+      '(?P<literal>.*?)'
+    | (?P<prefix>(?:wdt|wd|pq|ps|p):)
+    | (?P<punct>[(){},.='])
+    | (?P<word>[^\s(){},.=']+)
+    | \s+
+""",re.VERBOSE|re.IGNORECASE)
+
+
+def load_vocab(path='vocab.txt'):
+    file=open(path,'r')
+    vocab=[line.strip() for line in file.readlines()]
+    file.close()
+    vocab.append('null')
+    return vocab
+
+
+def mask_dict(vocab):
+    return {text:'<extra_id_'+str(i)+'>' for i,text in enumerate(vocab)}
+
+
+def lex(sparql):
+    # Yields (type, text) pairs. Everything but literal bodies is lowercased,
+    # and the id following a prefix is typed as an entity or relation.
+    after=None
+    for m in _TOKEN_RE.finditer(sparql):
+        kind=m.lastgroup
+        if kind is None:
+            continue
+        if kind=='literal':
+            after=None
+            yield KEYWORD,"'"
+            yield LITERAL,m.group('literal').strip()
+            yield KEYWORD,"'"
+            continue
+        text=m.group(kind).lower()
+        if kind=='prefix':
+            after=ENTITY if text in ENTITY_PREFIXES else RELATION
+            yield PREFIX,text
+        elif after is not None:
+            yield after,text
+            after=None
+        elif text[0]=='?':
+            yield VARIABLE,text
+        elif kind=='punct':
+            yield KEYWORD,text
+        else:
+            yield OTHER,text
+
+
+class Rewriter:
+    def __init__(self,vocab,labels,rel_labels):
+        self.vocab_dict=mask_dict(vocab)
+        self.labels=labels
+        self.rel_labels=rel_labels
+        self.null=self.vocab_dict['null']
+        self.newvars=['?vr0','?vr1','?vr2','?vr3','?vr4','?vr5']
+
+    def rename(self,variables):
+        # Variables are renamed in sorted order by sequential substring
+        # replacement, so '?sbj_label' follows '?sbj' to '?vr0_label'.
+        chain=[(var,self.newvars[idx]) for idx,var in enumerate(sorted(variables)) \
+               if var!='?maskvar1']
+        renamed={}
+        for var in variables:
+            new=var
+            for old,rep in chain:
+                new=new.replace(old,rep)
+            renamed[var]=new
+        return renamed
+
+    def rewrite(self,sparql):
+        # Returns (target, annotations, literals).
+        tokens=list(lex(sparql))
+        variables=set()
+        ents,rels=[],{p:[] for p in RELATION_PREFIXES}
+        literals={}
+        prefix=None
+        for kind,text in tokens:
+            if kind==PREFIX:
+                prefix=text
+            elif kind==ENTITY:
+                if '}' in text:
+                    ents.append(self.labels[text]+' ')
+                else:
+                    ents.append(self.annotation(prefix,text,self.labels[text]))
+            elif kind==RELATION:
+                # relations.json is keyed 'P123' while ids are lowercased here,
+                # so relations are annotated with the null label; the released
+                # checkpoints were trained on that.
+                rels[prefix].append(self.annotation(prefix,text,self.rel_labels.get(text)))
+            elif kind==VARIABLE:
+                variables.add(text)
+            elif kind==LITERAL:
+                literals['###'+str(len(literals)+1)]=text
+
+        renamed=self.rename(variables)
+        out=[]
+        for kind,text in tokens:
+            if kind==VARIABLE:
+                text=renamed[text]
+            if kind!=LITERAL:
+                text=self.vocab_dict.get(text,text)
+            out.append(text)
+        for p in RELATION_PREFIXES:
+            ents+=rels[p]
+        return ' '.join(out).strip(),ents,literals
+
+    def annotation(self,prefix,ident,label=None):
+        # one [DEF] entry; ' p:' and ' ps:' were matched with their leading
+        # space, and a missing label is the null mask
+        lead=' ' if prefix in ('p:','ps:') else ''
+        if label is None:
+            label=self.null
+        return lead+self.vocab_dict[prefix]+'  '+ident.lower()+' '+label+' '
+
+    def annotate(self,question,annotations):
+        for ann in annotations:
+            question=question+' '+self.vocab_dict['[DEF]']+' '+ann
+        return question.strip()
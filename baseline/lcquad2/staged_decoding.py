@@ -0,0 +1,95 @@
+import re
+import time
+from collections import Counter
+
+from triple_store import parse, QueryError
+
+# Greedy-first decoding with beam search as a fallback.
+#
+# A batch is decoded greedily; an output is accepted when it parses as
+# SPARQL, every Q/P id in it is one of the input's [DEF] annotations and,
+# with an endpoint, it returns a non-empty result. Only the rejected inputs
+# are decoded again with the full beam, so accepted ones carry a single
+# candidate instead of beam_length.
+
+_INPUT_ID_RE=re.compile(r'(?<![\w:])([qp][0-9]+)\b')
+_OUTPUT_ID_RE=re.compile(r'\b([QqPp][0-9]+)\b')
+
+PREFIXES='PREFIX p: <http://www.wikidata.org/prop/> PREFIX pq: <http://www.wikidata.org/prop/qualifier/> ' \
+         'PREFIX ps: <http://www.wikidata.org/prop/statement/> PREFIX wd: <http://www.wikidata.org/entity/> ' \
+         'PREFIX wds: <http://www.wikidata.org/entity/statement/> PREFIX wdt: <http://www.wikidata.org/prop/direct/> '
+
+
+def annotated_ids(input):
+    return set(_INPUT_ID_RE.findall(input.lower()))
+
+
+def non_empty(result):
+    if not result:
+        return False
+    if 'boolean' in result:
+        return True
+    bindings=result.get('results',{}).get('bindings',[])
+    return bool(bindings) and {} not in bindings
+
+
+class Validator:
+    def __init__(self,demasker,endpoint=None):
+        self.demasker=demasker
+        self.endpoint=endpoint
+
+    def check(self,output,input):
+        # None when the greedy output is acceptable, else the reason
+        sparql=self.demasker.executable(output)
+        try:
+            parse(sparql)
+        except QueryError:
+            return 'parse'
+        if not set(i.lower() for i in _OUTPUT_ID_RE.findall(output))<=annotated_ids(input):
+            return 'ids'
+        if self.endpoint is not None:
+            try:
+                if not non_empty(self.endpoint.query(PREFIXES+sparql)):
+                    return 'empty'
+            except Exception:
+                return 'kg'
+        return None
+
+
+class StagedDecoder:
+    def __init__(self,validator,beam=10):
+        self.validator=validator
+        self.beam=beam
+        self.greedy,self.escalated=0,0
+        self.reasons=Counter()
+        self.greedy_ms,self.check_ms,self.beam_ms=0.0,0.0,0.0
+
+    def decode(self,inputs,fn):
+        # fn(positions, num_beams) returns the beams of inputs[positions]
+        start=time.perf_counter()
+        out=fn(list(range(len(inputs))),1)
+        checked=time.perf_counter()
+        failed=[]
+        for k in range(len(inputs)):
+            reason=self.validator.check(out[k][0],inputs[k])
+            if reason is not None:
+                self.reasons[reason]+=1
+                failed.append(k)
+        escalated=time.perf_counter()
+        if failed:
+            for k,beams in zip(failed,fn(failed,self.beam)):
+                out[k]=beams
+        end=time.perf_counter()
+
+        self.greedy+=len(inputs)
+        self.escalated+=len(failed)
+        self.greedy_ms+=1000*(checked-start)
+        self.check_ms+=1000*(escalated-checked)
+        self.beam_ms+=1000*(end-escalated)
+        return out
+
+    def report(self):
+        reasons=', '.join('{}={}'.format(r,n) for r,n in sorted(self.reasons.items())) or 'none'
+        return 'staged decoding: greedy={} ({:.0f} ms), accepted={}, beam search={} ({:.0f} ms), ' \
+               'validation {:.0f} ms, rejected: {}'.format(self.greedy,self.greedy_ms,self.greedy-self.escalated, \
+                                                           self.escalated,self.beam_ms,self.check_ms,reasons)
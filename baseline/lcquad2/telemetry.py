@@ -0,0 +1,169 @@
+import json
+import time
+import signal
+import contextlib
+
+import torch
+
+# Per-step telemetry for the Train_* loops.
+#
+# With --telemetry run.jsonl every training step writes one JSON line: the
+# milliseconds spent in each phase (data: sampling, tokenization and copy to
+# the device; forward; backward; optimizer), the wall time of the whole step,
+# real and padded tokens, padding ratio, tokens/s, loss, learning rate and
+# the peak memory so far. Validation runs write a 'validation' line with
+# their data/generate split. The first line describes the run, the last one
+# sums up each phase's share of the time, which tells an input-bound run
+# (data) from a compute-bound one.
+#
+# On GPUs each phase synchronizes the device so kernels are charged to the
+# phase that launched them; without --telemetry nothing is timed or synced.
+#
+# --profile_at 1000,20000 records --profile_steps steps from each of those
+# steps with torch.profiler into --profile_dir (TensorBoard/Chrome traces);
+# kill -USR1 <pid> does the same from the next step of a running job.
+
+
+def add_arguments(parser):
+    parser.add_argument('--telemetry',type=str,default=None)
+    parser.add_argument('--profile_at',type=str,default=None)
+    parser.add_argument('--profile_steps',type=int,default=5)
+    parser.add_argument('--profile_dir',type=str,default='profiles')
+
+
+def tokens(input):
+    # (real, padded) tokens of an encoded batch, inputs plus labels
+    real=int(input['attention_mask'].sum())+int((input['labels']!=-100).sum())
+    return real,input['input_ids'].numel()+input['labels'].numel()
+
+
+class Telemetry:
+    def __init__(self,path,engine,info=None,profile_at=None,profile_steps=5,profile_dir='profiles'):
+        self.engine=engine
+        self.sync=engine.device.type=='cuda'
+        self.file=open(path,'a',buffering=1) if path is not None else None
+        self.enabled=self.file is not None
+        self.times={}
+        self.totals={}
+        self.real,self.padded=0,0
+        self.last=time.perf_counter()
+        self.started=self.last
+        self.paused=None
+        self.profile_at=set(profile_at or [])
+        self.profile_steps=profile_steps
+        self.profile_dir=profile_dir
+        self.profiler=None
+        self.profile_left=0
+        self.profile_requested=False
+        if self.profile_at or self.enabled:
+            if hasattr(signal,'SIGUSR1'):
+                signal.signal(signal.SIGUSR1,self.request_profile)
+        if self.enabled:
+            self.write(dict({'event':'run','time':time.strftime('%Y-%m-%d %H:%M:%S'), \
+                             'device':str(engine.device),'threads':engine.threads},**(info or {})))
+
+    @classmethod
+    def from_args(cls,args,engine,**info):
+        profile_at=[int(s) for s in args.profile_at.split(',')] if args.profile_at else None
+        return cls(args.telemetry,engine,info,profile_at,args.profile_steps,args.profile_dir)
+
+    def write(self,record):
+        self.file.write(json.dumps(record)+'\n')
+
+    def request_profile(self,signum=None,frame=None):
+        self.profile_requested=True
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        if not self.enabled:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.engine.device)
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize(self.engine.device)
+            self.times[name]=self.times.get(name,0.0)+time.perf_counter()-start
+
+    def batch(self,input):
+        if self.enabled:
+            real,padded=tokens(input)
+            self.real+=real
+            self.padded+=padded
+
+    def flush(self,event,phases=None,**fields):
+        # writes the given phases (all when None) and forgets them
+        if not self.enabled:
+            return
+        names=list(self.times) if phases is None else [p for p in phases if p in self.times]
+        record={'event':event}
+        record.update(fields)
+        for name in names:
+            seconds=self.times.pop(name)
+            self.totals[name]=self.totals.get(name,0.0)+seconds
+            record[name+'_ms']=1000*seconds
+        record['peak_memory_mb']=self.engine.peak_memory()/2**20
+        self.write(record)
+
+    def step(self,step,loss=None,lr=None):
+        # end of a training step: its record, and the profiler schedule
+        if self.enabled:
+            now=time.perf_counter()
+            elapsed=now-self.last
+            self.last=now
+            ratio=1-self.real/self.padded if self.padded else None
+            self.flush('step',step=step,step_ms=1000*elapsed,tokens=self.real,padded_tokens=self.padded, \
+                       padding_ratio=ratio,tokens_per_sec=self.real/elapsed if elapsed else None,loss=loss,lr=lr)
+            self.real,self.padded=0,0
+        self.profile(step)
+
+    def pause(self):
+        # validation and checkpoints inside a step do not count to its time
+        self.paused=time.perf_counter()
+
+    def resume(self):
+        if self.paused is not None:
+            self.last+=time.perf_counter()-self.paused
+            self.paused=None
+
+    def profile(self,step):
+        if self.profiler is not None:
+            self.profiler.step()
+            self.profile_left-=1
+            if self.profile_left<=0:
+                self.profiler.stop()
+                self.profiler=None
+                print('profile of steps {}-{} written to {}'.format(step-self.profile_steps+1,step,self.profile_dir))
+            return
+        if step+1 in self.profile_at or self.profile_requested:
+            self.profile_requested=False
+            activities=[torch.profiler.ProfilerActivity.CPU]
+            if self.engine.device.type=='cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler=torch.profiler.profile(activities=activities,record_shapes=True,profile_memory=True, \
+                                                 on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profile_dir))
+            self.profiler.start()
+            self.profile_left=self.profile_steps
+
+    def summary(self):
+        # share of the timed phases so far
+        totals=dict(self.totals)
+        for name,seconds in self.times.items():
+            totals[name]=totals.get(name,0.0)+seconds
+        total=sum(totals.values())
+        if not total:
+            return ''
+        return ', '.join('{} {:.1f}%'.format(name,100*seconds/total) for name,seconds in totals.items())
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler=None
+        if self.enabled:
+            self.write({'event':'summary','seconds':time.perf_counter()-self.started, \
+                        'phase_seconds':self.totals,'peak_memory_mb':self.engine.peak_memory()/2**20})
+            self.file.close()
+            self.enabled=False
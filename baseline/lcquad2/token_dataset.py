@@ -0,0 +1,180 @@
+import json
+import struct
+import hashlib
+from collections.abc import Sequence
+
+import numpy as np
+
+# Pre-tokenized, memory-mapped replacement for the *_new_mix.pickle files.
+#
+# Layout: 8 byte magic, uint64 header length, JSON header, then 8-byte
+# aligned sections. Token ids are flat int32 arrays indexed by int64 offset
+# arrays (n+1 entries); the raw strings are kept as utf-8 blobs the same way
+# so validation and testing can still report the original text.
+
+MAGIC=b'T5SPTOK1'
+ALIGN=8
+
+SECTIONS=[('input_ids','<i4'),('input_offsets','<i8'),
+          ('labels','<i4'),('label_offsets','<i8'),
+          ('input_text','u1'),('input_text_offsets','<i8'),
+          ('label_text','u1'),('label_text_offsets','<i8')]
+
+
+def vocab_hash(path='vocab.txt'):
+    file=open(path,'rb')
+    digest=hashlib.sha1(file.read()).hexdigest()
+    file.close()
+    return digest
+
+
+def load_tokenizer(model_name,vocab=None,path=None):
+    # BART has no <extra_id_N> tokens, so the trainers add them on top.
+    # path: a local copy (bundle.py) of model_name's tokenizer
+    if 'bart' in model_name.lower():
+        from transformers import BartTokenizer
+        tokenizer=BartTokenizer.from_pretrained(path or model_name)
+        if vocab is not None:
+            tokenizer.add_tokens(['<extra_id_'+str(i)+'>' for i in range(len(vocab))])
+        return tokenizer
+    from transformers import T5Tokenizer
+    return T5Tokenizer.from_pretrained(path or model_name)
+
+
+def _flatten(seqs,dtype):
+    offsets=np.zeros(len(seqs)+1,dtype='<i8')
+    offsets[1:]=np.cumsum([len(s) for s in seqs])
+    flat=np.fromiter((t for s in seqs for t in s),dtype=dtype,count=int(offsets[-1]))
+    return flat,offsets
+
+
+def write(path,data,tokenizer,tokenizer_name,vocab_path='vocab.txt',max_length=512):
+    inputs=[d[0] for d in data]
+    targets=[d[1] for d in data]
+    input_ids=tokenizer(inputs,max_length=max_length,truncation=True)['input_ids']
+    labels=tokenizer(targets,max_length=max_length,truncation=True)['input_ids']
+
+    arrays={}
+    arrays['input_ids'],arrays['input_offsets']=_flatten(input_ids,'<i4')
+    arrays['labels'],arrays['label_offsets']=_flatten(labels,'<i4')
+    arrays['input_text'],arrays['input_text_offsets']= \
+        _flatten([s.encode('utf-8') for s in inputs],'u1')
+    arrays['label_text'],arrays['label_text_offsets']= \
+        _flatten([s.encode('utf-8') for s in targets],'u1')
+
+    header={'tokenizer':tokenizer_name,'vocab_sha1':vocab_hash(vocab_path),
+            'pad_token_id':tokenizer.pad_token_id,'count':len(data),
+            'max_length':max_length,'sections':{}}
+    # Section offsets depend on the header size, so lay out with a
+    # placeholder first and re-encode until the header length is stable.
+    blob=b''
+    while True:
+        start=len(MAGIC)+8+len(blob)
+        pos=-(-start//ALIGN)*ALIGN
+        for name,dtype in SECTIONS:
+            header['sections'][name]=[pos,dtype,len(arrays[name])]
+            pos+=-(-arrays[name].nbytes//ALIGN)*ALIGN
+        new=json.dumps(header).encode('utf-8')
+        stable=len(new)==len(blob)
+        blob=new
+        if stable:
+            break
+
+    file=open(path,'wb')
+    file.write(MAGIC)
+    file.write(struct.pack('<Q',len(blob)))
+    file.write(blob)
+    for name,dtype in SECTIONS:
+        file.write(b'\0'*(header['sections'][name][0]-file.tell()))
+        file.write(arrays[name].tobytes())
+    file.close()
+    return header
+
+
+class TokenDataset(Sequence):
+    def __init__(self,path,index=None,_mm=None):
+        self.path=path
+        if _mm is None:
+            file=open(path,'rb')
+            magic=file.read(len(MAGIC))
+            if magic!=MAGIC:
+                file.close()
+                raise ValueError('{} is not a token dataset'.format(path))
+            size=struct.unpack('<Q',file.read(8))[0]
+            header=json.loads(file.read(size).decode('utf-8'))
+            file.close()
+            mm=np.memmap(path,dtype='u1',mode='r')
+            arrays={}
+            for name,(offset,dtype,length) in header['sections'].items():
+                width=np.dtype(dtype).itemsize
+                arrays[name]=mm[offset:offset+length*width].view(dtype)
+            _mm=(header,arrays)
+        self._mm=_mm
+        self.header,self.arrays=_mm
+        self.index=range(self.header['count']) if index is None else index
+
+    def check(self,tokenizer_name,vocab_path='vocab.txt'):
+        if self.header['tokenizer']!=tokenizer_name:
+            raise ValueError('{} was tokenized with {}, not {}'.format(
+                self.path,self.header['tokenizer'],tokenizer_name))
+        if self.header['vocab_sha1']!=vocab_hash(vocab_path):
+            raise ValueError('{} was built against a different {}'.format(self.path,vocab_path))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self,i):
+        # Slices are views over the same mapping; items are [input, label]
+        # strings like the pickled lists.
+        if isinstance(i,slice):
+            return TokenDataset(self.path,self.index[i],self._mm)
+        j=self.index[i]
+        return [self._text('input_text',j),self._text('label_text',j)]
+
+    def _text(self,name,j):
+        offsets=self.arrays[name+'_offsets']
+        return self.arrays[name][offsets[j]:offsets[j+1]].tobytes().decode('utf-8')
+
+    def ids(self,i):
+        j=self.index[i]
+        a,b=self.arrays['input_offsets'][j:j+2]
+        c,d=self.arrays['label_offsets'][j:j+2]
+        return self.arrays['input_ids'][a:b],self.arrays['labels'][c:d]
+
+    def lengths(self):
+        index=np.asarray(self.index)
+        return np.diff(self.arrays['input_offsets'])[index],np.diff(self.arrays['label_offsets'])[index]
+
+    def collate(self,indices,pad_token_id=None):
+        # Same tensors preprocess_function builds from strings: right padded
+        # inputs with an attention mask, labels padded with -100.
+        import torch
+        if pad_token_id is None:
+            pad_token_id=self.header['pad_token_id']
+        pairs=[self.ids(i) for i in indices]
+        inp_len=max(len(p[0]) for p in pairs)
+        lab_len=max(len(p[1]) for p in pairs)
+        input_ids=np.full((len(pairs),inp_len),pad_token_id,dtype=np.int64)
+        attention_mask=np.zeros((len(pairs),inp_len),dtype=np.int64)
+        labels=np.full((len(pairs),lab_len),-100,dtype=np.int64)
+        for k,(inp,lab) in enumerate(pairs):
+            input_ids[k,:len(inp)]=inp
+            attention_mask[k,:len(inp)]=1
+            labels[k,:len(lab)]=lab
+        return {'input_ids':torch.from_numpy(input_ids),
+                'attention_mask':torch.from_numpy(attention_mask),
+                'labels':torch.from_numpy(labels)}
+
+
+def load(path):
+    # Accepts either a token dataset or one of the original pickles.
+    file=open(path,'rb')
+    magic=file.read(len(MAGIC))
+    file.close()
+    if magic==MAGIC:
+        return TokenDataset(path)
+    import pickle
+    file=open(path,'rb')
+    data=pickle.load(file)
+    file.close()
+    return data
@@ -9,3 +9,9 @@ python3 Train_T5.py --train_file train_new_mix.pickle --model_name t5-small
 echo "Training BART base on LCQUAD 2.0"
 python3 Train_BART.py --train_file train_new_mix.pickle --model_name facebook/bart-base
 
+
+# per-step phase times, tokens/s, padding ratio and memory as JSONL, with profiler traces of steps 1000-1004
+# python3 Train_T5.py --train_file train_new_mix.pickle --model_name t5-small --telemetry t5-small_train.jsonl --profile_at 1000
+
+# greedy validation on 512 stratified dev questions every 1000 steps, the full 10-beam one at 30000/45000/60000 and whenever the greedy accuracy improves
+# python3 Train_T5.py --train_file train_new_mix.pickle --model_name t5-small --val_every 1000 --val_size 512 --full_every 0 --full_at 30000,45000,60000 --full_on_improve
@@ -0,0 +1,784 @@
+import os
+import re
+import gzip
+import json
+import bisect
+import argparse
+
+import numpy as np
+
+# Embedded, integer-encoded triple store for offline execution accuracy.
+#
+# A store is a directory of .npy files: every RDF term (in N-Triples syntax)
+# sorted into one utf-8 blob with offsets, so a term's id is its rank and
+# lookups are a binary search, plus the triples sorted in SPO, POS and OSP
+# order as one contiguous int array per column. Everything is opened with
+# mmap, so worker processes share one page-cached copy.
+#
+# LocalEndpoint answers the SELECT/ASK/COUNT/FILTER/ORDER BY/LIMIT subset of
+# SPARQL that LC-QuAD 2.0 queries use, in the SPARQL JSON results format,
+# and can stand in for the HTTP endpoint in get_F1.py.
+#
+#   python triple_store.py --build --ntriples dump.nt.gz --out kg \
+#       --relevant test_KG_4211.json
+#   python triple_store.py --kg kg --query "ASK { wd:Q1 wdt:P31 ?x }"
+
+XSD='http://www.w3.org/2001/XMLSchema#'
+RDFS_LABEL='<http://www.w3.org/2000/01/rdf-schema#label>'
+NUMERIC_TYPES=set(XSD+t for t in ('integer','decimal','double','float','int','long','short', \
+                                  'nonNegativeInteger','positiveInteger','negativeInteger', \
+                                  'nonPositiveInteger','unsignedInt','unsignedLong'))
+
+PREFIXES={'wd':'http://www.wikidata.org/entity/',
+          'wds':'http://www.wikidata.org/entity/statement/',
+          'wdt':'http://www.wikidata.org/prop/direct/',
+          'p':'http://www.wikidata.org/prop/',
+          'ps':'http://www.wikidata.org/prop/statement/',
+          'pq':'http://www.wikidata.org/prop/qualifier/',
+          'rdfs':'http://www.w3.org/2000/01/rdf-schema#',
+          'rdf':'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+          'xsd':XSD,
+          'schema':'http://schema.org/',
+          'skos':'http://www.w3.org/2004/02/skos/core#'}
+
+ORDERS={'spo':(0,1,2),'pos':(1,2,0),'osp':(2,0,1)}
+
+
+# ---------------------------------------------------------------- terms
+
+_NT_RE=re.compile(r'^\s*(<[^>]*>|_:\S+)\s+(<[^>]*>)\s+'
+                  r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+_LIT_RE=re.compile(r'^"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^<([^>]*)>)?$',re.S)
+_ESC_RE=re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_ESCAPES={'t':'\t','b':'\b','n':'\n','r':'\r','f':'\f','"':'"',"'":"'",'\\':'\\'}
+
+
+def _unescape(text):
+    def sub(m):
+        e=m.group(1)
+        if e[0] in 'uU':
+            return chr(int(e[1:],16))
+        return _ESCAPES.get(e,e)
+    return _ESC_RE.sub(sub,text)
+
+
+def _escape(text):
+    return text.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n').replace('\r','\\r')
+
+
+def literal(lex,lang=None,datatype=None):
+    term='"'+_escape(lex)+'"'
+    if lang:
+        return term+'@'+lang.lower()
+    if datatype:
+        return term+'^^<'+datatype+'>'
+    return term
+
+
+def parse_term(term):
+    # ('uri', iri) | ('bnode', id) | ('lit', lexical, lang, datatype)
+    if term[0]=='<':
+        return ('uri',term[1:-1])
+    if term[0]=='_':
+        return ('bnode',term[2:])
+    m=_LIT_RE.match(term)
+    return ('lit',_unescape(m.group(1)),(m.group(2) or '').lower(),m.group(3))
+
+
+def to_json(term):
+    value=parse_term(term)
+    if value[0]!='lit':
+        return {'type':value[0],'value':value[1]}
+    out={'type':'literal','value':value[1]}
+    if value[2]:
+        out['xml:lang']=value[2]
+    elif value[3]:
+        out['type']='typed-literal'
+        out['datatype']=value[3]
+    return out
+
+
+# ---------------------------------------------------------------- building
+
+def _lines(path):
+    if path.endswith('.gz'):
+        return gzip.open(path,'rt',encoding='utf-8')
+    return open(path,'r',encoding='utf-8')
+
+
+def _triples(path):
+    file=_lines(path)
+    for line in file:
+        m=_NT_RE.match(line)
+        if m is not None:
+            yield m.group(1),m.group(2),m.group(3)
+    file.close()
+
+
+def relevant_entities(data):
+    # wd: ids mentioned by LC-QuAD 2.0 gold queries, as N-Triples IRIs
+    from sparql_rewriter import lex, ENTITY
+    ents=set()
+    for inst in data:
+        for kind,text in lex(inst['sparql_wikidata']):
+            if kind==ENTITY:
+                ents.add('<'+PREFIXES['wd']+text.upper()+'>')
+    return ents
+
+
+def build(ntriples,out,relevant=None):
+    # With `relevant`, keep only the triples touching those entities or their
+    # direct neighbours (statement nodes, class members, ...), which is what
+    # the single-hop and statement-qualifier queries of LC-QuAD 2.0 reach.
+    keep=None
+    if relevant is not None:
+        keep=set(relevant)
+        for s,p,o in _triples(ntriples):
+            if s in relevant:
+                if o[0]!='"':
+                    keep.add(o)
+            elif o in relevant:
+                keep.add(s)
+
+    ids={}
+    rows=[]
+    for s,p,o in _triples(ntriples):
+        if keep is not None and s not in keep and o not in relevant:
+            continue
+        row=[]
+        for t in (s,p,o):
+            idx=ids.get(t)
+            if idx is None:
+                idx=ids[t]=len(ids)
+            row.append(idx)
+        rows.append(row)
+
+    terms=sorted(ids)
+    remap=np.empty(len(terms),dtype=np.int64)
+    for rank,t in enumerate(terms):
+        remap[ids[t]]=rank
+    triples=remap[np.asarray(rows,dtype=np.int64).reshape(-1,3)] if rows else np.zeros((0,3),dtype=np.int64)
+    triples=np.unique(triples,axis=0)
+    dtype=np.int32 if len(terms)<2**31 else np.int64
+
+    os.makedirs(out,exist_ok=True)
+    blobs=[t.encode('utf-8') for t in terms]
+    offsets=np.zeros(len(blobs)+1,dtype=np.int64)
+    offsets[1:]=np.cumsum([len(b) for b in blobs])
+    np.save(os.path.join(out,'terms.npy'),np.frombuffer(b''.join(blobs),dtype=np.uint8))
+    np.save(os.path.join(out,'term_offsets.npy'),offsets)
+    for name,cols in ORDERS.items():
+        perm=np.lexsort((triples[:,cols[2]],triples[:,cols[1]],triples[:,cols[0]]))
+        for k in range(3):
+            np.save(os.path.join(out,'{}_{}.npy'.format(name,k)),triples[perm,cols[k]].astype(dtype))
+    file=open(os.path.join(out,'meta.json'),'w')
+    json.dump({'terms':len(terms),'triples':len(triples)},file)
+    file.close()
+    return len(terms),len(triples)
+
+
+# ---------------------------------------------------------------- store
+
+class _Terms:
+    # sorted term list over the mmapped blob, for bisect
+    def __init__(self,blob,offsets):
+        self.blob=blob
+        self.offsets=offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self,i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+
+class TripleStore:
+    def __init__(self,path):
+        self.path=path
+        load=lambda name:np.load(os.path.join(path,name+'.npy'),mmap_mode='r')
+        self.terms=_Terms(load('terms'),load('term_offsets'))
+        self.index={name:[load('{}_{}'.format(name,k)) for k in range(3)] for name in ORDERS}
+        self.size=len(self.index['spo'][0])
+
+    def term_id(self,term):
+        i=bisect.bisect_left(self.terms,term)
+        if i<len(self.terms) and self.terms[i]==term:
+            return i
+        return None
+
+    def term(self,i):
+        return self.terms[int(i)]
+
+    def match(self,s=None,p=None,o=None):
+        # (s, p, o) id arrays of the triples matching the bound positions
+        bound=(s is not None,p is not None,o is not None)
+        if bound[0] and not bound[1] and bound[2]:
+            name,key='osp',(o,s)
+        elif bound[0]:
+            name,key='spo',tuple(x for x in (s,p,o) if x is not None)
+        elif bound[1]:
+            name,key='pos',tuple(x for x in (p,o) if x is not None)
+        elif bound[2]:
+            name,key='osp',(o,)
+        else:
+            name,key='spo',()
+        cols=self.index[name]
+        lo,hi=0,self.size
+        for k,value in enumerate(key):
+            col=cols[k][lo:hi]
+            lo,hi=lo+np.searchsorted(col,value,'left'),lo+np.searchsorted(col,value,'right')
+        out=[None,None,None]
+        for k,pos in enumerate(ORDERS[name]):
+            out[pos]=np.asarray(cols[k][lo:hi])
+        return out
+
+
+# ---------------------------------------------------------------- parsing
+
+_TOKEN_RE=re.compile(r"""
+      (?P<ws>\s+)
+    | (?P<iri><[^<>"{}|^`\\\s]*>)
+    | (?P<var>[?$][A-Za-z0-9_]+)
+    | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      (?:@(?P<lang>[A-Za-z]+(?:-[A-Za-z0-9]+)*)|\^\^(?P<dt><[^>]*>|[A-Za-z_][\w-]*:[\w-]*))?
+    | (?P<number>[+-]?(?:\d+(?:\.\d+)?|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<op>&&|\|\||!=|<=|>=|[=<>!*(){}.,;])
+    | (?P<pname>[A-Za-z_][\w-]*:[^\s(){}.,;'"<>=!?]*)
+    | (?P<word>[A-Za-z_]\w*)
+""",re.VERBOSE)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def tokenize(query):
+    tokens=[]
+    pos=0
+    while pos<len(query):
+        m=_TOKEN_RE.match(query,pos)
+        if m is None:
+            raise QueryError('cannot parse query at: '+query[pos:pos+20])
+        pos=m.end()
+        kind=m.lastgroup
+        if kind=='ws':
+            continue
+        if kind in ('lang','dt'):
+            kind='string'
+        if kind=='word':
+            tokens.append(('word',m.group(0).lower()))
+        elif kind=='string':
+            dt=m.group('dt')
+            tokens.append(('string',(_unescape(m.group('string')[1:-1]),m.group('lang'),dt)))
+        else:
+            tokens.append((kind,m.group(0)))
+    return tokens
+
+
+class Parser:
+    def __init__(self,query):
+        self.tokens=tokenize(query)
+        self.pos=0
+        self.prefixes=dict(PREFIXES)
+
+    def peek(self,k=0):
+        if self.pos+k<len(self.tokens):
+            return self.tokens[self.pos+k]
+        return (None,None)
+
+    def take(self,kind=None,value=None):
+        tok=self.peek()
+        if (kind is not None and tok[0]!=kind) or (value is not None and tok[1]!=value):
+            raise QueryError('expected {} but found {}'.format(value or kind,tok[1]))
+        self.pos+=1
+        return tok
+
+    def accept(self,kind,value=None):
+        tok=self.peek()
+        if tok[0]==kind and (value is None or tok[1]==value):
+            self.pos+=1
+            return True
+        return False
+
+    def iri(self,tok):
+        if tok[0]=='iri':
+            return tok[1]
+        prefix,local=tok[1].split(':',1)
+        if prefix not in self.prefixes:
+            raise QueryError('unknown prefix '+prefix)
+        return '<'+self.prefixes[prefix]+local+'>'
+
+    def parse(self):
+        while self.accept('word','prefix'):
+            name=self.take('pname')[1].split(':',1)[0]
+            self.prefixes[name]=self.take('iri')[1][1:-1]
+        q={'distinct':False,'projection':[],'order':[],'limit':None,'offset':0}
+        if self.accept('word','ask'):
+            q['form']='ask'
+        else:
+            self.take('word','select')
+            q['form']='select'
+            if self.accept('word','distinct') or self.accept('word','reduced'):
+                q['distinct']=True
+            while True:
+                tok=self.peek()
+                if tok[0]=='var':
+                    self.pos+=1
+                    q['projection'].append(('var',tok[1][1:]))
+                elif tok==('op','*'):
+                    self.pos+=1
+                    q['projection'].append(('all',))
+                elif tok==('op','('):
+                    self.pos+=1
+                    self.take('word','count')
+                    self.take('op','(')
+                    distinct=self.accept('word','distinct')
+                    arg=None if self.accept('op','*') else self.take('var')[1][1:]
+                    self.take('op',')')
+                    self.take('word','as')
+                    alias=self.take('var')[1][1:]
+                    self.take('op',')')
+                    q['projection'].append(('count',arg,distinct,alias))
+                else:
+                    break
+            if not q['projection']:
+                raise QueryError('empty projection')
+        self.accept('word','where')
+        q['patterns'],q['filters']=self.group()
+        self.modifiers(q)
+        if self.peek()[0] is not None:
+            raise QueryError('trailing tokens after query')
+        return q
+
+    def group(self):
+        self.take('op','{')
+        patterns,filters=[],[]
+        while not self.accept('op','}'):
+            if self.accept('op','.'):
+                continue
+            if self.accept('word','filter'):
+                filters.append(self.constraint())
+                continue
+            patterns.extend(self.triples())
+        return patterns,filters
+
+    def term(self,position):
+        tok=self.take()
+        if tok[0]=='var':
+            return ('var',tok[1][1:])
+        if tok[0] in ('iri','pname'):
+            return ('const',self.iri(tok))
+        if tok==('word','a') and position=='p':
+            return ('const','<'+PREFIXES['rdf']+'type>')
+        if position=='o':
+            if tok[0]=='string':
+                lex,lang,dt=tok[1]
+                if dt is not None:
+                    dt=self.iri(('iri',dt) if dt[0]=='<' else ('pname',dt))[1:-1]
+                return ('const',literal(lex,lang,dt))
+            if tok[0]=='number':
+                return ('const',literal(tok[1],None,XSD+_number_type(tok[1])))
+            if tok[0]=='word' and tok[1] in ('true','false'):
+                return ('const',literal(tok[1],None,XSD+'boolean'))
+        raise QueryError('unexpected {} in triple pattern'.format(tok[1]))
+
+    def triples(self):
+        out=[]
+        s=self.term('s')
+        while True:
+            p=self.term('p')
+            while True:
+                out.append((s,p,self.term('o')))
+                if not self.accept('op',','):
+                    break
+            if not self.accept('op',';'):
+                break
+            if self.peek() in (('op','.'),('op','}')):
+                break
+        return out
+
+    def constraint(self):
+        if self.peek()==('op','('):
+            self.pos+=1
+            expr=self.expr()
+            self.take('op',')')
+            return expr
+        return self.primary()
+
+    def expr(self):
+        left=self.conjunction()
+        while self.accept('op','||'):
+            left=('or',left,self.conjunction())
+        return left
+
+    def conjunction(self):
+        left=self.relation()
+        while self.accept('op','&&'):
+            left=('and',left,self.relation())
+        return left
+
+    def relation(self):
+        left=self.unary()
+        tok=self.peek()
+        if tok[0]=='op' and tok[1] in ('=','!=','<','>','<=','>='):
+            self.pos+=1
+            return ('cmp',tok[1],left,self.unary())
+        return left
+
+    def unary(self):
+        if self.accept('op','!'):
+            return ('not',self.unary())
+        return self.primary()
+
+    def primary(self):
+        tok=self.take()
+        if tok==('op','('):
+            expr=self.expr()
+            self.take('op',')')
+            return expr
+        if tok[0]=='var':
+            return ('var',tok[1][1:])
+        if tok[0]=='string':
+            lex,lang,dt=tok[1]
+            if dt is not None:
+                dt=self.iri(('iri',dt) if dt[0]=='<' else ('pname',dt))[1:-1]
+            return ('value',('lit',lex,(lang or '').lower(),dt))
+        if tok[0]=='number':
+            return ('value',('lit',tok[1],'',XSD+_number_type(tok[1])))
+        if tok[0] in ('iri','pname'):
+            return ('value',('uri',self.iri(tok)[1:-1]))
+        if tok[0]=='word':
+            if tok[1] in ('true','false'):
+                return ('value',('lit',tok[1],'',XSD+'boolean'))
+            self.take('op','(')
+            args=[]
+            if not self.accept('op',')'):
+                while True:
+                    args.append(self.expr())
+                    if self.accept('op',')'):
+                        break
+                    self.take('op',',')
+            return ('call',tok[1],args)
+        raise QueryError('unexpected {} in expression'.format(tok[1]))
+
+    def modifiers(self,q):
+        while self.peek()[0]=='word':
+            word=self.take()[1]
+            if word=='order':
+                self.take('word','by')
+                while True:
+                    tok=self.peek()
+                    if tok[0]=='word' and tok[1] in ('asc','desc'):
+                        self.pos+=1
+                        self.take('op','(')
+                        expr=self.expr()
+                        self.take('op',')')
+                        q['order'].append((expr,tok[1]=='desc'))
+                    elif tok[0]=='var':
+                        self.pos+=1
+                        q['order'].append((('var',tok[1][1:]),False))
+                    else:
+                        break
+                if not q['order']:
+                    raise QueryError('empty ORDER BY')
+            elif word in ('limit','offset'):
+                text=self.take('number')[1]
+                if not text.isdigit():
+                    raise QueryError(word.upper()+' needs an integer, got '+text)
+                q[word]=int(text)
+            else:
+                raise QueryError('unsupported clause '+word)
+
+
+def _number_type(text):
+    if 'e' in text or 'E' in text:
+        return 'double'
+    if '.' in text:
+        return 'decimal'
+    return 'integer'
+
+
+def parse(query):
+    return Parser(query).parse()
+
+
+# ---------------------------------------------------------------- evaluation
+
+class _Error(Exception):
+    pass
+
+
+def _numeric(value):
+    if value[0]=='lit' and value[3] in NUMERIC_TYPES:
+        try:
+            return float(value[1])
+        except ValueError:
+            raise _Error()
+    return None
+
+
+def _string(value):
+    if value[0]=='lit':
+        return value[1]
+    raise _Error()
+
+
+def _ebv(value):
+    if isinstance(value,bool):
+        return value
+    if value[0]=='lit':
+        if value[3]==XSD+'boolean':
+            return value[1]=='true'
+        num=_numeric(value)
+        if num is not None:
+            return num!=0
+        return value[1]!=''
+    raise _Error()
+
+
+def _compare(op,a,b):
+    na,nb=_numeric(a),_numeric(b)
+    if na is not None and nb is not None:
+        x,y=na,nb
+    elif op in ('=','!='):
+        same=a[:3]==b[:3] if a[0]=='lit' and b[0]=='lit' else a==b
+        return same if op=='=' else not same
+    elif a[0]=='lit' and b[0]=='lit':
+        x,y=a[1],b[1]
+    else:
+        raise _Error()
+    return {'=':x==y,'!=':x!=y,'<':x<y,'>':x>y,'<=':x<=y,'>=':x>=y}[op]
+
+
+def _lit(text):
+    return ('lit',text,'',None)
+
+
+def _year(value):
+    m=re.match(r'^(-?\d+)-',_string(value))
+    if m is None:
+        raise _Error()
+    return ('lit',str(int(m.group(1))),'',XSD+'integer')
+
+
+_FUNCTIONS={
+    'lcase':lambda v:('lit',_string(v).lower(),v[2],v[3]),
+    'ucase':lambda v:('lit',_string(v).upper(),v[2],v[3]),
+    'str':lambda v:_lit(v[1]),
+    'lang':lambda v:_lit(v[2] if v[0]=='lit' else ''),
+    'contains':lambda a,b:_string(b) in _string(a),
+    'strstarts':lambda a,b:_string(a).startswith(_string(b)),
+    'strends':lambda a,b:_string(a).endswith(_string(b)),
+    'regex':lambda a,b,f=None:re.search(_string(b),_string(a), \
+                                        re.I if f is not None and 'i' in _string(f) else 0) is not None,
+    'langmatches':lambda a,b:_string(b)=='*' and _string(a)!='' or \
+        _string(a).lower().split('-')[0]==_string(b).lower(),
+    'year':_year,
+}
+
+
+class LocalEndpoint:
+    # Endpoint.query over a TripleStore, returning SPARQL JSON results.
+    def __init__(self,path):
+        self.store=TripleStore(path)
+        self.url='local:'+os.path.abspath(path)
+        self._values={}
+
+    def close(self):
+        pass
+
+    def value(self,idx):
+        v=self._values.get(idx)
+        if v is None:
+            v=self._values[idx]=parse_term(self.store.term(idx))
+        return v
+
+    def eval(self,expr,row):
+        kind=expr[0]
+        if kind=='var':
+            if expr[1] not in row:
+                raise _Error()
+            return self.value(row[expr[1]])
+        if kind=='value':
+            return expr[1]
+        if kind=='not':
+            return not _ebv(self.eval(expr[1],row))
+        if kind=='and':
+            return _ebv(self.eval(expr[1],row)) and _ebv(self.eval(expr[2],row))
+        if kind=='or':
+            try:
+                if _ebv(self.eval(expr[1],row)):
+                    return True
+            except _Error:
+                return _ebv(self.eval(expr[2],row)) or _raise()
+            return _ebv(self.eval(expr[2],row))
+        if kind=='cmp':
+            return _compare(expr[1],self.eval(expr[2],row),self.eval(expr[3],row))
+        if kind=='call':
+            if expr[1]=='bound':
+                return expr[2][0][1] in row
+            fn=_FUNCTIONS.get(expr[1])
+            if fn is None:
+                raise QueryError('unsupported function '+expr[1])
+            try:
+                return fn(*[self.eval(a,row) for a in expr[2]])
+            except (TypeError,IndexError):
+                raise _Error()
+        raise QueryError('bad expression')
+
+    def passes(self,expr,row):
+        try:
+            return _ebv(self.eval(expr,row))
+        except _Error:
+            return False
+
+    def solve(self,patterns,filters):
+        # Index nested-loop join. Patterns are taken greedily by how many
+        # positions are bound, and each FILTER runs as soon as its variables
+        # are, which keeps intermediate results small.
+        store=self.store
+        consts={}
+        for pat in patterns:
+            for t in pat:
+                if t[0]=='const' and t[1] not in consts:
+                    consts[t[1]]=store.term_id(t[1])
+                    if consts[t[1]] is None:
+                        return []
+        pending=[(f,_vars(f)) for f in filters]
+        rows=[{}]
+        todo=list(patterns)
+        bound=set()
+        while todo:
+            todo.sort(key=lambda pat:-sum(t[0]=='const' or t[1] in bound for t in pat))
+            pat=todo.pop(0)
+            new=[]
+            for row in rows:
+                key=[consts[t[1]] if t[0]=='const' else row.get(t[1]) for t in pat]
+                found=store.match(*key)
+                for k in range(len(found[0])):
+                    ext=dict(row)
+                    ok=True
+                    for pos,t in enumerate(pat):
+                        if t[0]=='var':
+                            val=int(found[pos][k])
+                            if ext.setdefault(t[1],val)!=val:
+                                ok=False
+                                break
+                    if ok:
+                        new.append(ext)
+            rows=new
+            for t in pat:
+                if t[0]=='var':
+                    bound.add(t[1])
+            ready=[f for f,v in pending if v<=bound]
+            pending=[(f,v) for f,v in pending if not v<=bound]
+            for f in ready:
+                rows=[row for row in rows if self.passes(f,row)]
+            if not rows:
+                return []
+        for f,v in pending:
+            rows=[row for row in rows if self.passes(f,row)]
+        return rows
+
+    def sort_key(self,expr,row):
+        try:
+            v=self.eval(expr,row)
+        except _Error:
+            return (0,0,'')
+        if isinstance(v,bool):
+            return (1,int(v),'')
+        num=_numeric(v)
+        if num is not None:
+            return (1,num,'')
+        return (2,0,v[1])
+
+    def execute(self,q):
+        rows=self.solve(q['patterns'],q['filters'])
+        if q['form']=='ask':
+            return {'head':{},'boolean':bool(rows)}
+
+        for expr,desc in reversed(q['order']):
+            rows.sort(key=lambda row:self.sort_key(expr,row),reverse=desc)
+
+        if any(p[0]=='count' for p in q['projection']):
+            result={}
+            for p in q['projection']:
+                if p[0]!='count':
+                    raise QueryError('mixing aggregates and variables needs GROUP BY')
+                vals=[row[p[1]] for row in rows if p[1] in row] if p[1] else [tuple(sorted(r.items())) for r in rows]
+                n=len(set(vals)) if p[2] else len(vals)
+                result[p[3]]={'type':'typed-literal','datatype':XSD+'integer','value':str(n)}
+            names=[p[3] for p in q['projection']]
+            bindings=[result]
+        else:
+            names=[]
+            for p in q['projection']:
+                if p[0]=='all':
+                    names.extend(v for v in _pattern_vars(q['patterns']) if v not in names)
+                elif p[1] not in names:
+                    names.append(p[1])
+            out,seen=[],set()
+            for row in rows:
+                key=tuple(row.get(n) for n in names)
+                if q['distinct']:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                out.append(key)
+            bindings=[{n:to_json(self.store.term(i)) for n,i in zip(names,key) if i is not None} for key in out]
+
+        bindings=bindings[q['offset']:]
+        if q['limit'] is not None:
+            bindings=bindings[:q['limit']]
+        return {'head':{'vars':names},'results':{'bindings':bindings}}
+
+    def query(self,query):
+        return self.execute(parse(query))
+
+
+def _raise():
+    raise _Error()
+
+
+def _vars(expr):
+    if expr[0]=='var':
+        return {expr[1]}
+    out=set()
+    for part in expr[1:]:
+        if isinstance(part,tuple):
+            out|=_vars(part)
+        elif isinstance(part,list):
+            for a in part:
+                out|=_vars(a)
+    return out
+
+
+def _pattern_vars(patterns):
+    names=[]
+    for pat in patterns:
+        for t in pat:
+            if t[0]=='var' and t[1] not in names:
+                names.append(t[1])
+    return names
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--build',action='store_true')
+    parser.add_argument('--ntriples',type=str,default=None)
+    parser.add_argument('--relevant',type=str,default=None)
+    parser.add_argument('--out',type=str,default='kg')
+    parser.add_argument('--kg',type=str,default='kg')
+    parser.add_argument('--query',type=str,default=None)
+    args=parser.parse_args()
+
+    if args.build:
+        relevant=None
+        if args.relevant is not None:
+            file=open(args.relevant,'r')
+            relevant=relevant_entities(json.load(file))
+            file.close()
+        n_terms,n_triples=build(args.ntriples,args.out,relevant)
+        print('{}: {} terms, {} triples'.format(args.out,n_terms,n_triples))
+    if args.query is not None:
+        print(json.dumps(LocalEndpoint(args.kg).query(args.query),indent=1))
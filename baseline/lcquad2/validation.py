@@ -0,0 +1,106 @@
+import json
+import random
+
+# Validation schedule for the Train_* loops.
+#
+# Every --val_every steps the trainer decodes a fixed subset of the dev split
+# greedily (the proxy run); every --full_every steps, at the --full_at steps
+# and, with --full_on_improve, whenever the proxy accuracy beats its best so
+# far, it runs the full 10-beam evaluation over the whole dev split and saves
+# a checkpoint. The subset (--val_size questions, --val_seed) is drawn once
+# per run, in proportion to the query templates of the dev split with at
+# least one question per template, so rare query shapes are still seen.
+#
+#   python Train_T5.py --train_file train_new_mix.pickle --val_every 1000 --val_size 512 --full_every 8000
+#   python Train_T5.py --train_file train_new_mix.pickle --full_at 30000,45000,60000 --full_on_improve
+#
+# Both runs write one JSON line per question ({'input','gold','generated'})
+# as they go, so a dev result can be read while the evaluation is running.
+# --val_every 0 turns the proxy runs off, which is the old behaviour.
+
+
+def add_arguments(parser):
+    parser.add_argument('--val_every',type=int,default=1000)
+    parser.add_argument('--val_size',type=int,default=512)
+    parser.add_argument('--val_seed',type=int,default=0)
+    parser.add_argument('--full_every',type=int,default=8000)
+    parser.add_argument('--full_at',type=str,default=None)
+    parser.add_argument('--full_on_improve',action='store_true')
+
+
+def template(target):
+    # query skeleton: the mask tokens of a target without its ids and labels
+    return ' '.join(tok for tok in target.split() if tok.startswith('<extra_id_'))
+
+
+def stratified_subset(data,size,seed=0):
+    # indices of about size items of data, each template in proportion to its
+    # share (largest remainders) and at least once
+    strata={}
+    for i in range(len(data)):
+        strata.setdefault(template(data[i][1]),[]).append(i)
+    if size>=len(data):
+        return list(range(len(data)))
+
+    keys=sorted(strata)
+    share={key:size*len(strata[key])/len(data) for key in keys}
+    take={key:max(1,int(share[key])) for key in keys}
+    left=size-sum(take.values())
+    for key in sorted(keys,key=lambda key:int(share[key])-share[key]):
+        if left<=0:
+            break
+        if take[key]<len(strata[key]):
+            take[key]+=1
+            left-=1
+
+    rng=random.Random(seed)
+    subset=[]
+    for key in keys:
+        subset.extend(rng.sample(strata[key],min(take[key],len(strata[key]))))
+    return sorted(subset)
+
+
+class ValidationSchedule:
+    def __init__(self,val_every=1000,full_every=8000,full_at=None,full_on_improve=False):
+        self.val_every=val_every
+        self.full_every=full_every
+        self.full_at=set(full_at or [])
+        self.full_on_improve=full_on_improve
+        self.best=None
+
+    @classmethod
+    def from_args(cls,args):
+        full_at=[int(s) for s in args.full_at.split(',')] if args.full_at else None
+        return cls(args.val_every,args.full_every,full_at,args.full_on_improve)
+
+    def due(self,step):
+        # 'full', 'proxy' or None after the given (1-based) step
+        if step in self.full_at or (self.full_every and step%self.full_every==0):
+            return 'full'
+        if self.val_every and step%self.val_every==0:
+            return 'proxy'
+        return None
+
+    def improved(self,score):
+        # whether a proxy score asks for a full run; the first one only
+        # sets the bar
+        best=self.best
+        if best is None or score>best:
+            self.best=score
+        return self.full_on_improve and best is not None and score>best
+
+
+class ResultWriter:
+    # dev results as JSON lines, written through as each batch is decoded
+    def __init__(self,path):
+        self.path=path
+        self.file=open(path,'w',buffering=1)
+
+    def write(self,records):
+        for record in records:
+            self.file.write(json.dumps(record)+'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
@@ -1,2 +1 @@
-python /home/yjunteng/t5-for-sparql/src/serve.py /home/yjunteng/t5-for-sparql/models/text2sparql-t5-small-lcquad2/checkpoints/checkpoint_56000.pth /home/yjunteng/t5-for-sparql/data/lcquad2/vocab.txt --gpu 1
-
+python /home/yjunteng/t5-for-sparql/baseline/lcquad2/serve.py /home/yjunteng/t5-for-sparql/models/text2sparql-t5-small-lcquad2/checkpoints/checkpoint_56000.pth /home/yjunteng/t5-for-sparql/data/lcquad2/vocab.txt --model_name t5-small --gpu 1 --max_batch 16 --max_wait_ms 10